@@ -8,7 +8,8 @@ Agent does gets the local keyboard input in the act() function.
 
 Example: parlai eval_model -m local_human -t babi:Task1k:1 -dt valid
 """
-from typing import Optional
+import time
+from typing import List, Optional
 from parlai.core.params import ParlaiParser
 from parlai.core.opt import Opt
 from parlai.core.agents import Agent
@@ -16,7 +17,18 @@ from parlai.core.message import Message
 from parlai.utils.misc import display_messages, load_cands
 from parlai.utils.strings import colorize
 
-from bbmhr.pipeline.prompting import inference, load_large_model
+from bbmhr.pipeline.latency_budget import make_latency_budget
+from bbmhr.pipeline.model_pool import model_pool
+from bbmhr.pipeline.prompting import (
+    MODEL_DTYPES,
+    DialogueHistory,
+    get_prompt_template,
+    inference,
+    set_response_cache,
+    stream_inference,
+)
+from bbmhr.pipeline.reasoning_client import ReasoningClient
+from bbmhr.pipeline.response_cache import ResponseCache
 
 
 class LocalHumanReasoningAgent(Agent):
@@ -54,7 +66,7 @@ class LocalHumanReasoningAgent(Agent):
             "--reasoning_model_name",
             default=False,
             type=str,
-            help="The reasoning model name. Choose from [gpt, gpt-2, ada, davinci]",
+            help="The reasoning model name. Choose from [gpt, gpt-2, ada, davinci, retrieval[:<expert>[:<encoder>]]]",
         )
         agent.add_argument(
             "--save_history_path",
@@ -62,6 +74,72 @@ class LocalHumanReasoningAgent(Agent):
             type=str,
             help="the file to save the dialogue history."
         )
+        agent.add_argument(
+            "--reasoning_cache_path",
+            default="",
+            type=str,
+            help="SQLite file to cache reasoning responses in.",
+        )
+        agent.add_argument(
+            "--reasoning_cache_read_only",
+            default=False,
+            type="bool",
+            help="Only read from the reasoning cache, e.g. to replay an earlier session.",
+        )
+        agent.add_argument(
+            "--reasoning_dtype",
+            default="float32",
+            type=str,
+            choices=["float32", "bfloat16", "float16", "int8"],
+            help="Type of the local reasoning model weights, bfloat16 halves the memory and "
+            "int8 quantizes the linear layers for faster cpu inference.",
+        )
+        agent.add_argument(
+            "--reasoning_low_memory",
+            default=False,
+            type="bool",
+            help="Memory-map the reasoning model weights while loading.",
+        )
+        agent.add_argument(
+            "--reasoning_lazy_load",
+            default=False,
+            type="bool",
+            help="Load the reasoning model on its first use instead of at startup.",
+        )
+        agent.add_argument(
+            "--reasoning_server_url",
+            default="",
+            type=str,
+            help="Url of a reasoning server to use instead of loading the reasoning model.",
+        )
+        agent.add_argument(
+            "--reasoning_budget",
+            default=0,
+            type=float,
+            help="Seconds to wait for the reasoning of a turn, 0 for no limit. When the "
+            "expert misses it, the reasoning of a similar conversation, the fallback "
+            "expert or no reasoning is used instead. Streamed reasoning has no budget.",
+        )
+        agent.add_argument(
+            "--fallback_reasoning_model_name",
+            default="",
+            type=str,
+            help="Smaller local expert to ask when the reasoning misses its budget, e.g. gpt-2 or retrieval.",
+        )
+        agent.add_argument(
+            "--fallback_reasoning_budget",
+            default=1.0,
+            type=float,
+            help="Seconds to wait for the fallback expert.",
+        )
+        agent.add_argument(
+            "--stream_reasoning",
+            default=False,
+            type="bool",
+            help="Print the reasoning while the expert generates it and report the "
+            "time to its first token. The time to the whole reasoning and to the "
+            "supporter reply is reported with and without streaming.",
+        )
         return parser
 
     def __init__(self, opt, shared=None):
@@ -71,8 +149,34 @@ class LocalHumanReasoningAgent(Agent):
         self.finished = False
         self.fixedCands_txt = load_cands(self.opt.get("local_human_candidates_file"))
         # self.prompt_prefix = read_prompt(self.opt.get("prompt_path"))
-        self.history = ""
-        self.model, self.tokenizer = load_large_model(self.opt.get("reasoning_model_name"))
+        self.history = DialogueHistory()
+        self.turn_start = None
+        self.reasoning_latency = None
+        self.reasoning_dtype = MODEL_DTYPES[self.opt.get("reasoning_dtype", "float32")]
+        self.reasoning_client = None
+        if self.opt.get("reasoning_server_url"):
+            # the expert runs in a reasoning server, no model is loaded here
+            self.reasoning_client = ReasoningClient(self.opt["reasoning_server_url"])
+            self.model, self.tokenizer = None, None
+        elif shared is not None and "reasoning_model" in shared:
+            self.model = shared["reasoning_model"]
+            self.tokenizer = shared["reasoning_tokenizer"]
+            model_pool.retain(self.opt.get("reasoning_model_name"), self.reasoning_dtype)
+        else:
+            self.model, self.tokenizer = model_pool.acquire(
+                self.opt.get("reasoning_model_name"),
+                self.reasoning_dtype,
+                low_memory=self.opt.get("reasoning_low_memory", False),
+                lazy=self.opt.get("reasoning_lazy_load", False),
+            )
+        self.reasoning_budget, self.release_budget = make_latency_budget(self.opt)
+        if self.opt.get("reasoning_cache_path"):
+            set_response_cache(
+                ResponseCache(
+                    self.opt["reasoning_cache_path"],
+                    read_only=self.opt.get("reasoning_cache_read_only", False),
+                )
+            )
         print(
             colorize(
                 "Enter [DONE] if you want to end the episode, [EXIT] to quit.",
@@ -80,11 +184,82 @@ class LocalHumanReasoningAgent(Agent):
             )
         )
 
+    def share(self):
+        shared = super().share()
+        if self.model is not None:
+            shared["reasoning_model"] = self.model
+            shared["reasoning_tokenizer"] = self.tokenizer
+        return shared
+
+    def shutdown(self):
+        if self.reasoning_client is None:
+            model_pool.release(self.opt.get("reasoning_model_name"), self.reasoning_dtype)
+        if self.release_budget is not None:
+            self.release_budget()
+        super().shutdown()
+
+    def expert_reasoning(self, histories: List[DialogueHistory]) -> List[str]:
+        if self.reasoning_client is not None:
+            template = get_prompt_template(self.opt.get("prompt_path")).text
+            return [
+                self.reasoning_client.inference(template, history.text())
+                for history in histories
+            ]
+        return [
+            inference(
+                self.opt.get("reasoning_model_name"),
+                self.model,
+                self.tokenizer,
+                self.opt.get("prompt_path"),
+                history,
+            )
+            for history in histories
+        ]
+
+    def stream_reasoning(self) -> str:
+        """
+        Print the reasoning of the expert piece by piece while it is generated.
+        """
+        first_token = []
+
+        def print_piece(text: str) -> None:
+            if not first_token:
+                first_token.append(time.perf_counter())
+                print(colorize("Expert:", "highlight") + " The seeker", end="")
+            print(text, end="", flush=True)
+
+        gpt_response = stream_inference(
+            self.opt.get("reasoning_model_name"),
+            self.model,
+            self.tokenizer,
+            self.opt.get("prompt_path"),
+            self.history,
+            print_piece,
+        )
+        end = time.perf_counter()
+        print()
+        first = first_token[0] if first_token else end
+        self.reasoning_latency = (first - self.turn_start, end - self.turn_start)
+        return gpt_response
+
+    def report_latency(self, turn_latency: float) -> None:
+        parts = []
+        if self.reasoning_latency is not None:
+            first_token, reasoning = self.reasoning_latency
+            # only a streamed reasoning has a first token before the whole reasoning
+            if first_token is not None:
+                parts.append(f"expert first token {first_token:.2f}s")
+            parts.append(f"reasoning {reasoning:.2f}s")
+        parts.append(f"supporter reply {turn_latency:.2f}s")
+        print(colorize("[ " + ", ".join(parts) + " ]", "field"))
+        self.reasoning_latency = None
+
     def epoch_done(self):
         return self.finished
 
     def observe(self, msg):
-        self.history += "supporter: " + msg["text"] + "\n"
+        self.history.append("supporter: " + msg["text"])
+        received = time.perf_counter()
         print(
             display_messages(
                 [msg],
@@ -93,6 +268,9 @@ class LocalHumanReasoningAgent(Agent):
                 verbose=self.opt.get("verbose", False),
             )
         )
+        if self.turn_start is not None:
+            self.report_latency(received - self.turn_start)
+            self.turn_start = None
 
     def act(self):
         reply = Message()
@@ -100,16 +278,20 @@ class LocalHumanReasoningAgent(Agent):
         try:
             reply_text = input(colorize("Enter Your Message:", "text") + " ")
             if self.opt.get("use_gpt"):
-                self.history += f"seeker: {reply_text}\n"
+                self.turn_start = time.perf_counter()
+                self.history.append(f"seeker: {reply_text}")
                 # prompt = self.prompt_prefix.replace("<conversation>", self.history)
                 gpt_response = ""
-                gpt_response = inference(
-                    self.opt.get("reasoning_model_name"),
-                    self.model,
-                    self.tokenizer,
-                    self.opt.get("prompt_path"),
-                    self.history[:-1]
-                )
+                if self.reasoning_client is None and self.opt.get("stream_reasoning"):
+                    gpt_response = self.stream_reasoning()
+                else:
+                    if self.reasoning_budget is not None:
+                        gpt_response = self.reasoning_budget.reasoning(
+                            self.expert_reasoning, [self.history]
+                        )[0]
+                    else:
+                        gpt_response = self.expert_reasoning([self.history])[0]
+                    self.reasoning_latency = (None, time.perf_counter() - self.turn_start)
                 reply_text += gpt_response
         except EOFError:
             self.finished = True
@@ -124,8 +306,8 @@ class LocalHumanReasoningAgent(Agent):
             # let interactive know we're resetting
             if self.opt.get("save_history_path") != "":
                 with open(self.opt.get("save_history_path"), 'w+', encoding='utf-8') as file:
-                    file.write(self.history)
-            self.history = ""
+                    file.write(str(self.history))
+            self.history.clear()
             raise StopIteration
         reply["text"] = reply_text
         if "[EXIT]" in reply_text:
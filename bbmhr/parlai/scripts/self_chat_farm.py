@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Run the self chats of self_chat_mental in several worker processes.
+
+Every worker loads its own agents, runs a contiguous block of the episodes with the
+seed plus its index, and writes its own log. The logs are merged into the outfile in
+worker order, so the output does not depend on which worker finishes first.
+"""
+import copy
+import json
+import multiprocessing
+import os
+
+from parlai.core.script import ParlaiScript, register_script
+from parlai.utils.conversations import Conversations, Metadata
+from parlai.utils.io import PathManager
+import parlai.utils.logging as logging
+
+from bbmhr.parlai.scripts.self_chat_mental import self_chat, setup_args as setup_self_chat_args
+
+
+def setup_args(parser=None):
+    parser = setup_self_chat_args(parser)
+    parser.add_argument(
+        '--farm-workers', type=int, default=2, help='Number of self chat worker processes'
+    )
+    parser.add_argument(
+        '--farm-gpus',
+        type=str,
+        default='',
+        help='Comma separated gpus to spread the workers over, e.g. "0,1"',
+    )
+    return parser
+
+
+def split_episodes(num_self_chats, num_workers):
+    """
+    Return the number of episodes of every worker, the first ones taking the rest.
+    """
+    size, rest = divmod(num_self_chats, num_workers)
+    return [size + (1 if index < rest else 0) for index in range(num_workers)]
+
+
+def worker_outfile(outfile, index):
+    base, ext = os.path.splitext(outfile)
+    return f'{base}_worker{index}{ext}'
+
+
+def worker_opt(opt, index, num_self_chats):
+    opt = copy.deepcopy(opt)
+    opt['seed'] = opt['seed'] + index
+    opt['num_self_chats'] = num_self_chats
+    opt['outfile'] = worker_outfile(opt['outfile'], index)
+    if opt.get('farm_gpus'):
+        gpus = [int(gpu) for gpu in opt['farm_gpus'].split(',')]
+        opt['gpu'] = gpus[index % len(gpus)]
+    return opt
+
+
+def _run_worker(opt):
+    self_chat(opt)
+
+
+def merge_conversations(opt, outfiles):
+    """
+    Merge the conversations jsonl files of the workers into the one of the outfile.
+    """
+    to_save = Conversations._get_path(opt['outfile'])
+    metadata_path = Metadata._get_path(to_save)
+    speakers = []
+    with PathManager.open(to_save, 'w') as f:
+        for outfile in outfiles:
+            with PathManager.open(Conversations._get_path(outfile)) as worker_file:
+                for line in worker_file:
+                    convo = json.loads(line)
+                    convo['metadata_path'] = metadata_path
+                    for act_pair in convo['dialog']:
+                        for turn in act_pair:
+                            if turn['id'] not in speakers:
+                                speakers.append(turn['id'])
+                    f.write(json.dumps(convo) + '\n')
+    Metadata.save_metadata(
+        to_save, opt, self_chat=opt.get('selfchat_task', False), speakers=speakers
+    )
+    for outfile in outfiles:
+        os.remove(Conversations._get_path(outfile))
+        os.remove(Metadata._get_path(Conversations._get_path(outfile)))
+    logging.info(f'Merged the conversations of {len(outfiles)} workers into {to_save}')
+
+
+def merge_parlai_format(opt, outfiles):
+    with PathManager.open(opt['outfile'], 'w') as f:
+        for outfile in outfiles:
+            with PathManager.open(outfile) as worker_file:
+                f.write(worker_file.read())
+            os.remove(outfile)
+    logging.info(f'Merged the logs of {len(outfiles)} workers into {opt["outfile"]}')
+
+
+def self_chat_farm(opt):
+    if opt['outfile'] is None:
+        opt['outfile'] = '/tmp/self_chat_farm'
+    episodes = split_episodes(opt['num_self_chats'], max(1, opt['farm_workers']))
+    worker_opts = [
+        worker_opt(opt, index, num_self_chats)
+        for index, num_self_chats in enumerate(episodes)
+        if num_self_chats
+    ]
+    # spawn, so that every worker initializes cuda on its own
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_run_worker, args=(o,)) for o in worker_opts]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [index for index, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'self chat workers {failed} failed, their logs are not merged')
+
+    outfiles = [o['outfile'] for o in worker_opts]
+    if opt['save_format'] == 'conversations':
+        merge_conversations(opt, outfiles)
+    else:
+        merge_parlai_format(opt, outfiles)
+
+
+@register_script('self_chat_farm')
+class SelfChatFarm(ParlaiScript):
+    @classmethod
+    def setup_args(cls):
+        return setup_args()
+
+    def run(self):
+        return self_chat_farm(self.opt)
+
+
+if __name__ == '__main__':
+    SelfChatFarm.main()
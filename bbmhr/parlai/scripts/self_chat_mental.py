@@ -17,10 +17,13 @@ from parlai.core.script import ParlaiScript, register_script
 import parlai.utils.logging as logging
 from parlai.utils.io import PathManager
 
+import copy
 import math
 import json
 import random
 
+from bbmhr.parlai.tasks.self_chat.worlds import BatchSelfChatWorld, PipelinedSelfChatWorld
+
 
 def setup_args(parser=None):
     if parser is None:
@@ -41,7 +44,10 @@ def setup_args(parser=None):
         help='Create a self chat version of the task',
     )
     parser.add_argument(
-        '--num-self-chats', type=int, default=1, help='Number of self chats to run'
+        '--num-self-chats',
+        type=int,
+        default=1,
+        help='Number of self chats to run, a multiple of the batchsize',
     )
     parser.add_argument(
         '--selfchat-max-turns',
@@ -55,6 +61,19 @@ def setup_args(parser=None):
         default=False,
         help='Automatically seed conversation with messages from task dataset.',
     )
+    parser.add_argument(
+        '--openers-cache-dir',
+        type=str,
+        default=None,
+        help='Folder to cache the openers of --seed-messages-from-task in, '
+        'defaults to bbmhr_openers in the datapath',
+    )
+    parser.add_argument(
+        '--refresh-openers-cache',
+        type='bool',
+        default=False,
+        help='Collect the openers from the task data again and update the cache',
+    )
     parser.add_argument(
         '--seed-messages-from-file',
         default=None,
@@ -91,7 +110,8 @@ def setup_args(parser=None):
         '--reasoning-model-name',
         type=str,
         default='gpt',
-        help='The name of PLM. selct from [gpt, gpt-2, ada, davinci]'
+        help='The name of PLM. selct from [gpt, gpt-2, ada, davinci], or retrieval[:<expert>[:<encoder>]] '
+        'to retrieve the stored reasoning of the most similar annotated conversation'
     )
     parser.add_argument(
         "--prompt_path", 
@@ -99,6 +119,83 @@ def setup_args(parser=None):
         type=str, 
         help="File for the prompt."
     )
+    parser.add_argument(
+        '--reasoning-cache-path',
+        default='',
+        type=str,
+        help='SQLite file to cache reasoning responses in'
+    )
+    parser.add_argument(
+        '--reasoning-cache-read-only',
+        type='bool',
+        default=False,
+        help='Only read from the reasoning cache, e.g. to replay an earlier run'
+    )
+    parser.add_argument(
+        '--reasoning-dtype',
+        type=str,
+        default='float32',
+        choices=['float32', 'bfloat16', 'float16', 'int8'],
+        help='Type of the local reasoning model weights, bfloat16 halves the memory and '
+        'int8 quantizes the linear layers for faster cpu inference'
+    )
+    parser.add_argument(
+        '--reasoning-low-memory',
+        type='bool',
+        default=False,
+        help='Memory-map the reasoning model weights while loading'
+    )
+    parser.add_argument(
+        '--reasoning-lazy-load',
+        type='bool',
+        default=False,
+        help='Load the reasoning model on its first use instead of at startup'
+    )
+    parser.add_argument(
+        '--reasoning-server-url',
+        default='',
+        type=str,
+        help='Url of a reasoning server to use instead of loading the reasoning model'
+    )
+    parser.add_argument(
+        '--reasoning-budget',
+        type=float,
+        default=0,
+        help='Seconds to wait for the reasoning of a turn, 0 for no limit. When the expert '
+        'misses it, the reasoning of a similar conversation, the fallback expert or no '
+        'reasoning is used instead'
+    )
+    parser.add_argument(
+        '--fallback-reasoning-model-name',
+        type=str,
+        default='',
+        help='Smaller local expert to ask when the reasoning misses its budget, e.g. gpt-2 or retrieval'
+    )
+    parser.add_argument(
+        '--fallback-reasoning-budget',
+        type=float,
+        default=1.0,
+        help='Seconds to wait for the fallback expert'
+    )
+    parser.add_argument(
+        '--pipeline-reasoning',
+        type='bool',
+        default=False,
+        help='With a batchsize above 1, run the reasoning of some episodes on worker '
+        'threads while the dialogue model generates for the others'
+    )
+    parser.add_argument(
+        '--pipeline-groups',
+        type=int,
+        default=2,
+        help='Number of episode groups that take turns in a pipelined batch'
+    )
+    parser.add_argument(
+        '--reasoning-workers',
+        type=int,
+        default=0,
+        help='Worker threads for pipelined reasoning, 0 for one per pipeline group'
+    )
     parser.set_defaults(interactive_mode=True, task='self_chat')
     WorldLogger.add_cmdline_args(parser, partial_opt=None)
     return parser
@@ -107,8 +204,8 @@ def setup_args(parser=None):
 def _run_self_chat_episode(opt, world, world_logger):
     bsz = opt.get('batchsize', 1)
     num_turns = opt['selfchat_max_turns']
-    assert bsz == 1, "Batch size cannot be different than 1 for self-chat"
-    num_parleys = math.ceil(num_turns / bsz)
+    # a batch world runs bsz episodes in lockstep, one turn of each per parley
+    num_parleys = num_turns
     for _ in range(num_parleys):
         world.parley()
         world_logger.log(world)
@@ -120,13 +217,20 @@ def _run_self_chat_episode(opt, world, world_logger):
         print('-- end of episode --')
 
     world.reset()
-    world_logger.reset_world()  # flush this episode
+    for idx in range(bsz):
+        world_logger.reset_world(idx)  # flush this episode
 
 
 def self_chat(opt):
     random.seed(opt['seed'])
     partner = opt['partner_model_file']
     partner_opt_file = opt.get('partner_opt_file')
+    bsz = opt.get('batchsize', 1)
+    # a batch runs bsz whole episodes, a smaller last batch would log more chats than asked
+    if opt['num_self_chats'] % bsz != 0:
+        raise ValueError(
+            f"--num-self-chats {opt['num_self_chats']} must be a multiple of the batchsize {bsz}"
+        )
 
     # Create agents
     agent1 = create_agent(opt, requireModelExists=True)
@@ -155,19 +259,44 @@ def self_chat(opt):
 
     model_id = agent1.id + "_" + agent2.id
 
-    world = create_task(opt, user_agents=[agent1, agent2])
+    if bsz > 1:
+        # batch the self chat world ourselves instead of the generic BatchWorld
+        world_opt = copy.deepcopy(opt)
+        world_opt['batchsize'] = 1
+        world = create_task(world_opt, user_agents=[agent1, agent2])
+        if opt.get('pipeline_reasoning'):
+            world = PipelinedSelfChatWorld(opt, world)
+        else:
+            world = BatchSelfChatWorld(opt, world)
+    else:
+        if opt.get('pipeline_reasoning'):
+            logging.warning('--pipeline-reasoning needs a batchsize above 1, ignoring it')
+        world = create_task(opt, user_agents=[agent1, agent2])
     print(type(world))
 
     # Set up world logging
     logger = WorldLogger(opt)
     log_time = TimeLogger()
 
-    # Run some self chats.
-    for i in range(opt['num_self_chats']):
+    # Run some self chats, bsz at a time.
+    num_batches = opt['num_self_chats'] // bsz
+    for i in range(num_batches):
         _run_self_chat_episode(opt, world, logger)
         report = world.report()
-        text, report = log_time.log(i + 1, opt['num_self_chats'], report)
+        text, report = log_time.log(i + 1, num_batches, report)
         logging.info(text)
+    if isinstance(world, PipelinedSelfChatWorld):
+        overlap = world.overlap_report()
+        logging.info(
+            f"reasoning {overlap['reasoning_seconds']:.1f}s, dialogue model "
+            f"{overlap['act_seconds']:.1f}s, {overlap['hidden_reasoning_seconds']:.1f}s "
+            f"({overlap['hidden_reasoning_fraction']:.0%}) of the reasoning hidden "
+            "behind the dialogue model"
+        )
+
+    reasoning_budget = getattr(getattr(world, 'world', world), 'reasoning_budget', None)
+    if reasoning_budget is not None:
+        logging.info(f"reasoning sources: {reasoning_budget.summary()}")
 
     # Save chats
     if opt['outfile'] is None:
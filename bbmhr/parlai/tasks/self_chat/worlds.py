@@ -6,17 +6,69 @@
 
 from cgitb import text
 import copy
+import hashlib
+import json
+import os
 import random
-from typing import Any, Dict, List, Optional
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
 
 from parlai.agents.fixed_response.fixed_response import FixedResponseAgent
 from parlai.core.agents import Agent
-from parlai.core.worlds import create_task, DialogPartnerWorld, validate
+from parlai.core.worlds import create_task, BatchWorld, DialogPartnerWorld, validate
 from parlai.core.message import Message
-from bbmhr.pipeline.prompting import load_large_model, inference
+from bbmhr.pipeline.latency_budget import make_latency_budget
+from bbmhr.pipeline.model_pool import model_pool
+from bbmhr.pipeline.prompting import (
+    MODEL_DTYPES,
+    DialogueHistory,
+    batch_inference,
+    get_prompt_template,
+    inference,
+    set_response_cache,
+)
+from bbmhr.pipeline.reasoning_client import ReasoningClient
+from bbmhr.pipeline.response_cache import ResponseCache
+
+
+def openers_fingerprint(opt, base_task: str) -> str:
+    """
+    Fingerprint the data the openers of a task are read from.
+
+    Covers the sizes and modification times of the files in the data folder of the
+    task and of any file given with a *_datapath option, e.g. --fromfile-datapath.
+    """
+    paths = []
+    task_folder = os.path.join(opt.get('datapath') or '', base_task.split(':')[-1])
+    if os.path.isdir(task_folder):
+        for root, _, files in os.walk(task_folder):
+            paths.extend(os.path.join(root, name) for name in files)
+    for key, value in opt.items():
+        if key.endswith('_datapath') and isinstance(value, str) and os.path.isfile(value):
+            paths.append(value)
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f'{path}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def openers_cache_path(opt, base_task: str, datatype: str) -> str:
+    cache_dir = opt.get('openers_cache_dir') or os.path.join(
+        opt.get('datapath') or '.', 'bbmhr_openers'
+    )
+    key = json.dumps(
+        [base_task, datatype, openers_fingerprint(opt, base_task)]
+    ).encode('utf-8')
+    return os.path.join(cache_dir, f'openers_{hashlib.sha1(key).hexdigest()}.json')
 
 
 def load_openers(opt) -> Optional[List[str]]:
+    """
+    Load the first messages of the episodes of the task, from the openers cache if
+    the task data did not change since they were collected.
+    """
     if opt['task'].startswith('internal:') or opt['task'].startswith('fb:'):
         base_task = opt['task']
     else:
@@ -26,6 +78,29 @@ def load_openers(opt) -> Optional[List[str]]:
         # TODO(#2284): Load default openers from s3
         return None
 
+    datatype = opt['datatype']
+    cache_path = openers_cache_path(opt, base_task, datatype)
+    if os.path.exists(cache_path) and not opt.get('refresh_openers_cache'):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            openers = json.load(f)['openers']
+        print(f'[ loaded {len(openers)} openers from {cache_path} ]')
+        return openers
+
+    openers = collect_openers(opt, base_task)
+    # the task data may have been downloaded just now, fingerprint it again
+    cache_path = openers_cache_path(opt, base_task, datatype)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'task': base_task, 'datatype': datatype, 'openers': openers}, f)
+    os.replace(tmp_path, cache_path)
+    return openers
+
+
+def collect_openers(opt, base_task: str) -> List[str]:
+    """
+    Run through one epoch of the task data, collecting all first messages.
+    """
     print('[ loading conversation openers... ]')
     # create dummy task so we can get openers from the data
     task_opt = copy.deepcopy(opt)
@@ -71,14 +146,113 @@ class SelfChatWorld(DialogPartnerWorld):
         super().__init__(opt, agents, shared)
         self.init_contexts(shared=shared)
         self._openers = None
-        self.init_openers()
+        if shared is not None and 'openers' in shared:
+            self._openers = shared['openers']
+        else:
+            self.init_openers()
         self.max_turn_cnt = self.opt.get('selfchat_max_turns', 10)
         self.turn_cnt = 0
         self.episode_cnt = 0
         # process bbmhr setting
-        self.history = ""
+        self.history = DialogueHistory()
+        self.reasoning_client = None
+        self.model, self.tokenizer = None, None
+        self.reasoning_budget, self.release_budget = None, None
         if self.opt.get("use_reasoning"):
-            self.model, self.tokenizer = load_large_model(self.opt.get("reasoning_model_name"))
+            self.reasoning_dtype = MODEL_DTYPES[self.opt.get("reasoning_dtype", "float32")]
+            if self.opt.get("reasoning_server_url"):
+                # the expert runs in a reasoning server, no model is loaded here
+                self.reasoning_client = ReasoningClient(self.opt["reasoning_server_url"])
+            elif shared is not None and "reasoning_model" in shared:
+                # copies of this world use the expert of the world they were shared from
+                self.model = shared["reasoning_model"]
+                self.tokenizer = shared["reasoning_tokenizer"]
+                model_pool.retain(self.opt.get("reasoning_model_name"), self.reasoning_dtype)
+            else:
+                self.model, self.tokenizer = model_pool.acquire(
+                    self.opt.get("reasoning_model_name"),
+                    self.reasoning_dtype,
+                    low_memory=self.opt.get("reasoning_low_memory", False),
+                    lazy=self.opt.get("reasoning_lazy_load", False),
+                )
+            if shared is not None and "reasoning_budget" in shared:
+                self.reasoning_budget = shared["reasoning_budget"]
+            else:
+                self.reasoning_budget, self.release_budget = make_latency_budget(self.opt)
+            if self.opt.get("reasoning_cache_path") and shared is None:
+                set_response_cache(
+                    ResponseCache(
+                        self.opt["reasoning_cache_path"],
+                        read_only=self.opt.get("reasoning_cache_read_only", False),
+                    )
+                )
+
+    def share(self):
+        shared = super().share()
+        shared['openers'] = self._openers
+        if self.model is not None:
+            shared["reasoning_model"] = self.model
+            shared["reasoning_tokenizer"] = self.tokenizer
+        if self.reasoning_budget is not None:
+            shared["reasoning_budget"] = self.reasoning_budget
+        return shared
+
+    def shutdown(self):
+        if self.opt.get("use_reasoning") and self.reasoning_client is None:
+            model_pool.release(self.opt.get("reasoning_model_name"), self.reasoning_dtype)
+        if self.release_budget is not None:
+            self.release_budget()
+        super().shutdown()
+
+    def reasoning(self, history: DialogueHistory) -> str:
+        """
+        Get the reasoning of the expert for the conversation so far.
+        """
+        if self.reasoning_budget is not None:
+            return self.batch_reasoning([history])[0]
+        if self.reasoning_client is not None:
+            template = get_prompt_template(self.opt.get("prompt_path"))
+            return self.reasoning_client.inference(template.text, history.text())
+        return inference(
+            self.opt.get("reasoning_model_name"),
+            self.model,
+            self.tokenizer,
+            self.opt.get("prompt_path"),
+            history,
+        )
+
+    def batch_reasoning(self, histories: List[DialogueHistory]) -> List[str]:
+        """
+        Get the reasoning of the expert for several conversations at once, within the
+        latency budget if there is one.
+        """
+        if self.reasoning_budget is not None:
+            return self.reasoning_budget.reasoning(self.expert_reasoning, histories)
+        return self.expert_reasoning(histories)
+
+    def expert_reasoning(self, histories: List[DialogueHistory]) -> List[str]:
+        """
+        Ask the expert for the reasoning of several conversations at once.
+        """
+        if self.reasoning_client is not None:
+            template = get_prompt_template(self.opt.get("prompt_path")).text
+            # concurrent requests are batched by the reasoning server
+            with ThreadPoolExecutor(len(histories)) as executor:
+                return list(
+                    executor.map(
+                        lambda history: self.reasoning_client.inference(
+                            template, history.text()
+                        ),
+                        histories,
+                    )
+                )
+        return batch_inference(
+            self.opt.get("reasoning_model_name"),
+            self.model,
+            self.tokenizer,
+            self.opt.get("prompt_path"),
+            histories,
+        )
 
     def init_contexts(self, shared=None) -> None:
         """
@@ -152,6 +326,27 @@ class SelfChatWorld(DialogPartnerWorld):
             return self.seed_utterances
 
     def parley(self):
+        steps = self.parley_steps()
+        result = None
+        while True:
+            try:
+                request, value = steps.send(result)
+            except StopIteration:
+                break
+            if request == 'act':
+                result = self.agents[value].act()
+            else:
+                result = self.reasoning(value)
+
+    def parley_steps(self):
+        """
+        Run one parley, handing every agent act and every expert reasoning to the
+        caller.
+
+        Yields ('act', agent index) and ('reasoning', history) requests and expects
+        the act or the reasoning text to be sent back, so that a batch world can
+        serve the requests of all its worlds together.
+        """
         if self.episode_done():
             self._end_episode()
 
@@ -187,20 +382,14 @@ class SelfChatWorld(DialogPartnerWorld):
                             self.agents[i].observe({'episode_done': False})
                             self.agents[i].self_observe(self.acts[i])
                     else:
-                        self.acts[i] = self.agents[i].act()
+                        self.acts[i] = yield 'act', i
                     print(f"World acts: {self.acts}")
                     if i == 1:
-                        self.history += "supporter: " + self.acts[1]['text'] + "\n"
+                        self.history.append("supporter: " + self.acts[1]['text'])
                     elif i == 0:
-                        self.history += "seeker: " + self.acts[0]['text'] + "\n"
+                        self.history.append("seeker: " + self.acts[0]['text'])
                         gpt_response = ""
-                        gpt_response = inference(
-                            self.opt.get("reasoning_model_name"),
-                            self.model,
-                            self.tokenizer,
-                            self.opt.get("prompt_path"),
-                            self.history[:-1]
-                        )
+                        gpt_response = yield 'reasoning', self.history
                         self.acts[0]['text'] = self.acts[0]['text'] + gpt_response
                     self.agents[1 - i].observe(validate(self.acts[i]))
             else:
@@ -213,24 +402,18 @@ class SelfChatWorld(DialogPartnerWorld):
                             self.agents[i].observe({'episode_done': False})
                             self.agents[i].self_observe(self.acts[i])
                     else:
-                        self.acts[i] = self.agents[i].act()
+                        self.acts[i] = yield 'act', i
                     self.agents[1 - i].observe(validate(self.acts[i]))
         else:
             # do regular loop
             acts = self.acts
             agents = self.agents
-            acts[0] = agents[0].act()
+            acts[0] = yield 'act', 0
 
             if self.opt.get("use_reasoning"):
-                self.history += "seeker: " + acts[0]['text'] + "\n"
+                self.history.append("seeker: " + acts[0]['text'])
                 gpt_response = ""
-                gpt_response = inference(
-                    self.opt.get("reasoning_model_name"),
-                    self.model,
-                    self.tokenizer,
-                    self.opt.get("prompt_path"),
-                    self.history[:-1]
-                )
+                gpt_response = yield 'reasoning', self.history
                 acts[0] = Message(
                     {
                         'text': acts[0]['text'] + gpt_response, 
@@ -241,8 +424,8 @@ class SelfChatWorld(DialogPartnerWorld):
                 # acts[0]['text'] = acts[0]['text'] + gpt_response
                 print(f"acts[0] after prompting: {acts[0]}")
             agents[1].observe(validate(acts[0]))
-            acts[1] = agents[1].act()
-            self.history += "supporter: " + acts[1]['text'] + "\n"
+            acts[1] = yield 'act', 1
+            self.history.append("supporter: " + acts[1]['text'])
             agents[0].observe(validate(acts[1]))
 
         self.update_counters()
@@ -257,3 +440,190 @@ class SelfChatWorld(DialogPartnerWorld):
         self.contexts = None
         self.seed_utterances = None
         self.reset_agents()
+
+
+class BatchSelfChatWorld(BatchWorld):
+    """
+    Run a batch of self chats in lockstep.
+
+    Every sub world runs the steps of its own parley. At each step, the acts of an
+    agent in all sub worlds are computed with one batch_act call, and the reasoning
+    of all seeker turns with one batched expert call.
+    """
+
+    def parley(self):
+        steps = [w.parley_steps() for w in self.worlds]
+        requests = {}
+        for i, step in enumerate(steps):
+            self._advance(requests, i, step, None)
+        while requests:
+            # serve all the worlds that wait for the same kind of request
+            kind, value = next(iter(requests.values()))
+            if kind == 'act':
+                rows = [i for i, r in requests.items() if r == ('act', value)]
+                results = self._batch_act_rows(value, rows)
+            else:
+                rows = [i for i, r in requests.items() if r[0] == 'reasoning']
+                results = self.world.batch_reasoning([requests[i][1] for i in rows])
+            for i, result in zip(rows, results):
+                del requests[i]
+                self._advance(requests, i, steps[i], result)
+        self.acts = [[w.get_acts()[index] for w in self.worlds] for index in range(2)]
+        self.update_counters()
+
+    def _advance(self, requests, i, step, result):
+        try:
+            requests[i] = step.send(result)
+        except StopIteration:
+            pass
+
+    def _batch_act_rows(self, agent_idx: int, rows: List[int]) -> List[Message]:
+        agent = self.world.get_agents()[agent_idx]
+        row_agents = [self.worlds[i].get_agents()[agent_idx] for i in rows]
+        if not hasattr(agent, 'batch_act'):
+            return [row_agent.act() for row_agent in row_agents]
+        # the same as act() of every row agent, see TorchAgent.act
+        batch_actions = agent.batch_act([row_agent.observation for row_agent in row_agents])
+        for row_agent, action in zip(row_agents, batch_actions):
+            row_agent.self_observe(action)
+        return batch_actions
+
+
+def merge_intervals(intervals: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def overlap_seconds(
+    intervals: List[Tuple[float, float]], others: List[Tuple[float, float]]
+) -> float:
+    """
+    Return the time covered by both groups of (start, end) intervals.
+    """
+    intervals, others = merge_intervals(intervals), merge_intervals(others)
+    total, i, j = 0.0, 0, 0
+    while i < len(intervals) and j < len(others):
+        total += max(
+            0.0, min(intervals[i][1], others[j][1]) - max(intervals[i][0], others[j][0])
+        )
+        if intervals[i][1] < others[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+class PipelinedSelfChatWorld(BatchSelfChatWorld):
+    """
+    Run a batch of self chats, hiding the expert reasoning behind the dialogue model.
+
+    The sub worlds are split into pipeline groups that take turns in act generation.
+    The reasoning of a group runs on a worker pool meanwhile, so the expert works for
+    one episode while BlenderBot generates for another. A sub world that finished its
+    turn may start the next turn of the same episode before the others finish theirs,
+    unless that turn ends the episode.
+    The reasoning time hidden behind act generation is given by overlap_report().
+    """
+
+    def __init__(self, opt, world):
+        super().__init__(opt, world)
+        self.num_groups = max(1, min(opt.get('pipeline_groups') or 2, len(self.worlds)))
+        self.executor = ThreadPoolExecutor(opt.get('reasoning_workers') or self.num_groups)
+        self.steps = {}
+        self.requests = {}
+        self.futures = {}
+        self.finished_turns = [[] for _ in self.worlds]
+        self.next_group = 0
+        self.act_intervals = []
+        self.reasoning_intervals = []
+
+    def group(self, i: int) -> int:
+        return i * self.num_groups // len(self.worlds)
+
+    def parley(self):
+        for i in range(len(self.worlds)):
+            if i not in self.steps and not self.finished_turns[i]:
+                self._start_turn(i)
+        while not all(self.finished_turns):
+            # send the reasoning of every group that is ready to the workers
+            reasoning_rows = [i for i, r in self.requests.items() if r[0] == 'reasoning']
+            for group in sorted({self.group(i) for i in reasoning_rows}):
+                rows = [i for i in reasoning_rows if self.group(i) == group]
+                future = self.executor.submit(
+                    self._timed_reasoning, [self.requests.pop(i)[1] for i in rows]
+                )
+                self.futures[future] = rows
+            act_groups = sorted({self.group(i) for i in self.requests})
+            if act_groups:
+                # serve the groups in turns, one act batch of one group at a time
+                group = next((g for g in act_groups if g >= self.next_group), act_groups[0])
+                self.next_group = group + 1
+                request = next(r for i, r in self.requests.items() if self.group(i) == group)
+                rows = [
+                    i
+                    for i, r in self.requests.items()
+                    if r == request and self.group(i) == group
+                ]
+                start = time.perf_counter()
+                results = self._batch_act_rows(request[1], rows)
+                self.act_intervals.append((start, time.perf_counter()))
+                for i in rows:
+                    del self.requests[i]
+            else:
+                done, _ = wait(self.futures, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                rows = self.futures.pop(future)
+                results = future.result()
+            for i, result in zip(rows, results):
+                self._advance_row(i, result)
+        turns = [finished.pop(0) for finished in self.finished_turns]
+        self.acts = [[acts[index] for acts in turns] for index in range(2)]
+        self.update_counters()
+
+    def _start_turn(self, i: int) -> None:
+        self.steps[i] = self.worlds[i].parley_steps()
+        self._advance_row(i, None)
+
+    def _advance_row(self, i: int, result) -> None:
+        try:
+            self.requests[i] = self.steps[i].send(result)
+        except StopIteration:
+            del self.steps[i]
+            self.finished_turns[i].append(list(self.worlds[i].get_acts()))
+            # run one turn ahead, but never into the next episode nor into the turn that
+            # ends this one: the world logger reads episode_done() of the sub world when
+            # it logs the previous turn
+            world = self.worlds[i]
+            if len(self.finished_turns[i]) == 1 and world.turn_cnt + 1 < world.max_turn_cnt:
+                self._start_turn(i)
+
+    def _timed_reasoning(self, histories: List[str]) -> List[str]:
+        start = time.perf_counter()
+        try:
+            return self.world.batch_reasoning(histories)
+        finally:
+            self.reasoning_intervals.append((start, time.perf_counter()))
+
+    def overlap_report(self) -> Dict[str, float]:
+        """
+        Return the seconds spent in reasoning and in act generation, and the part of
+        the reasoning that was hidden behind act generation.
+        """
+        reasoning = sum(end - start for start, end in merge_intervals(self.reasoning_intervals))
+        acts = sum(end - start for start, end in merge_intervals(self.act_intervals))
+        hidden = overlap_seconds(self.reasoning_intervals, self.act_intervals)
+        return {
+            'reasoning_seconds': reasoning,
+            'act_seconds': acts,
+            'hidden_reasoning_seconds': hidden,
+            'hidden_reasoning_fraction': hidden / reasoning if reasoning else 0.0,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown()
+        super().shutdown()
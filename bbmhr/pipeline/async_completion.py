@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Text
+
+import aiohttp
+import openai
+
+from bbmhr.pipeline.response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+
+
+class RateLimiter:
+    """Token buckets for a requests-per-minute and a tokens-per-minute budget.
+
+    Args:
+        requests_per_minute (int): Allowed requests per minute, 0 for no limit.
+        tokens_per_minute (int): Allowed tokens per minute, 0 for no limit.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.capacities = [requests_per_minute, tokens_per_minute]
+        self.available = [float(requests_per_minute), float(tokens_per_minute)]
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for index, capacity in enumerate(self.capacities):
+            if capacity:
+                self.available[index] = min(
+                    capacity, self.available[index] + elapsed * capacity / 60
+                )
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until one request with the given number of tokens fits the budget."""
+        async with self.lock:
+            while True:
+                self._refill()
+                needed = [1, tokens]
+                wait = 0.0
+                for index, capacity in enumerate(self.capacities):
+                    if not capacity:
+                        continue
+                    # a request larger than the whole budget waits for a full bucket
+                    need = min(needed[index], capacity)
+                    if self.available[index] < need:
+                        wait = max(wait, (need - self.available[index]) * 60 / capacity)
+                if wait == 0:
+                    for index, capacity in enumerate(self.capacities):
+                        if capacity:
+                            self.available[index] -= needed[index]
+                    return
+                await asyncio.sleep(wait)
+
+
+class Backoff:
+    """A pause shared by all requests after rate limit errors.
+       The pause doubles on every error and halves on every success.
+
+    Args:
+        initial (float, optional): First pause in seconds. Defaults to 1.0.
+        maximum (float, optional): Longest pause in seconds. Defaults to 60.0.
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self.resume_at = 0.0
+
+    def failed(self) -> None:
+        self.delay = min(self.maximum, self.delay * 2 or self.initial)
+        pause = self.delay * (1 + random.random() / 10)
+        self.resume_at = max(self.resume_at, time.monotonic() + pause)
+
+    def succeeded(self) -> None:
+        self.delay /= 2
+        if self.delay < self.initial:
+            self.delay = 0.0
+
+    async def wait(self) -> None:
+        pause = self.resume_at - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+
+class OrderedWriter:
+    """Collect results that finish in any order and write them in input order."""
+
+    def __init__(self, write: Callable[[Text], None]):
+        self.write = write
+        self.pending = {}
+        self.next_index = 0
+
+    def put(self, index: int, text: Text) -> None:
+        self.pending[index] = text
+        while self.next_index in self.pending:
+            self.write(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+
+async def request_completion(
+    prompt: Text,
+    params: Dict[str, Any],
+    limiter: RateLimiter,
+    backoff: Backoff,
+    stats: Dict[str, int],
+    count_tokens: Callable[[Text], int],
+    max_retries: int,
+    cache: Optional[ResponseCache] = None,
+    template: Text = "",
+) -> Text:
+    """Send one completion request, retrying with backoff on rate limit errors."""
+    cache_key = None
+    if cache is not None:
+        cache_key = ResponseCache.key(params["engine"], template, prompt, params)
+        response = cache.get(cache_key)
+        if response is not None:
+            return response["choices"][0]["text"]
+    tokens = count_tokens(prompt) + params.get("max_tokens", 0)
+    for attempt in range(max_retries + 1):
+        await backoff.wait()
+        await limiter.acquire(tokens)
+        try:
+            response = await openai.Completion.acreate(prompt=prompt, **params)
+        except RETRY_ERRORS as error:
+            stats["retries"] += 1
+            if isinstance(error, openai.error.RateLimitError):
+                stats["rate_limited"] += 1
+            if attempt == max_retries:
+                raise
+            logger.warning("completion request failed (%s), backing off", error)
+            backoff.failed()
+            continue
+        backoff.succeeded()
+        stats["requests"] += 1
+        if cache_key is not None:
+            cache.put(cache_key, response)
+        return response["choices"][0]["text"]
+
+
+async def _complete_in_order(
+    prompts: Iterable[Text],
+    params: Dict[str, Any],
+    write_response: Callable[[Text], None],
+    max_in_flight: int,
+    requests_per_minute: int,
+    tokens_per_minute: int,
+    count_tokens: Callable[[Text], int],
+    max_retries: int,
+    cache: Optional[ResponseCache],
+    template: Text,
+) -> Dict[str, int]:
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    backoff = Backoff()
+    writer = OrderedWriter(write_response)
+    stats = {"requests": 0, "retries": 0, "rate_limited": 0}
+    # all workers pull from the same iterator, so at most max_in_flight prompts are built ahead
+    indexed_prompts = enumerate(prompts)
+
+    async def worker():
+        for index, prompt in indexed_prompts:
+            text = await request_completion(
+                prompt,
+                params,
+                limiter,
+                backoff,
+                stats,
+                count_tokens,
+                max_retries,
+                cache=cache,
+                template=template,
+            )
+            writer.put(index, text)
+
+    async with aiohttp.ClientSession() as session:
+        openai.aiosession.set(session)
+        try:
+            await asyncio.gather(*[worker() for _ in range(max_in_flight)])
+        finally:
+            openai.aiosession.set(None)
+    return stats
+
+
+def complete_in_order(
+    prompts: Iterable[Text],
+    params: Dict[str, Any],
+    write_response: Callable[[Text], None],
+    max_in_flight: int = 8,
+    requests_per_minute: int = 0,
+    tokens_per_minute: int = 0,
+    count_tokens: Optional[Callable[[Text], int]] = None,
+    max_retries: int = 8,
+    cache: Optional[ResponseCache] = None,
+    template: Text = "",
+) -> Dict[str, int]:
+    """Run completion requests concurrently and write the results in input order.
+
+    Args:
+        prompts (Iterable[Text]): The prompts to complete.
+        params (Dict[str, Any]): Arguments of the completion request besides the prompt.
+        write_response (Callable[[Text], None]): Called with each completion, in input order.
+        max_in_flight (int, optional): Number of requests in flight. Defaults to 8.
+        requests_per_minute (int, optional): Request budget, 0 for no limit. Defaults to 0.
+        tokens_per_minute (int, optional): Token budget, 0 for no limit. Defaults to 0.
+        count_tokens (Optional[Callable[[Text], int]], optional): Count the tokens of a
+            prompt for the token budget. Defaults to a word count.
+        max_retries (int, optional): Retries of a request before giving up. Defaults to 8.
+        cache (Optional[ResponseCache], optional): Cache to look up responses in before
+            sending a request. Defaults to None.
+        template (Text, optional): The template of the prompts, part of the cache key.
+            Defaults to "".
+
+    Returns:
+        Dict[str, int]: Number of finished requests, retries and rate limit errors.
+    """
+    if count_tokens is None:
+        count_tokens = lambda prompt: len(prompt.split())
+    return asyncio.run(
+        _complete_in_order(
+            prompts,
+            params,
+            write_response,
+            max_in_flight,
+            requests_per_minute,
+            tokens_per_minute,
+            count_tokens,
+            max_retries,
+            cache,
+            template,
+        )
+    )
@@ -1,9 +1,11 @@
 import json
 import argparse
+import os
+from contextlib import ExitStack
 from xmlrpc.client import boolean
 
-from prompting import read_source_data
-from typing import Dict, List, Text
+from prompting import iter_source_data
+from typing import Dict, Iterable, Iterator, List, Optional, Text, Tuple
 
 source_data_path = r"./data/ESConv_one_speaker_one_turn.json"
 batch_data_path = r"./data/experiments/3B/gpt/train_response_b0_14.jsonl"
@@ -11,21 +13,28 @@ parlai_format_path = r"./data/experiments/3B/gpt/train_parlai_b0_14.txt"
 
 
 def read_batch_data(batch_data_path: Text) -> List[Dict[str, str]]:
-    batch_data_file = open(batch_data_path, "r", encoding="utf-8")
     batch_data = []
-    for row in batch_data_file:
-        batch_data.append(json.loads(row))
+    with open(batch_data_path, "r", encoding="utf-8") as batch_data_file:
+        for row in batch_data_file:
+            batch_data.append(json.loads(row))
 
     return batch_data
 
 
-def parlai_format_from_batch(
-    batch_data: List[Dict[str, str]],
-    source_data: List[Dict[str, str]],
-    out_path: Text,
-    with_annotation: boolean = True,
-):
-    output_file = open(out_path, "w+", encoding="utf-8", newline="")
+def iter_parlai_turns(
+    source_data: Iterable[Dict[str, str]]
+) -> Iterator[Tuple[int, Text, Text, bool]]:
+    """Walk the dialogues once and yield every supporter reply with its context.
+
+    Args:
+        source_data (Iterable[Dict[str, str]]): The dialogues, a list or a stream from
+            iter_source_data.
+
+    Returns:
+        Iterator[Tuple[int, Text, Text, bool]]: The index of the seeker turn, whose
+            annotation goes with the text, the text, the label and whether the turn
+            ends the episode.
+    """
     tmp = ""
     total_seeker_utterance_index = 0
     for dialog in source_data:
@@ -37,35 +46,122 @@ def parlai_format_from_batch(
             ).decode("utf-8")
             start = 1
         for index in range(start, len(dialog["conversation"]) - 1, 2):
-            if total_seeker_utterance_index >= len(batch_data):
-                return
-
             text = tmp + dialog["conversation"][index]["content"]
-            if with_annotation:
-                annotation = batch_data[total_seeker_utterance_index]["response"].split(
-                    "\n"
-                )[0]
-                # annotation = post_process_annotation(batch_data[total_seeker_utterance_index]["response"])
-                # print(annotation)
-                if annotation == "":
-                    annotation = "<empty annotation>"
-                text += " The seeker " + annotation
             label = dialog["conversation"][index + 1]["content"]
             tmp = ""
+            episode_done = index >= len(dialog["conversation"]) - 3
+            yield total_seeker_utterance_index, text, label, episode_done
             total_seeker_utterance_index += 1
-            if index >= len(dialog["conversation"]) - 3:
-                output_file.write(
-                    f"text:{text}"
-                    + "\t"
-                    + f"labels:{label}"
-                    + "\t"
-                    + "episode_done:True\n"
-                )
-                if index == len(dialog["conversation"]) - 3:
-                    total_seeker_utterance_index += 1
-            else:
-                if "<empty annotation>" not in text:
-                    output_file.write(f"text:{text}" + "\t" + f"labels:{label}" + "\n")
+            if index == len(dialog["conversation"]) - 3:
+                total_seeker_utterance_index += 1
+
+
+def parlai_line(
+    text: Text, label: Text, episode_done: bool, annotation: Optional[Text] = None
+) -> Text:
+    """Format a turn as a ParlAI line, "" for a turn left out.
+
+    Args:
+        annotation (Optional[Text], optional): The reasoning response of the seeker turn,
+            None for data without annotation. Defaults to None.
+    """
+    if annotation is not None:
+        annotation = annotation.split("\n")[0]
+        # annotation = post_process_annotation(annotation)
+        # print(annotation)
+        if annotation == "":
+            annotation = "<empty annotation>"
+        text += " The seeker " + annotation
+    if episode_done:
+        return f"text:{text}" + "\t" + f"labels:{label}" + "\t" + "episode_done:True\n"
+    if "<empty annotation>" not in text:
+        return f"text:{text}" + "\t" + f"labels:{label}" + "\n"
+    return ""
+
+
+def parlai_format_from_batch(
+    batch_data: List[Dict[str, str]],
+    source_data: Iterable[Dict[str, str]],
+    out_path: Text,
+    with_annotation: boolean = True,
+):
+    with open(out_path, "w+", encoding="utf-8", newline="") as output_file:
+        for seeker_index, text, label, episode_done in iter_parlai_turns(source_data):
+            if seeker_index >= len(batch_data):
+                return
+            annotation = batch_data[seeker_index]["response"] if with_annotation else None
+            output_file.write(parlai_line(text, label, episode_done, annotation))
+
+
+class ResponseReader:
+    """Read the responses of a response jsonl file one seeker turn after the other.
+
+    Args:
+        batch_data_path (Text): Path to the responses.
+    """
+
+    def __init__(self, batch_data_path: Text):
+        self.file = open(batch_data_path, "r", encoding="utf-8")
+        self.index = -1
+        self.response = None
+
+    def get(self, seeker_index: int) -> Optional[Text]:
+        """Get the response of a seeker turn, None when the file ends before it."""
+        while self.index < seeker_index:
+            row = self.file.readline()
+            if not row:
+                return None
+            self.index += 1
+            self.response = json.loads(row)["response"]
+        return self.response
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def parlai_format_from_experts(
+    batch_data_paths: Dict[Text, Text],
+    source_data: Iterable[Dict[str, str]],
+    out_paths: Dict[Text, Text],
+    baseline_path: Optional[Text] = None,
+):
+    """Write the ParlAI data of several experts in one pass over the dialogues, the same
+       as parlai_format_from_batch writes them one expert at a time.
+
+    Args:
+        batch_data_paths (Dict[Text, Text]): The response file of every expert.
+        source_data (Iterable[Dict[str, str]]): The dialogues, a list or a stream from
+            iter_source_data.
+        out_paths (Dict[Text, Text]): The ParlAI file of every expert.
+        baseline_path (Optional[Text], optional): A ParlAI file to write the data without
+            reasoning to, as long as the longest response file. Defaults to None.
+    """
+    with ExitStack() as stack:
+        readers = {}
+        outputs = {}
+        for expert, batch_data_path in batch_data_paths.items():
+            readers[expert] = ResponseReader(batch_data_path)
+            stack.callback(readers[expert].close)
+            outputs[expert] = stack.enter_context(
+                open(out_paths[expert], "w+", encoding="utf-8", newline="")
+            )
+        baseline_file = None
+        if baseline_path:
+            baseline_file = stack.enter_context(
+                open(baseline_path, "w+", encoding="utf-8", newline="")
+            )
+        for seeker_index, text, label, episode_done in iter_parlai_turns(source_data):
+            for expert in list(readers):
+                annotation = readers[expert].get(seeker_index)
+                if annotation is None:
+                    # the responses of this expert ended, as in parlai_format_from_batch
+                    del readers[expert]
+                    continue
+                outputs[expert].write(parlai_line(text, label, episode_done, annotation))
+            if not readers:
+                break
+            if baseline_file is not None:
+                baseline_file.write(parlai_line(text, label, episode_done))
 
 
 def post_process_annotation(annotation: Text):
@@ -90,15 +186,48 @@ def add_arguments():
         help="Original ESConv data path",
     )
     parser.add_argument(
-        "--batch_data_path", type=str, required=True, help="Resposnes from PLMs."
+        "--batch_data_path", type=str, default="", help="Resposnes from PLMs."
     )
     parser.add_argument(
-        "--parlai_format_path", type=str, required=True, help="Output parlai file path."
+        "--parlai_format_path", type=str, default="", help="Output parlai file path."
     )
     parser.add_argument(
         "--annotation", type=bool, default=True, help="Generate data with annotation."
     )
+    parser.add_argument(
+        "--experts",
+        type=str,
+        default="",
+        help="Comma separated experts to build at once instead, e.g. gpt_1,gpt_2,new_gpt_2,ada,davinci,gpt_j",
+    )
+    parser.add_argument(
+        "--experiment_dir",
+        type=str,
+        default="./data/experiments/bbmhr/3B",
+        help="Directory with a sub directory of responses per expert.",
+    )
+    parser.add_argument(
+        "--response_name",
+        type=str,
+        default="train_response_b0_14.jsonl",
+        help="Response file name in the directory of every expert.",
+    )
+    parser.add_argument(
+        "--parlai_name",
+        type=str,
+        default="train_parlai_b0_14.txt",
+        help="Output parlai file name in the directory of every expert.",
+    )
+    parser.add_argument(
+        "--baseline_path",
+        type=str,
+        default=None,
+        help="Output parlai file without reasoning, no_reasoning/<parlai_name> in the "
+        "experiment dir by default, empty for none.",
+    )
     args = parser.parse_args()
+    if not args.experts and not (args.batch_data_path and args.parlai_format_path):
+        parser.error("either --experts or --batch_data_path and --parlai_format_path are required")
     return args
 
 
@@ -107,7 +236,21 @@ def main():
     args = add_arguments()
 
     # load data
-    source_data = read_source_data(args.source_data_path)
+    source_data = iter_source_data(args.source_data_path)
+    if args.experts:
+        experts = args.experts.split(",")
+        baseline_path = args.baseline_path
+        if baseline_path is None:
+            baseline_path = os.path.join(args.experiment_dir, "no_reasoning", args.parlai_name)
+        if baseline_path:
+            os.makedirs(os.path.dirname(baseline_path) or ".", exist_ok=True)
+        parlai_format_from_experts(
+            {e: os.path.join(args.experiment_dir, e, args.response_name) for e in experts},
+            source_data,
+            {e: os.path.join(args.experiment_dir, e, args.parlai_name) for e in experts},
+            baseline_path,
+        )
+        return
     batch_data = read_batch_data(args.batch_data_path)
 
     # generate parlai format file
@@ -0,0 +1,261 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Callable, FrozenSet, List, Optional, Text, Tuple, Union
+
+from bbmhr.pipeline.model_pool import model_pool
+from bbmhr.pipeline.prompting import MODEL_DTYPES, DialogueHistory, batch_inference
+
+logger = logging.getLogger(__name__)
+
+Expert = Callable[[List[Union[Text, DialogueHistory]]], List[Text]]
+
+
+def recent_words(history: Union[Text, DialogueHistory], lines: int = 2) -> FrozenSet[Text]:
+    """Lower-cased words of the last lines of a conversation, without the speakers."""
+    history_lines = history.lines if isinstance(history, DialogueHistory) else history.split("\n")
+    text = " ".join(line.split(": ", 1)[-1] for line in history_lines[-lines:])
+    return frozenset(re.findall(r"[a-z']+", text.lower()))
+
+
+class ReasoningMemory:
+    """The latest reasoning of the expert, looked up by the words of the end of the
+       conversation it was given for.
+
+    Args:
+        size (int, optional): Number of reasonings to keep. Defaults to 1000.
+        similarity (float, optional): Smallest Jaccard similarity of the words of two
+            conversations to reuse a reasoning. Defaults to 0.5.
+    """
+
+    def __init__(self, size: int = 1000, similarity: float = 0.5):
+        self.size = size
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, words: FrozenSet[Text], reasoning: Text) -> None:
+        if not words or not reasoning:
+            return
+        with self.lock:
+            self.entries[words] = reasoning
+            self.entries.move_to_end(words)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get(self, words: FrozenSet[Text]) -> Optional[Text]:
+        """Get the reasoning of the most similar conversation, None if none is similar enough."""
+        best, best_similarity = None, self.similarity
+        with self.lock:
+            for stored, reasoning in self.entries.items():
+                similarity = len(words & stored) / max(1, len(words | stored))
+                if similarity >= best_similarity:
+                    best, best_similarity = reasoning, similarity
+        return best
+
+
+class LatencyBudget:
+    """Get the reasoning of the expert within a time budget per turn.
+       When the expert misses the budget or fails, the reasoning falls back in a fixed
+       order to the reasoning of a similar conversation, to a smaller expert, and to
+       no reasoning. A late expert call keeps running and its reasoning is remembered
+       for later similar conversations. While it runs, the expert is not asked again,
+       so that new calls do not queue up behind it and miss their budget as well.
+
+    Args:
+        budget (float): Seconds to wait for the expert.
+        fallback_expert (Optional[Expert], optional): A faster expert to ask when the
+            expert misses the budget. Defaults to None.
+        fallback_budget (float, optional): Seconds to wait for the fallback expert.
+            Defaults to 1.
+        similarity (float, optional): Smallest similarity to reuse the reasoning of
+            another conversation, see ReasoningMemory. Defaults to 0.5.
+    """
+
+    sources = ["expert", "similar_history", "fallback_expert", "none"]
+
+    def __init__(
+        self,
+        budget: float,
+        fallback_expert: Optional[Expert] = None,
+        fallback_budget: float = 1.0,
+        similarity: float = 0.5,
+    ):
+        self.budget = budget
+        self.fallback_expert = fallback_expert
+        self.fallback_budget = fallback_budget
+        self.memory = ReasoningMemory(similarity=similarity)
+        # the fallback expert has its own workers, a late expert never holds it up
+        self.executor = ThreadPoolExecutor(4)
+        self.fallback_executor = ThreadPoolExecutor(2)
+        self.late = {"expert": set(), "fallback_expert": set()}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def _call(
+        self, source: Text, executor: ThreadPoolExecutor, expert: Expert, histories, timeout: float
+    ):
+        """Call an expert and wait at most timeout seconds for it.
+
+        Returns:
+            Tuple[Optional[Future], Optional[List[Text]]]: The call, None when the expert
+                is still busy with a late call, and its reasoning, None when it missed
+                the timeout or failed.
+        """
+        with self.lock:
+            if self.late[source]:
+                logger.warning("%s is still busy with a late call, not asked", source)
+                return None, None
+        future = executor.submit(expert, histories)
+        try:
+            return future, future.result(timeout=timeout)
+        except TimeoutError:
+            logger.warning(
+                "%s reasoning of %s conversations missed the %.2fs budget",
+                source,
+                len(histories),
+                timeout,
+            )
+        except Exception:
+            logger.exception("%s reasoning of %s conversations failed", source, len(histories))
+            return future, None
+        # a call that has not started yet is dropped, a running one is waited out
+        if not future.cancel():
+            with self.lock:
+                self.late[source].add(future)
+            future.add_done_callback(lambda done: self._finish_late(source, done))
+        return future, None
+
+    def _finish_late(self, source: Text, future) -> None:
+        with self.lock:
+            self.late[source].discard(future)
+
+    def reasoning(
+        self, expert: Expert, histories: List[Union[Text, DialogueHistory]]
+    ) -> List[Text]:
+        """Get the reasoning of every conversation, within the budget.
+
+        Args:
+            expert (Expert): Gets the reasoning of a list of conversations.
+            histories (List[Union[Text, DialogueHistory]]): The conversations.
+
+        Returns:
+            List[Text]: The reasoning of every conversation, "" where none was found.
+        """
+        # the conversations go on while a late expert call still runs
+        histories = [
+            history.copy() if isinstance(history, DialogueHistory) else history
+            for history in histories
+        ]
+        words = [recent_words(history) for history in histories]
+        start = time.perf_counter()
+
+        future, responses = self._call("expert", self.executor, expert, histories, self.budget)
+        if future is not None:
+            future.add_done_callback(lambda done: self._remember(done, words))
+        if responses is not None:
+            self._count("expert", len(histories))
+            return responses
+
+        responses = [self.memory.get(conversation_words) for conversation_words in words]
+        missing = [index for index, response in enumerate(responses) if response is None]
+        self._count("similar_history", len(histories) - len(missing))
+        if missing and self.fallback_expert is not None:
+            _, fallback_responses = self._call(
+                "fallback_expert",
+                self.fallback_executor,
+                self.fallback_expert,
+                [histories[index] for index in missing],
+                self.fallback_budget,
+            )
+            for index, response in zip(missing, fallback_responses or []):
+                responses[index] = response
+            fallen_back = [index for index in missing if responses[index] is not None]
+            self._count("fallback_expert", len(fallen_back))
+            missing = [index for index in missing if responses[index] is None]
+        self._count("none", len(missing))
+        for index in missing:
+            responses[index] = ""
+        logger.info("reasoning fell back after %.2fs", time.perf_counter() - start)
+        return responses
+
+    def _remember(self, future, words: List[FrozenSet[Text]]) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        for conversation_words, response in zip(words, future.result()):
+            self.memory.put(conversation_words, response)
+
+    def _count(self, source: Text, number: int) -> None:
+        if not number:
+            return
+        with self.lock:
+            self.counts[source] += number
+        if source != "expert":
+            logger.info("%s conversations fell back to %s", number, source)
+
+    def summary(self) -> Text:
+        """How often the reasoning came from every source, e.g. for the end of a run."""
+        with self.lock:
+            counts = Counter(self.counts)
+        total = sum(counts.values())
+        return ", ".join(
+            f"{source} {counts[source]} ({counts[source] / max(1, total):.0%})"
+            for source in self.sources
+        )
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.fallback_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def pooled_expert(
+    model_name: Text, prompt_path: Text, dtype=None
+) -> Tuple[Expert, Callable[[], None]]:
+    """Make an expert from a pooled reasoning model, loaded now so that its first
+       answer is not held up by loading.
+
+    Returns:
+        Tuple[Expert, Callable[[], None]]: The expert, and a function that releases
+            its model.
+    """
+    model, tokenizer = model_pool.acquire(model_name, dtype)
+
+    def expert(histories: List[Union[Text, DialogueHistory]]) -> List[Text]:
+        return batch_inference(model_name, model, tokenizer, prompt_path, histories)
+
+    return expert, lambda: model_pool.release(model_name, dtype)
+
+
+def make_latency_budget(opt) -> Tuple[Optional[LatencyBudget], Optional[Callable[[], None]]]:
+    """Make the latency budget of the reasoning_budget options of a world or an agent.
+
+    Returns:
+        Tuple[Optional[LatencyBudget], Optional[Callable[[], None]]]: The budget, None
+            without a budget, and a function that shuts it down and releases its
+            fallback expert.
+    """
+    if not opt.get("reasoning_budget"):
+        return None, None
+    fallback_expert, release_fallback = None, None
+    if opt.get("fallback_reasoning_model_name"):
+        fallback_expert, release_fallback = pooled_expert(
+            opt["fallback_reasoning_model_name"],
+            opt.get("prompt_path"),
+            MODEL_DTYPES[opt.get("reasoning_dtype") or "float32"],
+        )
+    budget = LatencyBudget(
+        opt["reasoning_budget"],
+        fallback_expert,
+        fallback_budget=opt.get("fallback_reasoning_budget") or 1.0,
+    )
+
+    def release() -> None:
+        logger.info("reasoning sources: %s", budget.summary())
+        budget.shutdown()
+        if release_fallback is not None:
+            release_fallback()
+
+    return budget, release
@@ -0,0 +1,89 @@
+import gc
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Text, Tuple
+
+import torch
+
+from bbmhr.pipeline.prompting import load_large_model
+
+logger = logging.getLogger(__name__)
+
+
+class ModelPool:
+    """Reference-counted pool of reasoning models, so that one process keeps a single
+       copy of every expert however many worlds, agents and clones use it.
+
+    Args:
+        loader (Callable, optional): Loads the model and tokenizer of a model name.
+            Defaults to load_large_model.
+    """
+
+    def __init__(self, loader: Callable[..., Tuple[Any, Any]] = load_large_model):
+        self.loader = loader
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name: Text, dtype: Optional[torch.dtype] = None) -> Tuple[Text, Text]:
+        return model_name, str(dtype) if dtype is not None else "default"
+
+    def acquire(
+        self, model_name: Text, dtype: Optional[torch.dtype] = None, **load_options
+    ) -> Tuple[Any, Any]:
+        """Get the model and tokenizer, loading them on first use.
+
+        Args:
+            model_name (Text): The reasoning model name, as for load_large_model.
+            dtype (Optional[torch.dtype], optional): Type of the model weights, None for
+                float32. Defaults to None.
+            load_options: Further options of the loader on first use, e.g. low_memory.
+
+        Returns:
+            Tuple[Any, Any]: The shared model and tokenizer.
+        """
+        key = self.key(model_name, dtype)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                model, tokenizer = self.loader(model_name, dtype=dtype, **load_options)
+                entry = {"model": model, "tokenizer": tokenizer, "references": 0}
+                self.entries[key] = entry
+            else:
+                logger.info("reusing pooled model %s (%s)", *key)
+            entry["references"] += 1
+            return entry["model"], entry["tokenizer"]
+
+    def retain(self, model_name: Text, dtype: Optional[torch.dtype] = None) -> None:
+        """Add a reference to a pooled model that the caller already holds, e.g. one
+           shared by the world it was copied from, without loading anything."""
+        key = self.key(model_name, dtype)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                raise KeyError(f"model {model_name} ({key[1]}) is not in the pool")
+            entry["references"] += 1
+
+    def release(self, model_name: Text, dtype: Optional[torch.dtype] = None) -> None:
+        """Drop one reference, and free the model once nothing uses it any more."""
+        key = self.key(model_name, dtype)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry["references"] -= 1
+            if entry["references"] > 0:
+                return
+            del self.entries[key]
+        logger.info("freeing pooled model %s (%s)", *key)
+        del entry
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def references(self) -> Dict[Tuple[Text, Text], int]:
+        with self.lock:
+            return {key: entry["references"] for key, entry in self.entries.items()}
+
+
+model_pool = ModelPool()
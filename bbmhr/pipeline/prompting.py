@@ -1,15 +1,36 @@
 import argparse
+import bisect
+import copy
+import io
 import json
 import random
+import re
 import logging
+import resource
+import threading
+import time
+import weakref
 import openai
 import os
-from typing import Any, Dict, List, Optional, Text, TextIO
+import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Text, TextIO, Tuple, Union
 
 from datetime import date
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import LogitsProcessor, LogitsProcessorList
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers.pytorch_utils import Conv1D
 from transformers import OpenAIGPTTokenizer, OpenAIGPTLMHeadModel
 
+from bbmhr.pipeline.async_completion import complete_in_order
+from bbmhr.pipeline.reasoning_client import ReasoningClient
+from bbmhr.pipeline.response_cache import ResponseCache
+from bbmhr.pipeline.retrieval_expert import HashingEncoder, is_retrieval_model, load_retrieval_expert
+
 Log_Format = "%(levelname)s %(asctime)s - %(message)s"
 
 GPT_3_log_path = os.path.join("./log", date.today().strftime("%Y%m%d") + ".log")
@@ -31,6 +52,14 @@ test_data_path = r"./data/ESConv_test_data.json"
 response_path = r"./data/NL_response"
 seeker_utterances_only = r"./data/seeker_only"
 
+response_cache = None
+
+
+def set_response_cache(cache: Optional[ResponseCache]) -> None:
+    """Put a response cache in front of all expert calls, None to disable it."""
+    global response_cache
+    response_cache = cache
+
 
 def read_prompt(prompt_path: Text) -> Text:
     """Read a prompt template from text file.
@@ -45,12 +74,111 @@ def read_prompt(prompt_path: Text) -> Text:
     return template_file.read()
 
 
+class PromptTemplate:
+    """A prompt template parsed once, with its token length cached per tokenizer.
+
+    Args:
+        text (Text): The template text with <conversation> placeholders.
+        mtime (int, optional): Modification time of the template file. Defaults to 0.
+    """
+
+    placeholder = "<conversation>"
+
+    def __init__(self, text: Text, mtime: int = 0):
+        self.text = text
+        self.mtime = mtime
+        self.parts = text.split(self.placeholder)
+        self.prefix = self.parts[0]
+        self.token_lengths = {}
+
+    def token_length(self, tokenizer) -> int:
+        """Number of tokens of the template text for the given tokenizer."""
+        key = getattr(tokenizer, "name_or_path", "") or id(tokenizer)
+        if key not in self.token_lengths:
+            self.token_lengths[key] = len(tokenizer(self.text)["input_ids"])
+        return self.token_lengths[key]
+
+    def fill(self, conversation: Text) -> Text:
+        """Replace the placeholders with the conversation."""
+        return conversation.join(self.parts)
+
+    def fill_utterances(self, utterances: List[Text]) -> Text:
+        """Replace the placeholders with the concatenated utterances in one join.
+
+        Args:
+            utterances (List[Text]): The formatted utterances of the conversation.
+
+        Returns:
+            Text: The filled template, the same as fill("".join(utterances)).
+        """
+        if len(self.parts) != 2:
+            return self.fill("".join(utterances))
+        # borrow the list for the join instead of building a new one per prompt
+        utterances.insert(0, self.parts[0])
+        utterances.append(self.parts[1])
+        try:
+            return "".join(utterances)
+        finally:
+            utterances.pop()
+            utterances.pop(0)
+
+
+prompt_templates = {}
+
+
+def get_prompt_template(prompt_path: Text) -> PromptTemplate:
+    """Get a prompt template from the process-wide registry.
+       The template is read on first use and read again when the file changes.
+
+    Args:
+        prompt_path (Text): Path to the prompt template file.
+
+    Returns:
+        PromptTemplate: The parsed template.
+    """
+    mtime = os.stat(prompt_path).st_mtime_ns
+    template = prompt_templates.get(prompt_path)
+    if template is None or template.mtime != mtime:
+        template = PromptTemplate(read_prompt(prompt_path), mtime)
+        prompt_templates[prompt_path] = template
+    return template
+
+
+def completion_params(
+    model_type: Text, stop_words: Optional[List[Text]] = []
+) -> Dict[str, Any]:
+    """Get the arguments of a completion request for the given gpt-3 model.
+
+    Args:
+        model_type (Text): The gpt-3 model type, e.g. "ada" or "davinci".
+        stop_words (Optional[List[Text]], optional): stops to break the generation.
+
+    Returns:
+        Dict[str, Any]: Keyword arguments for openai.Completion.create.
+    """
+    model_name = "text-" + model_type + "-001"
+    max_length = 80
+    if model_type == 'davinci':
+        model_name = "text-" + model_type + "-002"
+        max_length = 120
+    return {
+        "engine": model_name,
+        "temperature": 0.7,
+        "max_tokens": max_length,
+        "top_p": 1,
+        "frequency_penalty": 0,
+        "presence_penalty": 0,
+        "stop": stop_words,
+    }
+
+
 def get_gpt_result(
     task: Text,
     gpt_prompt: Optional[Text] = "",
     query: Optional[Text] = "",
     stop_words: Optional[List[Text]] = [],
-    model_type: Optional[Text] = "ada"
+    model_type: Optional[Text] = "ada",
+    template: Text = "",
 ) -> Dict:
     """Get response from the gpt by prompt.
 
@@ -59,6 +187,7 @@ def get_gpt_result(
         gpt_prompt (Optional[Text], optional): The prompt text. Defaults to "".
         query (Optional[Text], optional): classification task only. Defaults to "".
         stope_words (Optional[List[Text]], optional): stops to break the generation and prepare for next quest.
+        template (Text, optional): The template of the prompt, part of the cache key. Defaults to "".
 
     Returns:
         Dict: the result dict
@@ -69,22 +198,18 @@ def get_gpt_result(
         if not gpt_prompt:
             print("need to provide prompt")
         else:
-            model_name = model_name = "text-" + model_type + "-001"
-            max_length = 80
             if model_type == 'davinci':
                 logger.info("GPT-3 type: %s", model_type)
-                model_name = "text-" + model_type + "-002"
-                max_length = 120
-            response = openai.Completion.create(
-                engine=model_name,
-                prompt=gpt_prompt,
-                temperature=0.7,
-                max_tokens=max_length,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=stop_words,
-            )
+            params = completion_params(model_type, stop_words)
+            cache_key = None
+            if response_cache is not None:
+                cache_key = ResponseCache.key(params["engine"], template, gpt_prompt, params)
+                response = response_cache.get(cache_key)
+                if response is not None:
+                    return response
+            response = openai.Completion.create(prompt=gpt_prompt, **params)
+            if cache_key is not None:
+                response_cache.put(cache_key, response)
     elif task == GPT_3_TASK_CLASSIFICATION:
         if not query:
             print("need to provide query")
@@ -114,6 +239,45 @@ def get_gpt_result(
     return response
 
 
+def stream_gpt_completion(
+    gpt_prompt: Text,
+    on_text: Callable[[Text], None],
+    stop_words: Optional[List[Text]] = [],
+    model_type: Optional[Text] = "ada",
+    template: Text = "",
+) -> Text:
+    """Get a completion from the gpt by prompt, handing every streamed piece to on_text.
+
+    Args:
+        gpt_prompt (Text): The prompt text.
+        on_text (Callable[[Text], None]): Called with every piece of the completion.
+        stop_words (Optional[List[Text]], optional): stops to break the generation.
+        model_type (Optional[Text], optional): The gpt-3 model type. Defaults to "ada".
+        template (Text, optional): The template of the prompt, part of the cache key. Defaults to "".
+
+    Returns:
+        Text: The text of the completion.
+    """
+    params = completion_params(model_type, stop_words)
+    cache_key = None
+    if response_cache is not None:
+        # shared with the completions of get_gpt_result
+        cache_key = ResponseCache.key(params["engine"], template, gpt_prompt, params)
+        response = response_cache.get(cache_key)
+        if response is not None:
+            on_text(response["choices"][0]["text"])
+            return response["choices"][0]["text"]
+    pieces = []
+    for event in openai.Completion.create(prompt=gpt_prompt, stream=True, **params):
+        piece = event["choices"][0]["text"]
+        pieces.append(piece)
+        on_text(piece)
+    text = "".join(pieces)
+    if cache_key is not None:
+        response_cache.put(cache_key, {"choices": [{"text": text}]})
+    return text
+
+
 def reformat_source_data(
     source_path: Text, reformat_source_path: Text
 ) -> Dict[str, str]:
@@ -155,6 +319,80 @@ def read_source_data(source_path: Text) -> List[Dict[str, str]]:
     return source_data
 
 
+def iter_source_data(
+    source_path: Text, start_index: int = 0, chunk_size: int = 1 << 16, offset: int = 0
+) -> Iterator[Dict[str, Any]]:
+    """Stream the dialogues of the ESConv source data one at a time.
+       Only the dialogue being parsed is kept in memory, so memory use does not
+       grow with the size of the source file.
+
+    Args:
+        source_path (Text): Path to the source data file, a json list of dialogues.
+        start_index (int, optional): Index of the first dialogue to yield. Defaults to 0.
+        chunk_size (int, optional): Number of characters read at a time. Defaults to 65536.
+        offset (int, optional): Byte offset of a dialogue in the file to start reading at,
+            see seeker_turn_index. Defaults to 0 for the beginning of the list.
+
+    Returns:
+        Iterator[Dict[str, Any]]: The dialogues in file order.
+    """
+    for dialog_index, (dialog, _) in enumerate(source_dialogs(source_path, chunk_size, offset)):
+        if dialog_index >= start_index:
+            yield dialog
+
+
+def source_dialogs(
+    source_path: Text, chunk_size: int = 1 << 16, offset: int = 0
+) -> Iterator[Tuple[Dict[str, Any], int]]:
+    """Stream the dialogues of the ESConv source data with the byte offset of each
+       in the file, see iter_source_data."""
+    decoder = json.JSONDecoder()
+    with open(source_path, "rb") as binary_file:
+        binary_file.seek(offset)
+        source_file = io.TextIOWrapper(binary_file, encoding="utf-8")
+        buffer = ""
+        position = 0
+        # byte offset of the start of the buffer, and of buffer[:scanned] within it
+        buffer_offset = offset
+        scanned, scanned_bytes = 0, 0
+        end_of_file = False
+        # a dialogue offset points into the list, after its "["
+        started = offset > 0
+        while True:
+            # skip whitespace and separators between the dialogues
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer):
+                if not started:
+                    if buffer[position] != "[":
+                        raise ValueError(f"{source_path} is not a json list")
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == "]":
+                    return
+                try:
+                    dialog, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # the dialogue continues in the next chunk
+                    if end_of_file:
+                        raise
+                else:
+                    scanned_bytes += len(buffer[scanned:position].encode("utf-8"))
+                    scanned = position
+                    yield dialog, buffer_offset + scanned_bytes
+                    position = end
+                    continue
+            elif end_of_file:
+                raise ValueError(f"{source_path} ended before the end of the json list")
+            chunk = source_file.read(chunk_size)
+            end_of_file = not chunk
+            buffer_offset += scanned_bytes + len(buffer[scanned:position].encode("utf-8"))
+            scanned, scanned_bytes = 0, 0
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
 def read_dialog_data(dialog_path: Text) -> List[Text]:
     """Read dialog directly from dialog style files.
 
@@ -171,156 +409,916 @@ def read_dialog_data(dialog_path: Text) -> List[Text]:
     return dialog_data
 
 
+def example_text(example: Dict[str, Any]) -> Text:
+    """The situation and conversation of an example, as compared with a target dialogue."""
+    lines = [example.get("situation", "")]
+    if "conversation" in example:
+        lines += [u["speaker"] + ": " + u["content"] for u in example["conversation"]]
+    else:
+        lines.append(example.get("dialog", ""))
+    return "\n".join(line for line in lines if line)
+
+
+class ExampleIndex:
+    """An index over a pool of examples, bucketed by their emotion and problem type, to
+       pick prompt examples of distinct types without scanning the pool.
+
+    Args:
+        test_data (List[Dict]): Pool of all data to choose examples from.
+    """
+
+    def __init__(self, test_data: List[Dict[str, Any]]):
+        self.test_data = test_data
+        self.buckets = {}
+        for index, example in enumerate(test_data):
+            key = (example["emotion_type"], example["problem_type"])
+            self.buckets.setdefault(key, []).append(index)
+        self.keys = list(self.buckets)
+        self.encoder = None
+        self.embeddings = None
+
+    def _embed(self) -> None:
+        # the embeddings are only needed for picking by similarity
+        self.encoder = HashingEncoder()
+        texts = [example_text(example) for example in self.test_data]
+        self.encoder.fit(texts)
+        self.embeddings = self.encoder.encode(texts)
+
+    def pick(
+        self, number: int, seed: Optional[int] = None, target: Optional[Text] = None
+    ) -> List[Dict[str, Any]]:
+        """Pick examples of distinct emotion and problem types.
+
+        Args:
+            number (int): The number of examples to choose.
+            seed (Optional[int], optional): Seed of the random choice, the global random
+                state when None. Defaults to None.
+            target (Optional[Text], optional): A dialogue to pick the most similar example
+                of every type for, instead of random ones. Defaults to None.
+
+        Returns:
+            List[Dict]: A list of data examples selected. Examples of types already
+                chosen fill up the list when the pool has fewer types than number.
+        """
+        rng = random if seed is None else random.Random(seed)
+        if target is None:
+            keys = rng.sample(self.keys, min(number, len(self.keys)))
+            indices = [rng.choice(self.buckets[key]) for key in keys]
+        else:
+            if self.embeddings is None:
+                self._embed()
+            scores = self.embeddings @ self.encoder.encode([target])[0]
+            best = [max(self.buckets[key], key=lambda index: scores[index]) for key in self.keys]
+            # most similar types first, ties in pool order
+            indices = sorted(best, key=lambda index: (-scores[index], index))[:number]
+        if len(indices) < number:
+            logger.warning(
+                "only %s emotion and problem types for %s examples", len(self.keys), number
+            )
+            chosen = set(indices)
+            rest = [index for index in range(len(self.test_data)) if index not in chosen]
+            indices += rng.sample(rest, min(number - len(indices), len(rest)))
+        return [self.test_data[index] for index in indices]
+
+
 def pick_up_examples(
-    test_data: List[Dict[str, str]], number: int
+    test_data: Union[List[Dict[str, str]], ExampleIndex],
+    number: int,
+    seed: Optional[int] = None,
+    target: Optional[Text] = None,
 ) -> List[Dict[str, str]]:
     """Randomly pick up certain number of examples as prompt instances.
 
     Args:
-        test_data (List[Dict]): Pool of all data to choose examples from.
+        test_data (Union[List[Dict], ExampleIndex]): Pool of all data to choose examples
+            from, or an ExampleIndex of it to reuse when picking several times.
         number (int): The number of examples to choose.
+        seed (Optional[int], optional): Seed of the random choice. Defaults to None.
+        target (Optional[Text], optional): A dialogue to pick similar examples for, see
+            ExampleIndex.pick. Defaults to None.
 
     Returns:
         List[Dict]: A list of data examples selected.
     """
-    examples = []
-    while len(examples) < number:
-        rand_index = random.randrange(len(test_data))
-        if len(examples) == 0:
-            examples.append(test_data[rand_index])
-        else:
-            selected = False
-            for example in examples:
-                if example["emotion_type"] == test_data[rand_index]["emotion_type"]:
-                    if example["problem_type"] == test_data[rand_index]["problem_type"]:
-                        selected = True
-                        break
-            if not selected:
-                examples.append(test_data[rand_index])
-    return examples
+    if not isinstance(test_data, ExampleIndex):
+        test_data = example_index(test_data)
+    return test_data.pick(number, seed=seed, target=target)
+
+
+example_indexes = {}
+
+
+def example_index(test_data: List[Dict[str, Any]]) -> ExampleIndex:
+    """Get the ExampleIndex of a pool, built on first use and reused for the same list."""
+    index = example_indexes.get(id(test_data))
+    if index is None or index.test_data is not test_data:
+        index = ExampleIndex(test_data)
+        example_indexes[id(test_data)] = index
+    return index
+
+
+def example_block(example: Dict[str, Any], turns: int = 4) -> Text:
+    """Format an example as a few-shot block of the nl templates, with the first turns
+       of its conversation and its emotion and problem type as the reasoning."""
+    lines = [u["speaker"] + ": " + u["content"] + "\n" for u in example["conversation"][:turns]]
+    return (
+        "Conversation:\n"
+        + "".join(lines)
+        + f"In this conversation, the seeker feels {example['emotion_type']}. "
+        + f"The reason is {example['problem_type']}.\n"
+    )
+
+
+def few_shot_template(template: PromptTemplate, examples: List[Dict[str, Any]]) -> PromptTemplate:
+    """Add examples to a template, after its own examples and before the conversation
+       to annotate.
+
+    Args:
+        template (PromptTemplate): The template to add the examples to.
+        examples (List[Dict]): The examples, e.g. picked with ExampleIndex.pick.
+
+    Returns:
+        PromptTemplate: A new template with a block per example.
+    """
+    text = template.text
+    position = text.find(template.placeholder)
+    header = text.rfind("Conversation:", 0, position)
+    if header != -1:
+        position = header
+    blocks = "".join(example_block(example) for example in examples)
+    return PromptTemplate(text[:position] + blocks + text[position:], template.mtime)
+
+
+def load_template(args) -> PromptTemplate:
+    """Get the prompt template of a run, with --example_number examples of the pool
+       added. The pool is indexed and the examples are picked once per run, so every
+       prompt of the run shares the template and its prefix cache."""
+    template = get_prompt_template(args.prompt_template)
+    if args.example_number > 0:
+        index = example_index(read_source_data(args.example_path))
+        examples = index.pick(args.example_number, seed=args.seed)
+        template = few_shot_template(template, examples)
+        logger.info("added %s examples to the prompt template", len(examples))
+    return template
+
+
+def seeker_turn_index(source_path: Text) -> List[Tuple[int, int]]:
+    """Precompute where the dialogue of every seeker turn starts, in one pass over the
+       source data, so that seek_seeker_turn finds a turn without reading the
+       dialogues before it.
+
+    Args:
+        source_path (Text): Path to the source data file.
+
+    Returns:
+        List[Tuple[int, int]]: (byte offset, number of earlier seeker turns) of every
+            dialogue, in file order.
+    """
+    index = []
+    seeker_turns = 0
+    for data, offset in source_dialogs(source_path):
+        index.append((offset, seeker_turns))
+        seeker_turns += sum(1 for utterance in data["conversation"] if utterance["speaker"] == "seeker")
+    return index
+
+
+def seek_seeker_turn(
+    source_path: Text, start_index: int, index: List[Tuple[int, int]]
+) -> Tuple[Iterator[Dict[Text, Any]], int]:
+    """Stream the source data from the dialogue of a seeker turn on. The dialogue is
+       looked up in the index and read from its byte offset, the dialogues before it
+       are never read.
+
+    Args:
+        source_path (Text): Path to the source data file.
+        start_index (int): Index of the seeker turn over all dialogues.
+        index (List[Tuple[int, int]]): The seeker_turn_index of the source data.
+
+    Returns:
+        Tuple[Iterator[Dict[str, Any]], int]: The dialogues from the one with the seeker
+            turn on, and the index of the seeker turn within them.
+    """
+    # the last dialogue that starts at or before the turn holds it, unless all of the
+    # turns come before it
+    dialog_index = bisect.bisect_right([earlier for _, earlier in index], start_index) - 1
+    if dialog_index < 0:
+        return iter(()), 0
+    offset, earlier = index[dialog_index]
+    return iter_source_data(source_path, offset=offset), start_index - earlier
 
 
 def assembly_prompt(
-    prompt: Text,
-    source_data: List[Dict[Text, Any]],
+    prompt: Union[Text, PromptTemplate],
+    source_data: Iterable[Dict[Text, Any]],
     seeker_only_file: Optional[TextIO] = None,
+    start_index: int = 0,
 ) -> str:
     """Assembly the final prompt with the given template and the source data.
        The method yield one prompt at a time. Each time, a user turn with previous
        dialogue history will be assigned as question of current prompt.
     Args:
-        template (Text): A template with main factors representated by tokens with <>.
+        prompt (Union[Text, PromptTemplate]): A template with main factors representated
+            by tokens with <>, or the parsed template.
         seeker_only_file (Optional[TextIO]): The file IO stream to write the seeker utterances.
-        source_data (List[Dict[str, Any]]): The dialogue data to annotate.
+        source_data (Iterable[Dict[str, Any]]): The dialogue data to annotate, a list
+            or a stream from iter_source_data.
+        start_index (int): Index of the first seeker turn to yield a prompt for. The
+            earlier prompts are skipped without being assembled, see seek_seeker_turn
+            to skip reading their dialogues as well.
 
     Returns:
         str: A prompt.
     """
+    if not isinstance(prompt, PromptTemplate):
+        prompt = PromptTemplate(prompt)
+    seeker_index = 0
     # Assembly question and yield one prompt one time
     for data in source_data:
-        current_dialog = ""
+        if seeker_index < start_index:
+            seeker_turns = sum(
+                1 for utterance in data["conversation"] if utterance["speaker"] == "seeker"
+            )
+            # skip whole dialogues before the start without assembling their prompts
+            if seeker_index + seeker_turns <= start_index:
+                seeker_index += seeker_turns
+                continue
+        current_dialog = []
         for utterance in data["conversation"]:
-            current_dialog += utterance["speaker"] + ": " + utterance["content"] + "\n"
+            current_dialog.append(utterance["speaker"] + ": " + utterance["content"] + "\n")
             if utterance["speaker"] == "seeker":
+                seeker_index += 1
+                if seeker_index <= start_index:
+                    continue
                 if seeker_only_file:
                     seeker_only_file.write(
                         json.dumps({"utterance": utterance["content"]}) + "\n"
                     )
-                dy_prompt = prompt.replace("<conversation>", current_dialog)
-                yield dy_prompt
+                yield prompt.fill_utterances(current_dialog)
 
 
-def prompt_from_dialog_data(prompt: Text, dialog_data: List[Text]) -> str:
+def prompt_from_dialog_data(
+    prompt: Union[Text, PromptTemplate], dialog_data: List[Text], start_index: int = 0
+) -> str:
     """Assembly prompt, however from existing dialog style data instead of utterance based
        data.
 
     Args:
-        prompt (Text): A template with main factors represented by tokens with <>.
+        prompt (Union[Text, PromptTemplate]): A template with main factors represented by
+            tokens with <>, or the parsed template.
         dialog_data (List[Text]): A list of dialogues for prompting.
+        start_index (int): Index of the first dialogue to yield a prompt for.
 
     Returns:
         str: A prompt.
     """
-    for data in dialog_data:
+    if not isinstance(prompt, PromptTemplate):
+        prompt = PromptTemplate(prompt)
+    for data in dialog_data[start_index:]:
         data = data.replace("\nIn this conversation, the seeker", "\n")
-        dy_prompt = prompt.replace("<conversation>", data)
-        yield dy_prompt
+        yield prompt.fill(data)
+
+
+MODEL_DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    # float32 weights with int8 dynamic quantization of the linear layers
+    "int8": torch.qint8,
+}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LazyModel:
+    """A stand-in for a model that is only loaded when it is first used.
+
+    Args:
+        load (Callable[[], Any]): Loads and returns the model.
+    """
 
+    def __init__(self, load: Callable[[], Any]):
+        self._load = load
+        self._model = None
 
-def load_large_model(model_name: Text):
+    def _get_model(self):
+        if self._model is None:
+            self._model = self._load()
+        return self._model
+
+    def __getattr__(self, name: Text):
+        return getattr(self._get_model(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._get_model()(*args, **kwargs)
+
+
+def conv1d_to_linear(model) -> None:
+    """Replace the Conv1D layers of gpt and gpt-2 by the equivalent nn.Linear layers,
+       which dynamic quantization supports.
+    """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+
+
+def quantize_model(model):
+    """Quantize the weights of the linear layers to int8 for faster cpu inference.
+       Activations are quantized on the fly, so no calibration data is needed.
+    """
+    conv1d_to_linear(model)
+    # in place, a copy would hold a second set of float32 weights while quantizing
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.quantization = "int8"
+    return model
+
+
+def model_cache_name(model) -> Text:
+    """Name of a model in the response cache keys, with the type of its weights,
+       e.g. gpt2:int8, since bfloat16 or quantized weights generate differently."""
+    weights = getattr(model, "quantization", None) or str(model.dtype).replace("torch.", "")
+    return f"{model.name_or_path}:{weights}"
+
+
+def load_pretrained_model(
+    model_class, model_name: Text, dtype: Optional[torch.dtype] = None, low_memory: bool = False
+):
+    """Load model weights and report the loading time and the peak memory.
+
+    Args:
+        model_class: The transformers model class, e.g. AutoModelForCausalLM.
+        model_name (Text): Name or path of the pretrained model.
+        dtype (Optional[torch.dtype], optional): Type to load the weights in, None for
+            float32, torch.qint8 to quantize the float32 weights. Defaults to None.
+        low_memory (bool, optional): Memory-map the safetensors weights and fill the
+            model from them directly instead of building a randomly initialised copy
+            first. Defaults to False.
+
+    Returns:
+        The loaded model in evaluation mode.
+    """
+    print(f"loading model from {model_name}")
+    start = time.time()
+    kwargs = {}
+    quantize = dtype == torch.qint8
+    if dtype is not None and not quantize:
+        kwargs["torch_dtype"] = dtype
+    if low_memory:
+        kwargs["low_cpu_mem_usage"] = True
+    model = model_class.from_pretrained(model_name, **kwargs)
+    model.eval()
+    if quantize:
+        model = quantize_model(model)
+    print(f"Model configuration: {model.config}")
+    report = (
+        f"loaded {model_name} ({'int8' if quantize else model.dtype}) in {time.time() - start:.1f}s, "
+        f"peak RSS {peak_rss_mb():.0f} MiB"
+    )
+    print(report)
+    logger.info(report)
+    return model
+
+
+def load_large_model(
+    model_name: Text,
+    dtype: Optional[torch.dtype] = None,
+    low_memory: bool = False,
+    lazy: bool = False,
+):
     """Load the large language model based on model name.
 
     Args:
         model_name (Text): The given model name.
+        dtype (Optional[torch.dtype], optional): Type of the model weights, e.g.
+            torch.bfloat16 to halve the memory on CPU or torch.qint8 for int8 dynamic
+            quantization. Defaults to None for float32.
+        low_memory (bool, optional): Memory-map the weights while loading, see
+            load_pretrained_model. Defaults to False.
+        lazy (bool, optional): Load only the tokenizer now and the model on its first
+            use. Defaults to False.
 
     Returns:
         _type_: Return the model file and tokenizer.
     """
+    if is_retrieval_model(model_name):
+        # a retrieval expert is its own model and needs no tokenizer
+        return load_retrieval_expert(model_name), None
     if "gpt-j" == model_name:
         model_name = "EleutherAI/gpt-j-6B"
-        print(f"loading model from {model_name}")
-        model = AutoModelForCausalLM.from_pretrained(model_name)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        print(f"Model configuration: {model.config}")
+        model_class, tokenizer_class = AutoModelForCausalLM, AutoTokenizer
     elif "gpt-2" == model_name:
         model_name = "gpt2"
-        print(f"loading model from {model_name}")
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModelForCausalLM.from_pretrained(model_name)
-        print(f"Model configuration: {model.config}")
+        model_class, tokenizer_class = AutoModelForCausalLM, AutoTokenizer
     elif "distilgpt2" == model_name:
         model_name = "distilgpt2"
-        print(f"loading model from {model_name}")
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModelForCausalLM.from_pretrained(model_name)
-        print(f"Model configuration: {model.config}")
+        model_class, tokenizer_class = AutoModelForCausalLM, AutoTokenizer
     elif "gpt" == model_name:
         model_name = "openai-gpt"
-        print(f"loading model from {model_name}")
-        model = OpenAIGPTLMHeadModel.from_pretrained(model_name)
-        tokenizer = OpenAIGPTTokenizer.from_pretrained(model_name)
-        print(f"Model configuration: {model.config}")
+        model_class, tokenizer_class = OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
     elif model_name in ["ada", "davinci", "gpt-3"]:
         model_name = "gpt2"
         tokenizer = AutoTokenizer.from_pretrained(model_name)
         model = None
+        return model, tokenizer
     else:
         return None
+    tokenizer = tokenizer_class.from_pretrained(model_name)
+
+    def load():
+        return load_pretrained_model(model_class, model_name, dtype, low_memory)
+
+    model = LazyModel(load) if lazy else load()
     return model, tokenizer
 
 
-def gpt_text_generate(prompt: Text, model, tokenizer) -> str:
+class SeededSampler(LogitsProcessor):
+    """Sample the next token of every row in a batch with its own random generator.
+
+    Sampling with a per-row seed makes the generated text of a prompt independent
+    of the other prompts in the batch, so batched and per-prompt generation give
+    the same output. The chosen token is returned as the only finite score, which
+    is why it must be used together with greedy decoding.
+    """
+
+    def __init__(self, seeds: List[int], temperature: float = 0.7, top_k: int = 50):
+        self.generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+        self.temperature = temperature
+        self.top_k = top_k
+
+    def __call__(self, input_ids, scores):
+        scores = scores / self.temperature
+        top_k = min(self.top_k, scores.size(-1))
+        kth_scores = torch.topk(scores, top_k)[0][..., -1, None]
+        scores = scores.masked_fill(scores < kth_scores, -float("inf"))
+        probs = torch.softmax(scores.float(), dim=-1)
+        picked = torch.full_like(scores, -float("inf"))
+        for row, generator in enumerate(self.generators):
+            token = torch.multinomial(probs[row], 1, generator=generator)
+            picked[row, token] = 0
+        return picked
+
+
+# every caller keeps only the first line of a generated reasoning
+STOP_STRINGS = ["\n"]
+# the gpt tokenizer drops newlines, so a gpt reasoning never produces one. Its line
+# ends where the "Conversation:" of the next example starts, as gpt decodes it.
+GPT_LINE_END = "conversation :"
+
+
+class StopOnStrings(StoppingCriteria):
+    """Stop the generation of every row as soon as its generated text contains a stop string.
+
+    Only the last few generated tokens of a row are decoded at each step, and rows that
+    stopped are remembered, so batched rows stop independently of each other.
+
+    Args:
+        tokenizer: The tokenizer of the model.
+        prompt_length (int): Length of the (padded) prompts, generated text starts after it.
+        stop_strings (List[Text]): Strings that end the generation.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, stop_strings: List[Text]):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_strings = stop_strings
+        # a stop string completed by the newest token spans at most this many tokens
+        self.window = max(len(tokenizer(stop)["input_ids"]) for stop in stop_strings) + 2
+        self.stop_lengths = {}
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        length = input_ids.shape[1]
+        start = max(self.prompt_length, length - self.window)
+        for row, tokens in enumerate(input_ids[:, start:].tolist()):
+            if row in self.stop_lengths:
+                continue
+            text = self.tokenizer.decode(tokens)
+            if any(stop in text for stop in self.stop_strings):
+                self.stop_lengths[row] = length
+        return torch.tensor(
+            [row in self.stop_lengths for row in range(input_ids.shape[0])],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def stopping_criteria(
+    tokenizer, prompt_length: int, stop_strings: Optional[List[Text]]
+) -> Tuple[Optional[StopOnStrings], Dict[str, Any]]:
+    """Build the stopping criteria of a generate call, none for an empty stop list."""
+    if not stop_strings:
+        return None, {}
+    if isinstance(tokenizer, OpenAIGPTTokenizer):
+        stop_strings = [GPT_LINE_END if stop == "\n" else stop for stop in stop_strings]
+    criteria = StopOnStrings(tokenizer, prompt_length, stop_strings)
+    return criteria, {"stopping_criteria": StoppingCriteriaList([criteria])}
+
+
+def template_prefix(prompt_template: Text) -> Text:
+    """Get the static part of a template that comes before the conversation.
+
+    Args:
+        prompt_template (Text): A template with a <conversation> placeholder.
+
+    Returns:
+        Text: The text before the <conversation> placeholder.
+    """
+    if "<conversation>" not in prompt_template:
+        raise ValueError("prompt template has no <conversation> placeholder")
+    return prompt_template.split("<conversation>")[0]
+
+
+# prefix caches of every live model, the most recently used prefixes last
+prefix_caches = weakref.WeakKeyDictionary()
+PREFIX_CACHE_SIZE = 8
+generation_locks = weakref.WeakKeyDictionary()
+generation_locks_lock = threading.Lock()
+
+
+def generation_lock(model) -> threading.RLock:
+    """Get the lock that serializes the generation calls of a model. A fast tokenizer
+       and the model config must not be used by two generations at once, and threads
+       that share a model, e.g. the reasoning of pipelined self chat groups, take turns."""
+    with generation_locks_lock:
+        lock = generation_locks.get(model)
+        if lock is None:
+            lock = generation_locks[model] = threading.RLock()
+        return lock
+
+
+def prompt_lock(model):
+    """Lock the tokenizer of a local model while a prompt is built with it, nothing for
+       the gpt-3 models."""
+    if model is None:
+        return nullcontext()
+    return generation_lock(model)
+
+
+def get_prefix_cache(prefix: Text, model, tokenizer):
+    """Encode a fixed prompt prefix once per model and keep its key/value cache, for
+       the PREFIX_CACHE_SIZE most recently used prefixes of every model.
+
+    Args:
+        prefix (Text): The static prompt prefix, see template_prefix.
+
+    Returns:
+        Tuple: The prefix input ids and its past_key_values. The past_key_values
+            is None if the model does not return a cache.
+    """
+    # a freed model drops its caches, and a model keeps only its recent prefixes
+    with generation_locks_lock:
+        caches = prefix_caches.get(model)
+        if caches is None:
+            caches = prefix_caches[model] = OrderedDict()
+    with generation_lock(model):
+        if prefix in caches:
+            caches.move_to_end(prefix)
+            return caches[prefix]
+        prefix_ids = tokenizer(prefix, return_tensors="pt")["input_ids"]
+        with torch.no_grad():
+            outputs = model(prefix_ids, use_cache=True)
+        caches[prefix] = (prefix_ids, getattr(outputs, "past_key_values", None))
+        if len(caches) > PREFIX_CACHE_SIZE:
+            caches.popitem(last=False)
+        return caches[prefix]
+
+
+def generation_params(
+    seed: Optional[int], return_prompt: bool, stop_strings: Optional[List[Text]] = None
+) -> Dict[str, Any]:
+    """Get the generation parameters of the local models, used as part of the cache key."""
+    return {
+        "do_sample": True,
+        "temperature": 0.7,
+        "max_new_tokens": 80,
+        "seed": seed,
+        "return_prompt": return_prompt,
+        "stop": stop_strings or [],
+    }
+
+
+def gpt_text_generate(
+    prompt: Text,
+    model,
+    tokenizer,
+    seed: Optional[int] = None,
+    prefix: Optional[Text] = None,
+    template: Text = "",
+    stop_strings: Optional[List[Text]] = STOP_STRINGS,
+    streamer: Optional[TextIteratorStreamer] = None,
+) -> str:
     """Generate text with GPT-J 6B model using the given prompt.
 
     Args:
         prompt (Text): The prompt input.
+        seed (Optional[int], optional): Seed for sampling. Use the same seed as
+            gpt_batch_generate to reproduce its output. Defaults to None.
+        prefix (Optional[Text], optional): Static beginning of the prompt whose
+            key/value cache is reused instead of encoding it again. Defaults to None.
+        template (Text, optional): The template of the prompt, part of the cache key. Defaults to "".
+        stop_strings (Optional[List[Text]], optional): Strings that end the generation once
+            it produced one of them, None to always generate 80 tokens. Defaults to a newline.
+        streamer (Optional[TextIteratorStreamer], optional): Streamer to put the generated
+            tokens into while they are generated. Nothing is streamed for a cached
+            response. Defaults to None.
 
     Returns:
         str: The generated answer.
     """
+    cache_key = None
+    if response_cache is not None:
+        params = generation_params(seed, return_prompt=True, stop_strings=stop_strings)
+        cache_key = ResponseCache.key(model_cache_name(model), template, prompt, params)
+        gen_text = response_cache.get(cache_key)
+        if gen_text is not None:
+            return gen_text
+
+    # the tokenizer and the model config are changed while generating
+    with generation_lock(model):
+        sequence = tokenizer(
+            prompt,
+            return_tensors="pt",
+            # truncation=True,
+            # max_length=600,
+        )
+        input_ids = sequence["input_ids"]
+        attention_mask = sequence["attention_mask"]
+        model.config.pad_token_id = model.config.eos_token_id
+
+        cache_kwargs = {}
+        if prefix and prompt.startswith(prefix):
+            prefix_ids, past_key_values = get_prefix_cache(prefix, model, tokenizer)
+            prefix_length = prefix_ids.shape[1]
+            # only reuse the cache if the prompt tokenizes into the same prefix tokens
+            if (
+                past_key_values is not None
+                and input_ids.shape[1] > prefix_length
+                and torch.equal(input_ids[:, :prefix_length], prefix_ids)
+            ):
+                cache_kwargs["past_key_values"] = copy.deepcopy(past_key_values)
+        _, stop_kwargs = stopping_criteria(tokenizer, input_ids.shape[1], stop_strings)
+        if streamer is not None:
+            stop_kwargs["streamer"] = streamer
+
+        try:
+            if seed is None:
+                gen_tokens = model.generate(
+                    input_ids,
+                    do_sample=True,
+                    temperature=0.7,
+                    max_new_tokens=80,
+                    attention_mask=attention_mask,
+                    **cache_kwargs,
+                    **stop_kwargs,
+                )
+            else:
+                gen_tokens = model.generate(
+                    input_ids,
+                    do_sample=False,
+                    logits_processor=LogitsProcessorList([SeededSampler([seed])]),
+                    max_new_tokens=80,
+                    attention_mask=attention_mask,
+                    **cache_kwargs,
+                    **stop_kwargs,
+                )
+            gen_text = tokenizer.batch_decode(gen_tokens)[0]
+        except RuntimeError:
+            return "<padding> <padding> <padding> <padding> <padding>"
+    if cache_key is not None:
+        response_cache.put(cache_key, gen_text)
+    return gen_text
 
-    sequence = tokenizer(
-        prompt,
-        return_tensors="pt",
-        # truncation=True,
-        # max_length=600,
-    )
-    input_ids = sequence["input_ids"]
-    attention_mask = sequence["attention_mask"]
-    model.config.pad_token_id = model.config.eos_token_id
 
+def check_prefix_cache(prompt: Text, prefix: Text, model, tokenizer, seed: int = 0) -> bool:
+    """Check that generating with the cached prefix matches full recomputation.
+
+    Args:
+        prompt (Text): A prompt starting with the prefix.
+        prefix (Text): The static prompt prefix.
+        seed (int, optional): Sampling seed used for both runs. Defaults to 0.
+
+    Returns:
+        bool: Whether both generations are the same.
+    """
+    # compare real generations, not responses from the response cache
+    cache = response_cache
+    set_response_cache(None)
     try:
-        gen_tokens = model.generate(
-            input_ids,
-            do_sample=True,
-            temperature=0.7,
-            max_new_tokens=80,
-            attention_mask=attention_mask,
+        full = gpt_text_generate(prompt, model, tokenizer, seed=seed)
+        cached = gpt_text_generate(prompt, model, tokenizer, seed=seed, prefix=prefix)
+    finally:
+        set_response_cache(cache)
+    return full == cached
+
+
+def gpt_batch_generate(
+    prompts: List[Text],
+    model,
+    tokenizer,
+    seeds: Optional[List[int]] = None,
+    template: Text = "",
+    stop_strings: Optional[List[Text]] = STOP_STRINGS,
+    return_prompt: bool = False,
+) -> List[str]:
+    """Generate text for several prompts with one call to the model.
+       The prompts are left padded so that every generation starts right after
+       its own prompt.
+
+    Args:
+        prompts (List[Text]): The prompt inputs.
+        seeds (Optional[List[int]], optional): One sampling seed per prompt. With
+            seeds, each output is the same as gpt_text_generate with that seed.
+            Defaults to None.
+        template (Text, optional): The template of the prompts, part of the cache key. Defaults to "".
+        stop_strings (Optional[List[Text]], optional): Strings that end the generation of a
+            row once it produced one of them. Defaults to a newline.
+        return_prompt (bool, optional): Decode every prompt together with its generation,
+            as gpt_text_generate does. Tokenizers that change the text when decoding, e.g.
+            the lower-casing one of gpt, then give the same text as gpt_text_generate.
+            Defaults to False.
+
+    Returns:
+        List[str]: The generated answers, without the prompts unless return_prompt,
+            in input order.
+    """
+    all_texts = [None] * len(prompts)
+    cache_keys = [None] * len(prompts)
+    if response_cache is not None:
+        for index, prompt in enumerate(prompts):
+            seed = None if seeds is None else seeds[index]
+            params = generation_params(seed, return_prompt=return_prompt, stop_strings=stop_strings)
+            cache_keys[index] = ResponseCache.key(model_cache_name(model), template, prompt, params)
+            all_texts[index] = response_cache.get(cache_keys[index])
+    missing = [index for index, text in enumerate(all_texts) if text is None]
+    if not missing:
+        return all_texts
+    prompts = [prompts[index] for index in missing]
+    if seeds is not None:
+        seeds = [seeds[index] for index in missing]
+
+    # the tokenizer and the model config are changed while generating
+    with generation_lock(model):
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token or tokenizer.unk_token
+        sequences = tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left")
+        input_ids = sequences["input_ids"]
+        attention_mask = sequences["attention_mask"]
+        eos_token_id = model.config.eos_token_id
+        model.config.pad_token_id = eos_token_id
+        criteria, stop_kwargs = stopping_criteria(tokenizer, input_ids.shape[1], stop_strings)
+
+        try:
+            if seeds is None:
+                gen_tokens = model.generate(
+                    input_ids,
+                    do_sample=True,
+                    temperature=0.7,
+                    max_new_tokens=80,
+                    attention_mask=attention_mask,
+                    pad_token_id=tokenizer.pad_token_id,
+                    **stop_kwargs,
+                )
+            else:
+                gen_tokens = model.generate(
+                    input_ids,
+                    do_sample=False,
+                    logits_processor=LogitsProcessorList([SeededSampler(seeds)]),
+                    max_new_tokens=80,
+                    attention_mask=attention_mask,
+                    pad_token_id=tokenizer.pad_token_id,
+                    **stop_kwargs,
+                )
+        except RuntimeError:
+            for index in missing:
+                all_texts[index] = "<padding> <padding> <padding> <padding> <padding>"
+            return all_texts
+
+        for row, (index, tokens) in enumerate(
+            zip(missing, gen_tokens[:, input_ids.shape[1]:].tolist())
+        ):
+            # finished rows are filled up to the batch length, cut them after the eos
+            # or after the stop string
+            if criteria is not None and row in criteria.stop_lengths:
+                tokens = tokens[: criteria.stop_lengths[row] - input_ids.shape[1]]
+            if eos_token_id in tokens:
+                tokens = tokens[: tokens.index(eos_token_id) + 1]
+            if return_prompt:
+                prompt_tokens = input_ids[row][attention_mask[row].bool()].tolist()
+                tokens = prompt_tokens + tokens
+            all_texts[index] = tokenizer.decode(tokens)
+    for index in missing:
+        if cache_keys[index] is not None:
+            response_cache.put(cache_keys[index], all_texts[index])
+    return all_texts
+
+
+def drop_history_index(
+    utterances: List[Text],
+    allowed_dialog_length: int,
+    tokenizer,
+    prefix_lengths: Optional[List[int]] = None,
+) -> int:
+    """Find how many leading utterances to drop so that the rest fits the length.
+       Every utterance is tokenized once, the cut point is searched on the prefix
+       sums of the token counts and then confirmed on the joined text.
+
+    Args:
+        utterances (List[Text]): Utterances of the dialogue, joined with newlines.
+        allowed_dialog_length (int): Maximum number of tokens of the joined text.
+        prefix_lengths (Optional[List[int]], optional): Known prefix sums of the token
+            counts, starting with 0. Defaults to None, to tokenize every utterance.
+
+    Returns:
+        int: Index of the first utterance to keep.
+    """
+
+    def joined_length(start: int) -> int:
+        return len(tokenizer("\n".join(utterances[start:]))["input_ids"])
+
+    if prefix_lengths is None:
+        prefix_lengths = [0]
+        for index, utterance in enumerate(utterances):
+            if index < len(utterances) - 1:
+                utterance += "\n"
+            prefix_lengths.append(prefix_lengths[-1] + len(tokenizer(utterance)["input_ids"]))
+
+    start = bisect.bisect_left(prefix_lengths, prefix_lengths[-1] - allowed_dialog_length)
+    start = min(start, len(utterances))
+    # tokens may merge across utterance boundaries, correct the estimate on the real text
+    while start < len(utterances) and joined_length(start) > allowed_dialog_length:
+        start += 1
+    while start > 0 and joined_length(start - 1) <= allowed_dialog_length:
+        start -= 1
+    return start
+
+
+class DialogueHistory:
+    """The lines of an ongoing conversation, e.g. "seeker: ...", with the running
+       totals of their token counts cached per tokenizer. Only new lines are
+       tokenized for the totals and only the window that fits the reasoning model
+       is tokenized again, so a turn costs the same however long the conversation.
+
+    Args:
+        lines (Optional[List[Text]], optional): Lines to start with. Defaults to None.
+    """
+
+    def __init__(self, lines: Optional[List[Text]] = None):
+        self.lines = []
+        self.prefix_lengths = {}
+        for line in lines or []:
+            self.append(line)
+
+    def append(self, line: Text) -> None:
+        """Add a line, e.g. "supporter: " + text."""
+        self.lines.extend(line.split("\n"))
+
+    def clear(self) -> None:
+        self.lines = []
+        self.prefix_lengths = {}
+
+    def copy(self) -> "DialogueHistory":
+        """A copy that keeps the token counts, e.g. for a reasoning that may outlive the turn."""
+        history = DialogueHistory()
+        history.lines = list(self.lines)
+        history.prefix_lengths = {key: list(value) for key, value in self.prefix_lengths.items()}
+        return history
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __str__(self) -> Text:
+        return "".join(line + "\n" for line in self.lines)
+
+    def text(self) -> Text:
+        """The conversation without its last newline, as given to inference()."""
+        return "\n".join(self.lines)
+
+    def running_lengths(self, tokenizer) -> List[int]:
+        """Prefix sums of the token counts of the lines, each with its newline."""
+        key = getattr(tokenizer, "name_or_path", "") or id(tokenizer)
+        prefix_lengths = self.prefix_lengths.setdefault(key, [0])
+        for line in self.lines[len(prefix_lengths) - 1 :]:
+            prefix_lengths.append(prefix_lengths[-1] + len(tokenizer(line + "\n")["input_ids"]))
+        return prefix_lengths
+
+    def token_length(self, tokenizer) -> int:
+        """Number of tokens of the whole conversation."""
+        return self.running_lengths(tokenizer)[-1]
+
+    def window(self, allowed_dialog_length: int, tokenizer) -> Text:
+        """The end of the conversation that fits the length, the same as
+           process_prompt_length(self.text(), allowed_dialog_length, tokenizer).
+        """
+        start = drop_history_index(
+            self.lines, allowed_dialog_length, tokenizer, self.running_lengths(tokenizer)
         )
-        gen_text = tokenizer.batch_decode(gen_tokens)[0]
-    except RuntimeError:
-        gen_text = "<padding> <padding> <padding> <padding> <padding>"
-    return gen_text
+        return "\n".join(self.lines[start:]) + "\n"
 
 
 def process_prompt_length(
@@ -339,9 +1337,8 @@ def process_prompt_length(
         tmp_text = "\n".join(utterances)
 
     if not single_utterance:
-        while len(tokenizer(tmp_text)["input_ids"]) > allowed_dialog_length:
-            utterances.pop(0)
-            tmp_text = "\n".join(utterances)
+        start = drop_history_index(utterances, allowed_dialog_length, tokenizer)
+        tmp_text = "\n".join(utterances[start:])
     else:
         if len(utterances) >= 2:
             tmp_text = utterances[-2] + "\n" + utterances[-1]
@@ -358,12 +1355,179 @@ def prompting(prompt: Text, model_name: Text, model, tokenizer) -> str:
     return
 
 
+def fit_prompt_length(
+    prompts: Iterable[Text], template: PromptTemplate, allowed_dialog_length: int, tokenizer
+) -> Iterator[Text]:
+    """Remove the beginning of the conversation from prompts that are too long.
+
+    Args:
+        prompts (Iterable[Text]): Prompts assembled from the template.
+        template (PromptTemplate): The template used to assemble the prompts.
+        allowed_dialog_length (int): Maximum number of tokens of the conversation.
+
+    Returns:
+        Iterator[Text]: The prompts that fit the model input length.
+    """
+    fixed_length = template.token_length(tokenizer)
+    for prompt in prompts:
+        logger.debug(len(prompt))
+        current_length = len(tokenizer(prompt)["input_ids"]) - fixed_length + 1
+        if current_length > allowed_dialog_length:
+            print(
+                f"current dialog length {current_length} is longer than allowed dialog length {allowed_dialog_length}. The beginning part of the conversation will be removed adaptively."
+            )
+            prompt = template.fill(
+                process_prompt_length(prompt, allowed_dialog_length, tokenizer)
+            )
+            print(prompt)
+        yield prompt
+
+
+class AnnotationCheckpoint:
+    """Progress manifest of an annotation run, kept next to the response file.
+       The manifest records the index of the next prompt after every written
+       response, so that an interrupted run continues where it stopped, and the
+       seeker_turn_index of the source data, so that it seeks there directly.
+
+    Args:
+        response_file_path (Text): Path of the response jsonl file.
+        settings (Dict[str, Any]): Settings of the run, a resumed run must use the same.
+        start_index (int): Index of the first prompt of the run.
+    """
+
+    def __init__(self, response_file_path: Text, settings: Dict[str, Any], start_index: int):
+        self.path = os.path.splitext(response_file_path)[0] + ".manifest.json"
+        self.settings = settings
+        self.start_index = start_index
+        self.next_index = start_index
+        self.source = None
+        self.index = None
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+            if manifest["settings"] != settings:
+                raise ValueError(
+                    f"checkpoint {self.path} was written with settings {manifest['settings']}"
+                )
+            self.start_index = manifest["start_index"]
+            self.next_index = manifest["next_index"]
+            self.source = manifest.get("source")
+            if manifest.get("index") is not None:
+                self.index = [tuple(entry) for entry in manifest["index"]]
+
+    @property
+    def completed(self) -> int:
+        """Number of responses written so far."""
+        return self.next_index - self.start_index
+
+    def record(self, *files: TextIO) -> None:
+        """Mark one more response as written, after flushing the files written with it,
+           e.g. the response file and the seeker utterance file."""
+        for file in files:
+            file.flush()
+        self.next_index += 1
+        self.write()
+
+    def seeker_turn_index(self, source_path: Text) -> List[Tuple[int, int]]:
+        """Get the seeker_turn_index of the source data. It is built once and kept in
+           the manifest, and only built again when the source file changed."""
+        stat = os.stat(source_path)
+        source = {"path": os.path.abspath(source_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        if self.index is None or self.source != source:
+            self.index = seeker_turn_index(source_path)
+            self.source = source
+            self.write()
+        return self.index
+
+    def write(self) -> None:
+        manifest = {
+            "settings": self.settings,
+            "start_index": self.start_index,
+            "next_index": self.next_index,
+            "source": self.source,
+            "index": self.index,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, self.path)
+
+
+def open_truncated(path: Text, line_number: int) -> TextIO:
+    """Open a jsonl file for appending after its first line_number lines.
+       Lines written after the last checkpoint are removed.
+    """
+    if not os.path.exists(path):
+        return open(path, "w+", encoding="utf-8")
+    # count lines on the raw bytes, text mode tell() is not a byte offset
+    with open(path, "rb+") as file:
+        for _ in range(line_number):
+            if not file.readline():
+                break
+        file.truncate(file.tell())
+    return open(path, "a", encoding="utf-8")
+
+
 def dump_response(message: Text, response_file: Text) -> None:
     response_file.write(json.dumps({"response": message}) + "\n")
 
 
-def add_arguments():
-    parser = argparse.ArgumentParser()
+def dump_batch_responses(
+    prompts: List[Text],
+    seeds: List[Optional[int]],
+    model,
+    tokenizer,
+    write_response: Callable[[Text], None],
+    template: Text = "",
+) -> None:
+    """Generate responses for a batch of prompts and write them in prompt order."""
+    if None in seeds:
+        seeds = None
+    for response in batch_response_generate(
+        prompts, model, tokenizer, seeds=seeds, template=template
+    ):
+        write_response(response)
+
+
+def response_from_generation(tokenizer, prompt: Text, generated: Text) -> Text:
+    """Cut the response out of the prompt and generation of a local model, decoded
+       together as gpt_text_generate returns them. Tokenizers that change the text
+       when decoding, e.g. the lower-casing one of gpt, decode the prompt to other
+       text than the prompt itself, so the decoded prompt is cut off. A gpt response
+       also loses the GPT_LINE_END its generation stopped at, as a reasoning does."""
+    decoded_prompt = tokenizer.decode(tokenizer(prompt)["input_ids"])
+    response = generated[len(decoded_prompt) :]
+    if isinstance(tokenizer, OpenAIGPTTokenizer):
+        response = response.split(GPT_LINE_END)[0]
+    return response
+
+
+def batch_response_generate(
+    prompts: List[Text],
+    model,
+    tokenizer,
+    seeds: Optional[List[int]] = None,
+    template: Text = "",
+) -> List[Text]:
+    """Generate the responses of several prompts with one call to a local model. Every
+       response is cut out of one decoding of its prompt and generation, so it is the
+       same as the response of gpt_text_generate with the same seed.
+
+    Returns:
+        List[Text]: The response of every prompt, without the prompt.
+    """
+    generations = gpt_batch_generate(
+        prompts, model, tokenizer, seeds=seeds, template=template, return_prompt=True
+    )
+    return [
+        response_from_generation(tokenizer, prompt, generated)
+        for prompt, generated in zip(prompts, generations)
+    ]
+
+
+def add_arguments(parser: Optional[argparse.ArgumentParser] = None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
     parser.add_argument(
         "--model_name",
         type=str,
@@ -380,6 +1544,11 @@ def add_arguments():
         "--prompt_template", type=str, required=True, help="prompt template to use"
     )
     parser.add_argument("--start_index", type=int, default=0, help="where to start")
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="record progress in a manifest next to the responses and resume from it",
+    )
     parser.add_argument(
         "--response_suffix",
         type=str,
@@ -387,32 +1556,117 @@ def add_arguments():
         help="folder to save the results",
     )
     parser.add_argument("--use_dialog", type=bool, default=False, help="weather to use dialog data")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="number of prompts to generate together with local models",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="sampling seed for local models, prompt i is sampled with seed + i",
+    )
+    parser.add_argument(
+        "--reuse_prefix_cache",
+        action="store_true",
+        help="encode the template before <conversation> once and reuse its cache, batch size 1 only",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=0,
+        help="number of concurrent gpt-3 or reasoning server requests, 0 sends one blocking request at a time",
+    )
+    parser.add_argument(
+        "--requests_per_minute", type=int, default=0, help="gpt-3 request budget, 0 for no limit"
+    )
+    parser.add_argument(
+        "--tokens_per_minute", type=int, default=0, help="gpt-3 token budget, 0 for no limit"
+    )
+    parser.add_argument(
+        "--api_base", type=str, default="", help="base url of the completion api, e.g. a local fake server"
+    )
+    parser.add_argument(
+        "--cache_path", type=str, default="", help="sqlite file to cache expert responses in"
+    )
+    parser.add_argument(
+        "--cache_max_mb", type=int, default=0, help="size limit of the response cache, 0 for no limit"
+    )
+    parser.add_argument(
+        "--cache_read_only",
+        action="store_true",
+        help="only read from the response cache, e.g. to replay an earlier run",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float32",
+        choices=list(MODEL_DTYPES),
+        help="type of the local model weights, bfloat16 halves the memory and int8 "
+        "quantizes the linear layers for faster cpu inference",
+    )
+    parser.add_argument(
+        "--low_memory",
+        action="store_true",
+        help="memory-map the model weights while loading to keep the peak memory low",
+    )
+    parser.add_argument(
+        "--example_number",
+        type=int,
+        default=0,
+        help="number of examples of distinct emotion and problem types to add to the template",
+    )
+    parser.add_argument(
+        "--example_path", type=str, default=test_data_path, help="pool to pick the examples from"
+    )
+    parser.add_argument(
+        "--reasoning_server",
+        type=str,
+        default="",
+        help="url of a reasoning server to generate with instead of loading the model",
+    )
     args = parser.parse_args()
     return args
 
 
-def main():
-    # load arguments
-    args = add_arguments()
-    # load data
-    template_file = open(args.prompt_template, "r", encoding="utf-8")
-    fixed_prompt = template_file.read()
-    source_data = read_source_data(source_data_path)
-    dialog_data = read_dialog_data(dialog_data_path)
-    # test_data = read_source_data(test_data_path)
-    response_file = open(
-        response_path + args.response_suffix + ".jsonl", "w+", encoding="utf-8"
-    )
-    seeker_only_file = open(
-        seeker_utterances_only + args.response_suffix + ".jsonl", "w+", encoding="utf-8"
-    )
-    # load model
+def configure_experts(args) -> None:
+    """Set up the api endpoint and the response cache from the arguments."""
+    if args.api_base:
+        openai.api_base = args.api_base
+    if args.cache_path:
+        set_response_cache(
+            ResponseCache(
+                args.cache_path,
+                max_bytes=args.cache_max_mb * 1024 * 1024,
+                read_only=args.cache_read_only,
+            )
+        )
+
+
+def annotate(
+    args,
+    template: PromptTemplate,
+    prompt_generator: Iterable[Text],
+    model,
+    tokenizer,
+    write_response: Callable[[Text], None],
+    start_index: int = 0,
+) -> None:
+    """Generate a response for every prompt and write them in prompt order.
+
+    Args:
+        args: The parsed arguments, see add_arguments.
+        template (PromptTemplate): The template used to assemble the prompts.
+        prompt_generator (Iterable[Text]): The prompts to annotate.
+        write_response (Callable[[Text], None]): Called with each response, in prompt order.
+        start_index (int, optional): Index of the first prompt, used for seeding. Defaults to 0.
+    """
     model_name = args.model_name
-    model, tokenizer = load_large_model(model_name)
-    logger.info("loaded tokenizer and model from %s", model_name)
+    fixed_prompt = template.text
     # get fixed template length
-    fixed_sequence = tokenizer(fixed_prompt)
-    fixed_length = len(fixed_sequence["input_ids"])
+    fixed_length = template.token_length(tokenizer)
     logger.info("loaded fixed template length %s", fixed_length)
     max_input_length = 1000
     response_length = 80
@@ -428,79 +1682,243 @@ def main():
         response_length = 80
     allowed_dialog_length = max_input_length  - response_length - fixed_length - 1
     logger.info("Set max input length to %s, response length to %s and allowed dialog length to %s", max_input_length, response_length, allowed_dialog_length)
+
+    prefix = None
+    if args.reuse_prefix_cache and model is not None:
+        prefix = template_prefix(fixed_prompt)
+
+    batch_prompts = []
+    batch_seeds = []
+    prompt_generator = fit_prompt_length(
+        prompt_generator, template, allowed_dialog_length, tokenizer
+    )
+
+    if "gpt-3" == model_name and args.max_in_flight > 0:
+        stats = complete_in_order(
+            prompt_generator,
+            completion_params(args.model_type, stop_words=['\n']),
+            write_response,
+            max_in_flight=args.max_in_flight,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            count_tokens=lambda prompt: len(tokenizer(prompt)["input_ids"]),
+            cache=response_cache,
+            template=fixed_prompt,
+        )
+        logger.info("finished concurrent annotation: %s", stats)
+        return
+
+    if args.reasoning_server:
+        client = ReasoningClient(args.reasoning_server)
+        seeded_prompts = (
+            (prompt, None if args.seed is None else args.seed + prompt_index)
+            for prompt_index, prompt in enumerate(prompt_generator, start_index)
+        )
+        # keep enough requests in flight for the server to batch them
+        in_flight = max(args.max_in_flight, args.batch_size, 1)
+        with ThreadPoolExecutor(in_flight) as executor:
+            while True:
+                chunk = list(islice(seeded_prompts, in_flight))
+                if not chunk:
+                    break
+                for response in executor.map(lambda item: client.generate(*item), chunk):
+                    write_response(response)
+        return
+
+    for prompt_index, prompt in enumerate(prompt_generator, start_index):
+        seed = None if args.seed is None else args.seed + prompt_index
+        if "gpt-3" == model_name:
+            response = get_gpt_result(
+                "completion",
+                prompt,
+                stop_words=['\n'],
+                model_type=args.model_type,
+                template=fixed_prompt,
+            )
+            response = response["choices"][0]["text"]
+        elif args.batch_size > 1:
+            batch_prompts.append(prompt)
+            batch_seeds.append(seed)
+            if len(batch_prompts) == args.batch_size:
+                dump_batch_responses(
+                    batch_prompts, batch_seeds, model, tokenizer, write_response, fixed_prompt
+                )
+                batch_prompts, batch_seeds = [], []
+            continue
+        else:
+            if prefix and prompt_index == start_index:
+                if not check_prefix_cache(prompt, prefix, model, tokenizer):
+                    logger.warning("cached prefix does not match full recomputation, disabled")
+                    prefix = None
+            response = gpt_text_generate(
+                prompt, model, tokenizer, seed=seed, prefix=prefix, template=fixed_prompt
+            )
+            response = response_from_generation(tokenizer, prompt, response)
+        write_response(response)
+    if batch_prompts:
+        dump_batch_responses(
+            batch_prompts, batch_seeds, model, tokenizer, write_response, fixed_prompt
+        )
+    if response_cache is not None:
+        logger.info("response cache: %s", response_cache.stats())
+
+
+def main():
+    # load arguments
+    args = add_arguments()
+    # load data
+    template = load_template(args)
+    dialog_data = read_dialog_data(dialog_data_path)
+    response_file_path = response_path + args.response_suffix + ".jsonl"
+    seeker_only_file_path = seeker_utterances_only + args.response_suffix + ".jsonl"
+    start_index = args.start_index
+    checkpoint = None
+    if args.checkpoint:
+        settings = {
+            key: getattr(args, key)
+            for key in [
+                "model_name",
+                "model_type",
+                "prompt_template",
+                "use_dialog",
+                "seed",
+                "example_number",
+                "example_path",
+            ]
+        }
+        checkpoint = AnnotationCheckpoint(response_file_path, settings, args.start_index)
+        start_index = checkpoint.next_index
+        logger.info("resuming from prompt %s", start_index)
+        # append after the responses of the last checkpoint instead of truncating
+        response_file = open_truncated(response_file_path, checkpoint.completed)
+        seeker_only_file = open_truncated(seeker_only_file_path, checkpoint.completed)
+    else:
+        response_file = open(response_file_path, "w+", encoding="utf-8")
+        seeker_only_file = open(seeker_only_file_path, "w+", encoding="utf-8")
+    configure_experts(args)
+    # load model
+    model_name = args.model_name
+    # with a reasoning server only the tokenizer is used here, the model is never loaded
+    model, tokenizer = load_large_model(
+        model_name,
+        dtype=MODEL_DTYPES[args.dtype],
+        low_memory=args.low_memory,
+        lazy=bool(args.reasoning_server),
+    )
+    logger.info("loaded tokenizer and model from %s", model_name)
     # load prompt generator
     prompt_generator = None
 
     if args.use_dialog:
         prompt_generator = prompt_from_dialog_data(
-            fixed_prompt,
-            dialog_data
+            template,
+            dialog_data,
+            start_index=start_index,
         )
     else:
+        source_data, dialog_start_index = iter_source_data(source_data_path), 0
+        if start_index:
+            # read the source from the dialogue of the first prompt on
+            index = (
+                checkpoint.seeker_turn_index(source_data_path)
+                if checkpoint is not None
+                else seeker_turn_index(source_data_path)
+            )
+            source_data, dialog_start_index = seek_seeker_turn(source_data_path, start_index, index)
         prompt_generator = assembly_prompt(
-            fixed_prompt,
-            seeker_only_file,
-            source_data,
+            template,
+            source_data=source_data,
+            seeker_only_file=seeker_only_file,
+            start_index=dialog_start_index,
         )
 
-    for _ in range(args.start_index):
-        next(prompt_generator)
-
-    # total_token_num = 0
-    # sample_index = 0
     # if generate number is 0, generate until the end.
-    if args.sample_number == 0:
-        for prompt in prompt_generator:
-            # prompt = next(prompt_generator)
-            current_length = len(tokenizer(prompt)["input_ids"]) - fixed_length + 1
-            if current_length > allowed_dialog_length:
-                print(
-                    f"current dialog length {current_length} is longer than allowed dialog length {allowed_dialog_length}. The beginning part of the conversation will be removed adaptively."
-                )
-                prompt = fixed_prompt.replace(
-                    "<conversation>",
-                    process_prompt_length(prompt, allowed_dialog_length, tokenizer),
-                )
-                print(prompt)
-            if "gpt-3" == model_name:
-                response = get_gpt_result("completion", prompt, stop_words=['\n'], model_type=args.model_type)
-                response = response["choices"][0]["text"]
-            else:
-                response = gpt_text_generate(prompt, model, tokenizer)
-                response = response[len(prompt) :]
-            logger.info(response)
-            dump_response(response, response_file)
-    # if generate number is not 0, generate the given number of samples.
-    else:
-        for i in range(args.sample_number):
-            prompt = next(prompt_generator)
-            logger.debug(len(prompt))
-
-            current_length = len(tokenizer(prompt)["input_ids"]) - fixed_length + 1
-            print(current_length)
-            if current_length > allowed_dialog_length:
-                print(
-                    f"current dialog length {current_length} is longer than allowed dialog length {allowed_dialog_length}. The beginning part of the conversation will be removed adaptively."
-                )
-                prompt = fixed_prompt.replace(
-                    "<conversation>",
-                    process_prompt_length(prompt, allowed_dialog_length, tokenizer),
-                )
-                print(prompt)
-            # total_token_num += len(tokenizer(prompt)["input_ids"])
-            # sample_index += 1
-            if "gpt-3" == model_name:
-                response = get_gpt_result("completion", prompt, stop_words=['\n'], model_type=args.model_type)
-                response = response["choices"][0]["text"]
-            else:
-                response = gpt_text_generate(prompt, model, tokenizer)
-                response = response[len(prompt) :]
-            logger.info(response)
-            dump_response(response, response_file)
-        # print(sample_index, total_token_num)
+    if args.sample_number != 0:
+        remaining = args.sample_number - (start_index - args.start_index)
+        prompt_generator = islice(prompt_generator, max(remaining, 0))
+
+    def write_response(response: Text) -> None:
+        logger.info(response)
+        dump_response(response, response_file)
+        if checkpoint is not None:
+            checkpoint.record(response_file, seeker_only_file)
+
+    annotate(
+        args, template, prompt_generator, model, tokenizer, write_response, start_index
+    )
 
 
-def inference(model_name, model, tokenizer, prompt_template: Text, current_dialog) -> Text:
+def inference_length_limits(model_name: Text):
+    """Get the maximum input length and the response length of a reasoning model."""
+    if model_name == "davinci":
+        return 3000, 120
+    elif model_name == "ada":
+        return 2000, 80
+    elif model_name == "gpt":
+        return 500, 80
+    return 1000, 80
+
+
+def reasoning_prompt(
+    model_name, tokenizer, template: PromptTemplate, current_dialog: Union[Text, DialogueHistory]
+) -> Text:
+    """Fill the template with the end of the conversation that fits the reasoning model.
+
+    Args:
+        model_name (_type_): Name of reasoning model.
+        tokenizer (_type_): Tokenizer of reasonin model.
+        template (PromptTemplate): The parsed prompt template.
+        current_dialog (Union[Text, DialogueHistory]): Current updating conversation.
+
+    Returns:
+        Text: The prompt.
+    """
+    fixed_length = template.token_length(tokenizer)
+    max_input_length, response_length = inference_length_limits(model_name)
+    allowed_dialog_length = max_input_length  - response_length - fixed_length - 1
+    if isinstance(current_dialog, DialogueHistory):
+        return template.fill(current_dialog.window(allowed_dialog_length, tokenizer))
+    return template.fill(
+        process_prompt_length(current_dialog, allowed_dialog_length, tokenizer)
+    )
+
+
+def reasoning_from_generation(model_name, generated: Text) -> Text:
+    """Cut the reasoning out of the prompt and generation of a local model, decoded
+       together as gpt_text_generate returns them."""
+    if model_name == "gpt":
+        # response = response.split("in this conversation, the seeker")[-1].split(":")[0].replace("\nsupporter", "").replace("\nConversation", "")
+        # gpt decodes lower-cased, with spaces around the punctuation
+        return re.split(r"in this conversation ?, the seeker", generated)[-1].split(GPT_LINE_END)[0]
+    elif model_name == "gpt-2":
+        return generated.split("In this conversation, the seeker")[-1].split("\n")[0]
+    return ""
+
+
+def batch_reasoning_generate(
+    model_name,
+    prompts: List[Text],
+    model,
+    tokenizer,
+    seeds: Optional[List[int]] = None,
+    template: Text = "",
+) -> List[Text]:
+    """Generate the reasoning of several prompts with one call to a local model. Every
+       reasoning is cut out of one decoding of its prompt and generation, so it is the
+       same as the reasoning inference() gets with the same seed.
+
+    Returns:
+        List[Text]: The reasoning of every prompt, without "The seeker".
+    """
+    generations = gpt_batch_generate(
+        prompts, model, tokenizer, seeds=seeds, template=template, return_prompt=True
+    )
+    return [reasoning_from_generation(model_name, generated) for generated in generations]
+
+
+def inference(
+    model_name, model, tokenizer, prompt_template: Text, current_dialog, seed: Optional[int] = None
+) -> Text:
     """Inference gpt models in real time.
 
     Args:
@@ -508,52 +1926,268 @@ def inference(model_name, model, tokenizer, prompt_template: Text, current_dialo
         model (_type_): Reasoning model
         tokenizer (_type_): Tokenizer of reasonin model.
         prompt_template (Text): Prompt template.
-        current_dialog (_type_): Current updating conversation.
+        current_dialog (Union[Text, DialogueHistory]): Current updating conversation.
+        seed (Optional[int], optional): Seed to sample the response of a local model
+            reproducibly. Defaults to None.
 
     Returns:
         Text: The reasoning response from the reasoning model.
     """
-    template_file = open(prompt_template, "r", encoding="utf-8")
-    fixed_prompt = template_file.read()
+    if is_retrieval_model(model_name):
+        response = model.retrieve(current_dialog)
+        logger.info(response)
+        # no annotated conversation is similar enough
+        return " The seeker " + response if response else ""
+    template = get_prompt_template(prompt_template)
     # model, tokenizer = load_large_model(model_name)
 
-    fixed_sequence = tokenizer(fixed_prompt)
-    fixed_length = len(fixed_sequence["input_ids"])
-    max_input_length = 1000
-    response_length = 80
-    if model_name == "davinci":
-        max_input_length = 3000
-        response_length = 120
-    elif model_name == "ada":
-        max_input_length = 2000
-        response_length = 80
-    elif model_name == "gpt":
-        max_input_length = 500
-        response_length = 80
-    allowed_dialog_length = max_input_length  - response_length - fixed_length - 1
-    prompt = fixed_prompt.replace(
-        "<conversation>",
-        process_prompt_length(current_dialog, allowed_dialog_length, tokenizer),
-    )
+    prefix = template.prefix
+    with prompt_lock(model):
+        prompt = reasoning_prompt(model_name, tokenizer, template, current_dialog)
     print(prompt)
 
     response = ""
-    if model_name == "gpt":
-        response = gpt_text_generate(prompt, model, tokenizer)
-        # print(response)
-        # response = response.split("in this conversation, the seeker")[-1].split(":")[0].replace("\nsupporter", "").replace("\nConversation", "")
-        response = response.split("in this conversation, the seeker")[-1].split("\n")[0]
-    elif model_name == "gpt-2":
-        response = gpt_text_generate(prompt, model, tokenizer)
+    if model_name in ["gpt", "gpt-2"]:
+        response = gpt_text_generate(
+            prompt, model, tokenizer, seed=seed, prefix=prefix, template=template.text
+        )
         # print(response)
-        response = response.split("In this conversation, the seeker")[-1].split("\n")[0]
+        response = reasoning_from_generation(model_name, response)
     elif model_name in ["ada", "davinci"]:
-        response = get_gpt_result("completion", prompt, stop_words=['\n'], model_type=model_name)
+        response = get_gpt_result(
+            "completion",
+            prompt,
+            stop_words=['\n'],
+            model_type=model_name,
+            template=template.text,
+        )
         response = response["choices"][0]["text"]
     print(response)
     logger.info(response)
     return " The seeker " + response
 
 
+class StoppedStream:
+    """Hand streamed text on up to its first stop marker. The end of a piece that may
+       be the beginning of a marker is held back until the next piece tells.
+
+    Args:
+        on_text (Callable[[Text], None]): Called with every piece before the marker.
+        stops (List[Text]): The stop markers, e.g. a newline.
+    """
+
+    def __init__(self, on_text: Callable[[Text], None], stops: List[Text]):
+        self.on_text = on_text
+        self.stops = stops
+        self.pending = ""
+        self.text = ""
+        self.stopped = False
+
+    def put(self, text: Text) -> None:
+        if self.stopped:
+            return
+        pending = self.pending + text
+        cuts = [pending.find(stop) for stop in self.stops if stop in pending]
+        if cuts:
+            self.stopped = True
+            self.pending = ""
+            self._emit(pending[: min(cuts)])
+            return
+        held = max(
+            (
+                length
+                for stop in self.stops
+                for length in range(1, len(stop))
+                if pending.endswith(stop[:length])
+            ),
+            default=0,
+        )
+        self.pending = pending[len(pending) - held :]
+        self._emit(pending[: len(pending) - held])
+
+    def _emit(self, text: Text) -> None:
+        if text:
+            self.text += text
+            self.on_text(text)
+
+
+def stream_inference(
+    model_name,
+    model,
+    tokenizer,
+    prompt_template: Text,
+    current_dialog: Union[Text, DialogueHistory],
+    on_text: Callable[[Text], None],
+    seed: Optional[int] = None,
+) -> Text:
+    """Inference gpt models like inference(), handing the reasoning to on_text piece by
+       piece while it is generated. Local models stream through a TextIteratorStreamer,
+       the gpt-3 models through a streamed completion.
+
+    Args:
+        model_name (_type_): Name of reasoning model.
+        model (_type_): Reasoning model
+        tokenizer (_type_): Tokenizer of reasonin model.
+        prompt_template (Text): Prompt template.
+        current_dialog (Union[Text, DialogueHistory]): Current updating conversation.
+        on_text (Callable[[Text], None]): Called with every new piece of the reasoning.
+        seed (Optional[int], optional): Seed to sample the response of a local model
+            reproducibly. Defaults to None.
+
+    Returns:
+        Text: The reasoning response, the same as inference() returns.
+    """
+    if is_retrieval_model(model_name):
+        # a retrieved reasoning is there at once, hand it over in one piece
+        response = inference(model_name, model, tokenizer, prompt_template, current_dialog)
+        on_text(response[len(" The seeker ") :])
+        return response
+    template = get_prompt_template(prompt_template)
+    with prompt_lock(model):
+        prompt = reasoning_prompt(model_name, tokenizer, template, current_dialog)
+    # the reasoning ends at the first newline, or where gpt starts the next
+    # conversation, like in reasoning_from_generation
+    stream = StoppedStream(on_text, ["\n", GPT_LINE_END] if model_name == "gpt" else ["\n"])
+
+    response = ""
+    if model_name in ["gpt", "gpt-2"]:
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True)
+        result = {}
+
+        def generate() -> None:
+            try:
+                result["text"] = gpt_text_generate(
+                    prompt,
+                    model,
+                    tokenizer,
+                    seed=seed,
+                    prefix=template.prefix,
+                    template=template.text,
+                    streamer=streamer,
+                )
+            except Exception as error:
+                result["error"] = error
+            finally:
+                # a cached or failed generation streams nothing, end the stream anyway
+                streamer.end()
+
+        thread = threading.Thread(target=generate)
+        thread.start()
+        for text in streamer:
+            stream.put(text)
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        response = reasoning_from_generation(model_name, result["text"])
+    elif model_name in ["ada", "davinci"]:
+        response = stream_gpt_completion(
+            prompt,
+            stream.put,
+            stop_words=['\n'],
+            model_type=model_name,
+            template=template.text,
+        )
+    # hand over what the stream missed or held back, e.g. a response from the
+    # response cache
+    if response.startswith(stream.text) and len(response) > len(stream.text):
+        on_text(response[len(stream.text) :])
+    logger.info(response)
+    return " The seeker " + response
+
+
+def batch_inference(
+    model_name,
+    model,
+    tokenizer,
+    prompt_template: Text,
+    current_dialogs: List[Union[Text, DialogueHistory]],
+    seeds: Optional[List[int]] = None,
+) -> List[Text]:
+    """Inference gpt models for several conversations at once.
+       The local models generate the reasoning of all conversations in one batch,
+       the gpt-3 models are requested one conversation after the other.
+
+    Args:
+        model_name (_type_): Name of reasoning model.
+        model (_type_): Reasoning model
+        tokenizer (_type_): Tokenizer of reasonin model.
+        prompt_template (Text): Prompt template.
+        current_dialogs (List[Union[Text, DialogueHistory]]): The conversations to reason about.
+        seeds (Optional[List[int]], optional): One sampling seed per conversation.
+            Defaults to None.
+
+    Returns:
+        List[Text]: The reasoning responses, in the order of the conversations.
+    """
+    if is_retrieval_model(model_name):
+        responses = model.batch_retrieve(current_dialogs)
+        for response in responses:
+            logger.info(response)
+        return [" The seeker " + response if response else "" for response in responses]
+    if model_name not in ["gpt", "gpt-2"]:
+        return [
+            inference(
+                model_name,
+                model,
+                tokenizer,
+                prompt_template,
+                current_dialog,
+                seed=None if seeds is None else seeds[index],
+            )
+            for index, current_dialog in enumerate(current_dialogs)
+        ]
+    template = get_prompt_template(prompt_template)
+    with prompt_lock(model):
+        prompts = [
+            reasoning_prompt(model_name, tokenizer, template, current_dialog)
+            for current_dialog in current_dialogs
+        ]
+    responses = []
+    for response in batch_reasoning_generate(
+        model_name, prompts, model, tokenizer, seeds=seeds, template=template.text
+    ):
+        logger.info(response)
+        responses.append(" The seeker " + response)
+    return responses
+
+
+def check_batch_inference(
+    model_name,
+    model,
+    tokenizer,
+    prompt_template: Text,
+    current_dialogs: List[Union[Text, DialogueHistory]],
+    seed: int = 0,
+) -> bool:
+    """Check that batch_inference gives the same reasoning as inference one conversation
+       after the other, with the same seeds.
+
+    Args:
+        current_dialogs (List[Union[Text, DialogueHistory]]): The conversations to compare.
+        seed (int, optional): Seed of the first conversation. Defaults to 0.
+
+    Returns:
+        bool: Whether all reasonings are the same.
+    """
+    seeds = [seed + index for index in range(len(current_dialogs))]
+    # compare real generations, not responses from the response cache
+    cache = response_cache
+    set_response_cache(None)
+    try:
+        single = [
+            inference(model_name, model, tokenizer, prompt_template, current_dialog, seed=seed)
+            for current_dialog, seed in zip(current_dialogs, seeds)
+        ]
+        batch = batch_inference(
+            model_name, model, tokenizer, prompt_template, current_dialogs, seeds=seeds
+        )
+    finally:
+        set_response_cache(cache)
+    for index, (one, many) in enumerate(zip(single, batch)):
+        if one != many:
+            logger.warning("batch reasoning %s differs: %r != %r", index, many, one)
+    return single == batch
+
+
 if __name__ == "__main__":
     main()
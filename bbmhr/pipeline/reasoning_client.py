@@ -0,0 +1,44 @@
+import json
+import urllib.request
+from typing import Any, Dict, Optional, Text
+
+
+class ReasoningClient:
+    """Client of a reasoning server started with bbmhr/pipeline/reasoning_server.py.
+
+    Args:
+        url (Text): Base url of the server, e.g. http://localhost:8766.
+        timeout (float, optional): Seconds to wait for a response. Defaults to 600.
+    """
+
+    def __init__(self, url: Text, timeout: float = 600.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def post(self, path: Text, data: Dict[str, Any]) -> Dict[str, Any]:
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(data).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def inference(self, template: Text, current_dialog: Text, seed: Optional[int] = None) -> Text:
+        """Get the reasoning of a conversation, the same as inference of prompting.py.
+
+        Args:
+            template (Text): The prompt template text.
+            current_dialog (Text): Current updating conversation.
+            seed (Optional[int], optional): Seed to sample the response. Defaults to None.
+
+        Returns:
+            Text: The reasoning response, starting with " The seeker ".
+        """
+        return self.post(
+            "/reasoning", {"template": template, "history": current_dialog, "seed": seed}
+        )["response"]
+
+    def generate(self, prompt: Text, seed: Optional[int] = None) -> Text:
+        """Get the generated text of a complete prompt, without the prompt."""
+        return self.post("/generate", {"prompt": prompt, "seed": seed})["response"]
@@ -0,0 +1,212 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Text, Tuple
+
+from bbmhr.pipeline.prompting import (
+    MODEL_DTYPES,
+    PromptTemplate,
+    batch_reasoning_generate,
+    batch_response_generate,
+    load_large_model,
+    logger,
+    reasoning_prompt,
+)
+
+
+class DynamicBatcher:
+    """Collect concurrent generation requests and run them through the model in batches.
+       A batch is closed when it is full or when the batch window after its first
+       request has passed, so a single request waits at most the window.
+
+    Args:
+        model_name (Text): Name of the reasoning model.
+        model: The loaded model.
+        tokenizer: The tokenizer of the model.
+        max_batch_size (int, optional): Largest batch. Defaults to 8.
+        batch_window (float, optional): Seconds to wait for more requests. Defaults to 0.01.
+    """
+
+    def __init__(
+        self,
+        model_name: Text,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        batch_window: float = 0.01,
+    ):
+        self.model_name = model_name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.templates = {}
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+        # the model and the tokenizer are only used from this thread
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, request: Dict[str, Any]) -> Tuple[Text, int]:
+        """Queue a request and wait for its result.
+
+        Args:
+            request (Dict[str, Any]): Either a complete "prompt", or a "template" text with
+                the "history" of the conversation, and an optional "seed".
+
+        Returns:
+            Tuple[Text, int]: The response and the size of the batch it was generated in.
+        """
+        request = dict(request, done=threading.Event())
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["response"], request["batch_size"]
+
+    def _collect(self) -> List[Dict[str, Any]]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _prompt(self, request: Dict[str, Any]) -> Text:
+        if "prompt" in request:
+            return request["prompt"]
+        template = self.templates.get(request["template"])
+        if template is None:
+            template = self.templates[request["template"]] = PromptTemplate(request["template"])
+        return reasoning_prompt(self.model_name, self.tokenizer, template, request["history"])
+
+    def _generate(self, group: List[Dict[str, Any]]) -> None:
+        """Generate the responses of requests of the same kind in one batch."""
+        prompts = [self._prompt(request) for request in group]
+        seeds = [request.get("seed") for request in group]
+        seeds = None if seeds[0] is None else seeds
+        if "template" in group[0]:
+            responses = [
+                " The seeker " + reasoning
+                for reasoning in batch_reasoning_generate(
+                    self.model_name, prompts, self.model, self.tokenizer, seeds=seeds
+                )
+            ]
+        else:
+            responses = batch_response_generate(prompts, self.model, self.tokenizer, seeds=seeds)
+        for request, response in zip(group, responses):
+            request["response"] = response
+            request["batch_size"] = len(group)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            # reasoning and plain generation are cut differently, and an unseeded
+            # request must not take the seeds of the others away
+            groups = {}
+            for request in batch:
+                key = ("template" in request, request.get("seed") is None)
+                groups.setdefault(key, []).append(request)
+            for group in groups.values():
+                try:
+                    self._generate(group)
+                except Exception as error:
+                    logger.exception("generation of a batch of %s requests failed", len(group))
+                    for request in group:
+                        request["error"] = error
+            self.batches += len(groups)
+            self.batched_requests += len(batch)
+            logger.info(
+                "generated %s batches of %s requests, %.2f requests per batch on average",
+                len(groups),
+                len(batch),
+                self.batched_requests / self.batches,
+            )
+            for request in batch:
+                request["done"].set()
+
+
+def make_handler(batcher: DynamicBatcher):
+    """Create a request handler that answers /reasoning and /generate requests."""
+
+    class ReasoningHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                request = json.loads(body or b"{}")
+                if self.path == "/reasoning":
+                    request = {
+                        "template": request["template"],
+                        "history": request["history"],
+                        "seed": request.get("seed"),
+                    }
+                elif self.path == "/generate":
+                    request = {"prompt": request["prompt"], "seed": request.get("seed")}
+                else:
+                    self._send(404, {"error": f"unknown path {self.path}"})
+                    return
+            except (KeyError, ValueError) as error:
+                self._send(400, {"error": f"bad request: {error}"})
+                return
+            try:
+                response, batch_size = batcher.submit(request)
+            except Exception as error:
+                self._send(500, {"error": str(error)})
+                return
+            self._send(200, {"response": response, "batch_size": batch_size})
+
+        def _send(self, status: int, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ReasoningHandler
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name", type=str, default="gpt-2", help="select from ['gpt-j', 'gpt-2', 'gpt', 'distilgpt2']"
+    )
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=list(MODEL_DTYPES), help="type of the model weights"
+    )
+    parser.add_argument("--low_memory", action="store_true", help="memory-map the model weights while loading")
+    parser.add_argument("--host", type=str, default="localhost", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8766, help="port to listen on")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="largest batch of requests")
+    parser.add_argument(
+        "--batch_window_ms", type=float, default=10, help="milliseconds to wait for more requests of a batch"
+    )
+    args = parser.parse_args()
+    if args.model_name in ["ada", "davinci", "gpt-3"]:
+        parser.error("the reasoning server serves local models only")
+    return args
+
+
+if __name__ == "__main__":
+    # point clients at it with --reasoning_server http://<host>:<port>
+    args = add_arguments()
+    model, tokenizer = load_large_model(
+        args.model_name, dtype=MODEL_DTYPES[args.dtype], low_memory=args.low_memory
+    )
+    batcher = DynamicBatcher(
+        args.model_name, model, tokenizer, args.max_batch_size, args.batch_window_ms / 1000
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    print(f"reasoning server listening on {args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Text
+
+
+class ResponseCache:
+    """On-disk cache of expert responses in a SQLite file.
+       Entries are keyed by the model, a hash of the template, the exact prompt and
+       the generation parameters. The least recently used entries are removed when
+       the cache grows over its size limit.
+
+    Args:
+        path (Text): Path of the SQLite file.
+        max_bytes (int, optional): Size limit of the stored responses, 0 for no
+            limit. Defaults to 0.
+        read_only (bool, optional): Only look up responses, never add or update
+            entries, e.g. to replay an earlier run. Defaults to False.
+    """
+
+    def __init__(self, path: Text, max_bytes: int = 0, read_only: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if read_only:
+            self.connection = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+            self.connection.commit()
+        self.total_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(model: Text, template: Text, prompt: Text, params: Dict[str, Any]) -> Text:
+        """Build the content address of a response."""
+        template_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()
+        content = json.dumps([model, template_hash, prompt, params], sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: Text) -> Optional[Any]:
+        """Get a cached response, or None if it is not in the cache."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.connection.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+                self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key: Text, response: Any) -> None:
+        """Store a response and evict old entries if the cache is too large."""
+        if self.read_only:
+            return
+        data = json.dumps(response)
+        size = len(data.encode("utf-8"))
+        with self.lock:
+            old = self.connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time()),
+            )
+            self.total_bytes += size
+            if self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _evict(self) -> None:
+        rows = self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        )
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+        }
+
+    def close(self) -> None:
+        self.connection.close()
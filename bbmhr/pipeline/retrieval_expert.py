@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from typing import List, Optional, Set, Text, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODEL_PREFIX = "retrieval"
+EXPERIMENT_DIR = "./data/experiments/bbmhr/3B"
+SOURCE_PATH = "./data/ESConv_one_speaker_one_turn.json"
+# a closer annotated conversation has a higher cosine similarity. Below this, an
+# off-topic conversation would get the reasoning of an unrelated one
+MIN_SIMILARITY = 0.2
+
+
+def is_retrieval_model(model_name: Text) -> bool:
+    return bool(model_name) and model_name.split(":")[0] == RETRIEVAL_MODEL_PREFIX
+
+
+def history_lines(history) -> List[Text]:
+    """Lines of a conversation given as text or as a DialogueHistory."""
+    if hasattr(history, "lines"):
+        return list(history.lines)
+    return [line for line in history.strip().split("\n") if line]
+
+
+class HashingEncoder:
+    """Embed texts as idf-weighted bags of hashed words and word pairs.
+
+    Args:
+        dimensions (int, optional): Size of the embeddings. Defaults to 1024.
+    """
+
+    def __init__(self, dimensions: int = 1024):
+        self.dimensions = dimensions
+        self.idf = np.ones(dimensions, dtype=np.float32)
+
+    def features(self, text: Text) -> List[int]:
+        words = re.findall(r"[a-z']+", text.lower())
+        grams = words + [a + " " + b for a, b in zip(words, words[1:])]
+        return [zlib.crc32(gram.encode("utf-8")) % self.dimensions for gram in grams]
+
+    def fit(self, texts: List[Text]) -> None:
+        document_frequency = np.zeros(self.dimensions, dtype=np.float32)
+        for text in texts:
+            document_frequency[list(set(self.features(text)))] += 1
+        self.idf = np.log((1 + len(texts)) / (1 + document_frequency)).astype(np.float32) + 1
+
+    def encode(self, texts: List[Text]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            np.add.at(embeddings[row], self.features(text), 1)
+        embeddings *= self.idf
+        return normalize(embeddings)
+
+
+class TransformerEncoder:
+    """Embed texts with the mean of the last hidden states of a small local encoder,
+       e.g. sentence-transformers/all-MiniLM-L6-v2.
+
+    Args:
+        model_name (Text): Name or path of the encoder.
+        batch_size (int, optional): Texts encoded at once. Defaults to 64.
+    """
+
+    def __init__(self, model_name: Text, batch_size: int = 64):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModel.from_pretrained(model_name).eval()
+        self.batch_size = batch_size
+
+    def fit(self, texts: List[Text]) -> None:
+        pass
+
+    def encode(self, texts: List[Text]) -> np.ndarray:
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start : start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=256,
+                return_tensors="pt",
+            )
+            with self.torch.no_grad():
+                hidden = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            batches.append(((hidden * mask).sum(1) / mask.sum(1).clamp(min=1)).numpy())
+        return normalize(np.concatenate(batches).astype(np.float32))
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class RetrievalExpert:
+    """Answer with the stored reasoning of the most similar annotated conversation.
+       The last lines of every annotated conversation are embedded once into a
+       matrix, and a query is a single matrix product, so no generative model runs.
+
+    Args:
+        contexts (List[List[Text]]): Lines of the annotated conversations, e.g. "seeker: ...".
+        responses (List[Text]): The reasoning of every conversation, without "The seeker".
+        encoder (optional): Encoder with fit() and encode(). Defaults to a HashingEncoder.
+        window (int, optional): Number of last lines that are embedded. Defaults to 3.
+        positions (Optional[List[int]], optional): Index of every conversation in the
+            annotated data, e.g. the "index" of the evaluation samples. Defaults to None.
+        dialogs (Optional[List[int]], optional): Dialogue of every conversation.
+            Defaults to None.
+        min_similarity (float, optional): Smallest cosine similarity of a retrieved
+            conversation, no reasoning is given below it. Defaults to 0.2.
+    """
+
+    def __init__(
+        self,
+        contexts: List[List[Text]],
+        responses: List[Text],
+        encoder=None,
+        window: int = 3,
+        positions: Optional[List[int]] = None,
+        dialogs: Optional[List[int]] = None,
+        min_similarity: float = MIN_SIMILARITY,
+    ):
+        self.encoder = encoder if encoder is not None else HashingEncoder()
+        self.window = window
+        self.responses = responses
+        self.positions = positions if positions is not None else list(range(len(responses)))
+        self.dialogs = dialogs
+        self.min_similarity = min_similarity
+        windows = [self.window_text(lines) for lines in contexts]
+        self.encoder.fit(windows)
+        self.index = self.encoder.encode(windows)
+
+    def window_text(self, lines: List[Text]) -> Text:
+        return "\n".join(lines[-self.window :])
+
+    def nearest(
+        self, histories: List, exclude: Optional[List[Set[int]]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the most similar annotated conversation of every history.
+
+        Args:
+            histories (List): Conversations as text or DialogueHistory.
+            exclude (Optional[List[Set[int]]], optional): Rows of the index not to return
+                for every history, e.g. the conversation itself in an evaluation.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Rows of the nearest conversations in the index
+                and their cosine similarities.
+        """
+        queries = self.encoder.encode([self.window_text(history_lines(h)) for h in histories])
+        scores = queries @ self.index.T
+        if exclude:
+            for row, excluded in enumerate(exclude):
+                scores[row, list(excluded)] = -np.inf
+        rows = scores.argmax(axis=1)
+        return rows, scores[np.arange(len(histories)), rows]
+
+    def batch_retrieve(self, histories: List, exclude: Optional[List[Set[int]]] = None) -> List[Text]:
+        """Get the stored reasoning of every history, "" where no annotated conversation
+           is similar enough."""
+        rows, scores = self.nearest(histories, exclude)
+        return [
+            self.responses[row] if score >= self.min_similarity else ""
+            for row, score in zip(rows, scores)
+        ]
+
+    def retrieve(self, history) -> Text:
+        return self.batch_retrieve([history])[0]
+
+
+def annotated_contexts(source_path: Text, number: int) -> Tuple[List[List[Text]], List[int]]:
+    """Rebuild the conversation of every seeker turn of the source data, in the order
+       assembly_prompt annotated them, together with the index of their dialogue. The
+       source data is streamed and only read up to the last annotated turn."""
+    # prompting imports this module
+    from bbmhr.pipeline.prompting import iter_source_data
+
+    contexts, dialogs = [], []
+    for dialog_index, data in enumerate(iter_source_data(source_path)):
+        lines = []
+        for utterance in data["conversation"]:
+            lines.append(utterance["speaker"] + ": " + utterance["content"])
+            if utterance["speaker"] == "seeker":
+                contexts.append(list(lines))
+                dialogs.append(dialog_index)
+                if len(contexts) == number:
+                    return contexts, dialogs
+    return contexts, dialogs
+
+
+def annotation_path(annotations: Text) -> Text:
+    """Response file of an expert name, e.g. davinci, or a path to a response jsonl."""
+    if annotations.endswith(".jsonl"):
+        return annotations
+    return os.path.join(EXPERIMENT_DIR, annotations, "train_response_b0_14.jsonl")
+
+
+def strip_seeker(reasoning: Text) -> Text:
+    """Remove the "the seeker" that the reasoning of some experts, e.g. gpt_1, starts with."""
+    return re.sub(r"^[\s,]*the seeker\b", "", reasoning, flags=re.IGNORECASE).strip()
+
+
+def read_annotations(response_path: Text) -> List[Text]:
+    with open(response_path, "r", encoding="utf-8") as response_file:
+        return [strip_seeker(json.loads(line)["response"].split("\n")[0]) for line in response_file]
+
+
+def load_retrieval_expert(
+    model_name: Text = RETRIEVAL_MODEL_PREFIX,
+    source_path: Text = SOURCE_PATH,
+    min_similarity: float = MIN_SIMILARITY,
+) -> RetrievalExpert:
+    """Build a retrieval expert from a model name "retrieval[:<annotations>[:<encoder>]]".
+
+    Args:
+        model_name (Text, optional): The annotations are an expert of
+            data/experiments/bbmhr/3B or a response jsonl, davinci by default. The
+            encoder is a local transformer encoder, hashed words by default.
+        source_path (Text, optional): The ESConv source data the responses annotate.
+        min_similarity (float, optional): See RetrievalExpert. Defaults to 0.2.
+
+    Returns:
+        RetrievalExpert: The expert.
+    """
+    parts = model_name.split(":", 2)
+    annotations = parts[1] if len(parts) > 1 and parts[1] else "davinci"
+    encoder = TransformerEncoder(parts[2]) if len(parts) > 2 and parts[2] else HashingEncoder()
+    start = time.perf_counter()
+    responses = read_annotations(annotation_path(annotations))
+    contexts, dialogs = annotated_contexts(source_path, len(responses))
+    responses = responses[: len(contexts)]
+    # turns without an annotation are not worth retrieving
+    kept = [position for position, response in enumerate(responses) if response]
+    expert = RetrievalExpert(
+        [contexts[position] for position in kept],
+        [responses[position] for position in kept],
+        encoder,
+        positions=kept,
+        dialogs=[dialogs[position] for position in kept],
+        min_similarity=min_similarity,
+    )
+    logger.info(
+        "indexed %s annotated turns of %s in %.1fs", len(kept), annotations, time.perf_counter() - start
+    )
+    return expert
@@ -0,0 +1,153 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from itertools import islice
+from typing import Dict, Iterable, List, Text, Tuple
+
+import torch
+
+from bbmhr.pipeline.prompting import (
+    MODEL_DTYPES,
+    add_arguments,
+    annotate,
+    assembly_prompt,
+    configure_experts,
+    dump_response,
+    iter_source_data,
+    load_large_model,
+    load_template,
+    logger,
+    response_path,
+    seeker_utterances_only,
+    source_data_path,
+)
+
+
+def split_dialogs(
+    source_data: Iterable[Dict[Text, Text]], num_shards: int
+) -> List[Tuple[int, int, int]]:
+    """Split the dialogues into contiguous shards with about the same number of seeker turns.
+
+    Args:
+        source_data (Iterable[Dict[str, str]]): The dialogue data to annotate.
+        num_shards (int): The number of shards.
+
+    Returns:
+        List[Tuple[int, int, int]]: First dialogue, end dialogue and index of the first
+            prompt of every shard.
+    """
+    turn_counts = [
+        sum(1 for utterance in data["conversation"] if utterance["speaker"] == "seeker")
+        for data in source_data
+    ]
+    total = sum(turn_counts)
+    shards = []
+    dialog_start, prompt_start, seen = 0, 0, 0
+    for dialog_index, count in enumerate(turn_counts):
+        seen += count
+        # close the shard once it reaches its share of all seeker turns
+        if seen >= total * (len(shards) + 1) / num_shards and len(shards) < num_shards - 1:
+            shards.append((dialog_start, dialog_index + 1, prompt_start))
+            dialog_start, prompt_start = dialog_index + 1, seen
+    shards.append((dialog_start, len(turn_counts), prompt_start))
+    return shards
+
+
+def shard_path(path: Text, shard_index: int) -> Text:
+    return path + f".shard{shard_index}.jsonl"
+
+
+def annotate_shard(
+    args, shard_index: int, dialog_start: int, dialog_end: int, prompt_start: int, threads: int
+) -> None:
+    """Annotate one shard of the dialogues in a worker process."""
+    torch.set_num_threads(threads)
+    configure_experts(args)
+    template = load_template(args)
+    source_data = islice(
+        iter_source_data(source_data_path, dialog_start), dialog_end - dialog_start
+    )
+    response_file = open(
+        shard_path(response_path + args.response_suffix, shard_index), "w+", encoding="utf-8"
+    )
+    seeker_only_file = open(
+        shard_path(seeker_utterances_only + args.response_suffix, shard_index),
+        "w+",
+        encoding="utf-8",
+    )
+    model, tokenizer = load_large_model(
+        args.model_name, dtype=MODEL_DTYPES[args.dtype], low_memory=args.low_memory
+    )
+    logger.info(
+        "shard %s annotates dialogs %s to %s", shard_index, dialog_start, dialog_end
+    )
+    prompt_generator = assembly_prompt(
+        template, source_data=source_data, seeker_only_file=seeker_only_file
+    )
+
+    def write_response(response: Text) -> None:
+        logger.info(response)
+        dump_response(response, response_file)
+
+    # prompts keep their global index, so seeded runs match the single process run
+    annotate(
+        args, template, prompt_generator, model, tokenizer, write_response, prompt_start
+    )
+    response_file.close()
+    seeker_only_file.close()
+
+
+def merge_shards(path: Text, num_shards: int) -> None:
+    """Concatenate the shard files in shard order and remove them."""
+    with open(path + ".jsonl", "w+", encoding="utf-8") as merged_file:
+        for shard_index in range(num_shards):
+            with open(shard_path(path, shard_index), "r", encoding="utf-8") as shard_file:
+                shutil.copyfileobj(shard_file, merged_file)
+    for shard_index in range(num_shards):
+        os.remove(shard_path(path, shard_index))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_workers", type=int, default=2, help="number of annotation processes"
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=0,
+        help="torch threads of each worker, 0 to share all cores evenly",
+    )
+    args = add_arguments(parser)
+    if args.use_dialog or args.start_index or args.sample_number or args.checkpoint:
+        parser.error("the sharded runner annotates the whole source data only")
+    threads = args.threads_per_worker or max(1, os.cpu_count() // args.num_workers)
+
+    shards = split_dialogs(iter_source_data(source_data_path), args.num_workers)
+    logger.info("split source data into shards %s", json.dumps(shards))
+    start = time.time()
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for shard_index, (dialog_start, dialog_end, prompt_start) in enumerate(shards):
+        worker = context.Process(
+            target=annotate_shard,
+            args=(args, shard_index, dialog_start, dialog_end, prompt_start, threads),
+        )
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    failed = [index for index, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"annotation of shards {failed} failed, shards are not merged")
+
+    merge_shards(response_path + args.response_suffix, len(shards))
+    merge_shards(seeker_utterances_only + args.response_suffix, len(shards))
+    logger.info("annotated %s shards in %.1fs", len(shards), time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List, Text
+
+from bbmhr.pipeline.prompting import (
+    assembly_prompt,
+    get_prompt_template,
+    read_source_data,
+    source_data_path,
+)
+
+
+def concatenating_assembly_prompt(prompt: Text, source_data: List[Dict[Text, Any]]) -> Iterator[Text]:
+    """The former assembly: grow the history by concatenation and replace the placeholder
+       in the full template for every seeker turn.
+    """
+    for data in source_data:
+        current_dialog = ""
+        for utterance in data["conversation"]:
+            current_dialog += utterance["speaker"] + ": " + utterance["content"] + "\n"
+            if utterance["speaker"] == "seeker":
+                yield prompt.replace("<conversation>", current_dialog)
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--prompt_template",
+        type=str,
+        default="./bbmhr/prompt_templates/nl_gpt_1.txt",
+        help="template to fill",
+    )
+    parser.add_argument("--source_data", type=str, default=source_data_path, help="ESConv source json")
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the source data")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = add_arguments()
+    template = get_prompt_template(args.prompt_template)
+    source_data = read_source_data(args.source_data)
+    runs = {
+        "concatenate": lambda: concatenating_assembly_prompt(template.text, source_data),
+        "join": lambda: assembly_prompt(template, source_data),
+    }
+    assert list(runs["concatenate"]()) == list(runs["join"]()), "assembled prompts differ"
+    for name, run in runs.items():
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = sum(1 for _ in run())
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        for _ in run():
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{name:12s} {count} prompts, best of {args.repeat}: {best * 1000:.1f} ms "
+            f"({best / count * 1e6:.2f} us/prompt), peak traced memory {peak / 1024:.0f} KiB"
+        )
@@ -0,0 +1,116 @@
+import argparse
+import json
+import time
+from typing import Dict, List, Set, Text
+
+from evaluate_reasoning import calculate_score
+from bbmhr.pipeline.retrieval_expert import MIN_SIMILARITY, load_retrieval_expert, strip_seeker
+
+
+def read_samples(sample_path: Text, number: int) -> List[Dict]:
+    samples = []
+    with open(sample_path, "r", encoding="utf-8") as file:
+        for line in file.readlines():
+            samples.append(json.loads(line.strip()))
+    return samples[:number] if number else samples
+
+
+def sample_history(sample: Dict) -> Text:
+    """The conversation of a sample, without the reasoning prompt it ends with."""
+    return sample["content"]["dialog"].strip().split("\nIn this conversation, the seeker")[0]
+
+
+def excluded_rows(expert, samples: List[Dict], exclude_dialog: bool) -> List[Set[int]]:
+    """Rows of the index that must not answer a sample: its own annotated turn, and the
+    whole dialogue of it with exclude_dialog."""
+    rows = {position: row for row, position in enumerate(expert.positions)}
+    excluded = []
+    for sample in samples:
+        own = {rows[sample["index"]]} if sample["index"] in rows else set()
+        if exclude_dialog and own:
+            dialog = expert.dialogs[next(iter(own))]
+            own = {row for row, other in enumerate(expert.dialogs) if other == dialog}
+        excluded.append(own)
+    return excluded
+
+
+def score(responses: List[Text], references: List[Text]) -> Text:
+    return (
+        f"bleu {float(calculate_score(responses, [[r] for r in references], 'bleu')):.4f}, "
+        f"rougeL {float(calculate_score(responses, references, 'rouge')['rougeL_fmeasure']):.4f}"
+    )
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="retrieval",
+        help="retrieval[:<expert>[:<encoder>]], e.g. retrieval:davinci:sentence-transformers/all-MiniLM-L6-v2",
+    )
+    parser.add_argument(
+        "--source_path",
+        type=str,
+        default="./data/ESConv_one_speaker_one_turn.json",
+        help="the ESConv data the stored reasoning annotates",
+    )
+    parser.add_argument(
+        "--sample_path",
+        type=str,
+        default="./eval/reasoning_evaluation/samples.jsonl",
+        help="samples with human reasoning",
+    )
+    parser.add_argument("--sample_number", type=int, default=0, help="samples to compare, 0 for all")
+    parser.add_argument(
+        "--min_similarity",
+        type=float,
+        default=MIN_SIMILARITY,
+        help="smallest cosine similarity of a retrieved conversation, no reasoning below it",
+    )
+    parser.add_argument(
+        "--exclude_dialog",
+        action="store_true",
+        help="never retrieve from the dialogue of a sample, not only from its own turn",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    # run from the repository root: python bbmhr/tools/benchmark_retrieval_expert.py
+    args = add_arguments()
+    start = time.perf_counter()
+    expert = load_retrieval_expert(args.model_name, args.source_path, args.min_similarity)
+    print(f"indexed {len(expert.responses)} annotated turns in {time.perf_counter() - start:.1f}s")
+    samples = read_samples(args.sample_path, args.sample_number)
+    references = ["the seeker " + sample["content"]["human"] for sample in samples]
+    # the samples are annotated turns, retrieving their own reasoning would be cheating
+    excluded = excluded_rows(expert, samples, args.exclude_dialog)
+
+    responses, latencies = [], []
+    for sample, exclude in zip(samples, excluded):
+        start = time.perf_counter()
+        response = expert.batch_retrieve([sample_history(sample)], [exclude])[0]
+        latencies.append(time.perf_counter() - start)
+        responses.append("the seeker " + response)
+    start = time.perf_counter()
+    expert.batch_retrieve([sample_history(sample) for sample in samples], excluded)
+    batch_latency = time.perf_counter() - start
+
+    unanswered = sum(1 for response in responses if response == "the seeker ")
+    print(
+        f"retrieval: {score(responses, references)}, {unanswered} turns below the similarity "
+        f"floor, latency p50 "
+        f"{percentile(latencies, 0.5) * 1000:.2f} ms, p95 {percentile(latencies, 0.95) * 1000:.2f} ms "
+        f"per turn, {batch_latency * 1000:.2f} ms for all {len(samples)} turns at once"
+    )
+    # the generated reasoning stored with the samples, for comparison
+    for name in ["gpt_1", "gpt_2", "ada", "davinci"]:
+        stored = ["the seeker " + strip_seeker(sample["content"][name]) for sample in samples]
+        print(f"{name}: {score(stored, references)}")
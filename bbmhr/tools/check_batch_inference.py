@@ -0,0 +1,55 @@
+import argparse
+import json
+from typing import List, Text
+
+from bbmhr.pipeline.prompting import check_batch_inference, load_large_model
+
+
+def read_dialogs(sample_path: Text, number: int) -> List[Text]:
+    dialogs = []
+    with open(sample_path, "r", encoding="utf-8") as file:
+        for line in file.readlines():
+            dialog = json.loads(line.strip())["content"]["dialog"].strip()
+            dialogs.append(dialog.split("\nIn this conversation, the seeker")[0])
+    return dialogs[:number]
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_names", type=str, default="gpt,gpt-2", help="comma separated local reasoning models"
+    )
+    parser.add_argument(
+        "--prompt_template",
+        type=str,
+        default="./bbmhr/prompt_templates/nl_gpt_2.txt",
+        help="prompt template to use",
+    )
+    parser.add_argument(
+        "--sample_path",
+        type=str,
+        default="./eval/reasoning_evaluation/samples.jsonl",
+        help="dialogues to reason about",
+    )
+    parser.add_argument("--sample_number", type=int, default=8, help="dialogues in the batch")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first dialogue")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    # run from the repository root: python bbmhr/tools/check_batch_inference.py
+    args = add_arguments()
+    dialogs = read_dialogs(args.sample_path, args.sample_number)
+    failed = []
+    for model_name in args.model_names.split(","):
+        model, tokenizer = load_large_model(model_name)
+        same = check_batch_inference(
+            model_name, model, tokenizer, args.prompt_template, dialogs, seed=args.seed
+        )
+        print(f"{model_name}: batch reasoning {'matches' if same else 'differs from'} single reasoning")
+        if not same:
+            failed.append(model_name)
+        del model
+    if failed:
+        raise SystemExit(1)
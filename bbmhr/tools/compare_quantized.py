@@ -0,0 +1,92 @@
+import argparse
+import json
+import time
+from typing import Dict, List, Text
+
+import torch
+
+from evaluate_reasoning import calculate_score
+from bbmhr.pipeline.prompting import inference, load_large_model
+
+
+def read_samples(sample_path: Text, number: int) -> List[Dict[Text, Text]]:
+    samples = []
+    with open(sample_path, "r", encoding="utf-8") as file:
+        for line in file.readlines():
+            samples.append(json.loads(line.strip())["content"])
+    return samples[:number] if number else samples
+
+
+def generate_reasoning(args, model, tokenizer, samples: List[Dict[Text, Text]]):
+    """Generate the reasoning of every sample and time each turn."""
+    responses = []
+    latencies = []
+    for index, sample in enumerate(samples):
+        start = time.perf_counter()
+        response = inference(
+            args.model_name,
+            model,
+            tokenizer,
+            args.prompt_template,
+            sample["dialog"].strip(),
+            seed=args.seed + index,
+        )
+        latencies.append(time.perf_counter() - start)
+        # same form as the human references of calculate_score
+        responses.append(response.strip().replace("The seeker", "the seeker", 1))
+    return responses, latencies
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name", type=str, default="gpt-2", help="select from ['gpt-j', 'gpt-2', 'gpt']"
+    )
+    parser.add_argument(
+        "--prompt_template",
+        type=str,
+        default="./bbmhr/prompt_templates/nl_gpt_2.txt",
+        help="prompt template to use",
+    )
+    parser.add_argument(
+        "--sample_path",
+        type=str,
+        default="./eval/reasoning_evaluation/samples.jsonl",
+        help="samples with human reasoning",
+    )
+    parser.add_argument("--sample_number", type=int, default=0, help="samples to compare, 0 for all")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first sample")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 for the default")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    # run from the repository root: python bbmhr/tools/compare_quantized.py
+    args = add_arguments()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    samples = read_samples(args.sample_path, args.sample_number)
+    references = ["the seeker " + sample["human"] for sample in samples]
+
+    results = {}
+    for dtype in [None, torch.qint8]:
+        model, tokenizer = load_large_model(args.model_name, dtype=dtype)
+        results[dtype] = generate_reasoning(args, model, tokenizer, samples)
+        del model
+
+    fp32_responses, fp32_latencies = results[None]
+    int8_responses, int8_latencies = results[torch.qint8]
+    for name, (responses, latencies) in [("fp32", results[None]), ("int8", results[torch.qint8])]:
+        print(
+            f"{name}: bleu {float(calculate_score(responses, [[r] for r in references], 'bleu')):.4f}, "
+            f"rougeL {float(calculate_score(responses, references, 'rouge')['rougeL_fmeasure']):.4f}, "
+            f"mean latency {sum(latencies) / len(latencies) * 1000:.0f} ms per turn"
+        )
+    # how far the quantized reasoning drifts from the fp32 reasoning of the same seed
+    agreement = calculate_score(int8_responses, [[r] for r in fp32_responses], "bleu")
+    identical = sum(a == b for a, b in zip(int8_responses, fp32_responses))
+    print(
+        f"int8 vs fp32: bleu {float(agreement):.4f}, {identical}/{len(samples)} identical, "
+        f"speedup {sum(fp32_latencies) / sum(int8_latencies):.2f}x"
+    )
@@ -0,0 +1,113 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(delay: float, rate_limit_every: int, completion: str, stream_delay: float = 0.05):
+    """Create a request handler that answers completion requests like the OpenAI api.
+
+    Args:
+        delay (float): Seconds to wait before answering a request.
+        rate_limit_every (int): Answer every n-th request with a 429 error, 0 for never.
+        completion (str): Text returned as completion.
+        stream_delay (float, optional): Seconds between the words of a streamed answer.
+            Defaults to 0.05.
+    """
+    lock = threading.Lock()
+    counter = {"requests": 0}
+
+    class FakeCompletionHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            request = json.loads(body or b"{}")
+            with lock:
+                counter["requests"] += 1
+                number = counter["requests"]
+            time.sleep(delay)
+            if rate_limit_every and number % rate_limit_every == 0:
+                self._send(429, {"error": {"message": "Rate limit reached", "type": "requests"}})
+                return
+            # echo the end of the prompt so that clients can check the order of results
+            text = completion + " " + request.get("prompt", "").strip().split("\n")[-1]
+            if request.get("stream"):
+                self._stream(number, text)
+                return
+            self._send(
+                200,
+                {
+                    "id": f"cmpl-{number}",
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": self.path.split("/")[-2],
+                    "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                },
+            )
+
+        def _send(self, status: int, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, number: int, text: str):
+            # server-sent events of one word each, like a streamed completion
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for index, word in enumerate(text.split(" ")):
+                event = {
+                    "id": f"cmpl-{number}",
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": self.path.split("/")[-2],
+                    "choices": [
+                        {
+                            "text": (" " if index else "") + word,
+                            "index": 0,
+                            "logprobs": None,
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(stream_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeCompletionHandler
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds before each answer")
+    parser.add_argument(
+        "--rate_limit_every", type=int, default=0, help="answer every n-th request with 429"
+    )
+    parser.add_argument(
+        "--stream_delay", type=float, default=0.05, help="seconds between streamed words"
+    )
+    parser.add_argument(
+        "--completion", type=str, default="feels fine.", help="text returned as completion"
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    # run prompting.py with --api_base http://localhost:<port>/v1 to annotate against this server
+    args = add_arguments()
+    server = ThreadingHTTPServer(
+        ("localhost", args.port),
+        make_handler(args.delay, args.rate_limit_every, args.completion, args.stream_delay),
+    )
+    print(f"fake completion server listening on port {args.port}")
+    server.serve_forever()
@@ -4,7 +4,7 @@ import random
 import numpy as np
 from typing import Dict, List, Text
 from collections import Counter
-from bbmhr.pipeline.prompting import assembly_prompt, read_source_data
+from bbmhr.pipeline.prompting import assembly_prompt, iter_source_data
 
 
 def process_response(response: Text, task: Text) -> Text:
@@ -35,7 +35,7 @@ def pick_up_sample_conversations(sample_file_path, sample_number: int = 100):
     template_file = open(prompt_path, "r", encoding="utf-8")
     fixed_prompt = template_file.read()
     source_data_path = './data/ESConv_one_speaker_one_turn.json'
-    source_data = read_source_data(source_data_path)
+    source_data = iter_source_data(source_data_path)
     
     dialogue_list = []
     prompt_generator = assembly_prompt(fixed_prompt, source_data=source_data)
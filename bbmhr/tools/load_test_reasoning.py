@@ -0,0 +1,90 @@
+import argparse
+import json
+import threading
+import time
+from typing import List, Text
+
+from bbmhr.pipeline.reasoning_client import ReasoningClient
+
+
+def read_dialogs(sample_path: Text) -> List[Text]:
+    dialogs = []
+    with open(sample_path, "r", encoding="utf-8") as file:
+        for line in file.readlines():
+            dialogs.append(json.loads(line.strip())["content"]["dialog"].strip())
+    return dialogs
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def add_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://localhost:8766", help="reasoning server url")
+    parser.add_argument("--clients", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--requests_per_client", type=int, default=10, help="requests sent by each client")
+    parser.add_argument(
+        "--prompt_template",
+        type=str,
+        default="./bbmhr/prompt_templates/nl_gpt_2.txt",
+        help="prompt template to send",
+    )
+    parser.add_argument(
+        "--sample_path",
+        type=str,
+        default="./eval/reasoning_evaluation/samples.jsonl",
+        help="dialogues to send as history",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = add_arguments()
+    with open(args.prompt_template, "r", encoding="utf-8") as file:
+        template = file.read()
+    dialogs = read_dialogs(args.sample_path)
+    client = ReasoningClient(args.url)
+    latencies = []
+    batch_sizes = []
+    errors = []
+    lock = threading.Lock()
+
+    def run_client(client_index: int) -> None:
+        for request_index in range(args.requests_per_client):
+            number = client_index * args.requests_per_client + request_index
+            start = time.perf_counter()
+            try:
+                result = client.post(
+                    "/reasoning",
+                    {"template": template, "history": dialogs[number % len(dialogs)], "seed": number},
+                )
+            except Exception as error:
+                with lock:
+                    errors.append(error)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                batch_sizes.append(result["batch_size"])
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_client, args=(index,)) for index in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        print(f"first error: {errors[0]!r}")
+    print(f"{len(latencies)} requests from {args.clients} clients in {elapsed:.1f}s, {len(errors)} errors")
+    if latencies:
+        print(f"throughput {len(latencies) / elapsed:.2f} requests/s")
+        print(
+            f"latency p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms"
+        )
+        print(f"mean batch size {sum(batch_sizes) / len(batch_sizes):.2f}")
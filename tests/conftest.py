@@ -0,0 +1,76 @@
+import glob
+import json
+import os
+import string
+import tempfile
+
+import pytest
+
+# bbmhr.pipeline.prompting logs to ./log from the moment it is imported
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp())
+os.makedirs("log")
+
+TEMPLATE_DIR = os.path.join(REPO_DIR, "bbmhr", "prompt_templates")
+GPT_WORDS = ["conversation", "seeker", "supporter", "the", "in", "this", "feels", "should", "and"]
+
+
+@pytest.fixture(scope="session")
+def tiny_gpt2():
+    """A randomly initialised two-layer gpt-2 with a byte-level tokenizer trained on the
+       prompt templates, so that nothing is downloaded."""
+    torch = pytest.importorskip("torch")
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    trainer = ByteLevelBPETokenizer()
+    trainer.train(
+        sorted(glob.glob(os.path.join(TEMPLATE_DIR, "*.txt"))),
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        show_progress=False,
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=trainer._tokenizer,
+        eos_token="<|endoftext|>",
+        bos_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+    )
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=2048,
+        n_embd=32,
+        n_layer=2,
+        n_head=2,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    return GPT2LMHeadModel(config).eval(), tokenizer
+
+
+@pytest.fixture(scope="session")
+def tiny_gpt(tmp_path_factory):
+    """A randomly initialised two-layer openai-gpt. Like the real one, its tokenizer
+       lower-cases the text and drops newlines."""
+    torch = pytest.importorskip("torch")
+    from transformers import OpenAIGPTConfig, OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+
+    characters = string.ascii_lowercase + string.digits + string.punctuation
+    tokens = ["<unk>"] + [token for c in characters for token in (c, c + "</w>")]
+    merges = []
+    for word in GPT_WORDS:
+        for end in range(2, len(word) + 1):
+            merge = (word[: end - 1], word[end - 1] + ("</w>" if end == len(word) else ""))
+            if " ".join(merge) not in merges:
+                merges.append(" ".join(merge))
+                tokens.append("".join(merge))
+    path = tmp_path_factory.mktemp("tiny_gpt")
+    with open(path / "vocab.json", "w", encoding="utf-8") as vocab_file:
+        json.dump({token: index for index, token in enumerate(tokens)}, vocab_file)
+    with open(path / "merges.txt", "w", encoding="utf-8") as merges_file:
+        merges_file.write("#version: 0.2\n" + "\n".join(merges) + "\n")
+    tokenizer = OpenAIGPTTokenizer(str(path / "vocab.json"), str(path / "merges.txt"))
+    torch.manual_seed(0)
+    config = OpenAIGPTConfig(vocab_size=len(tokenizer), n_positions=2048, n_embd=32, n_layer=2, n_head=2)
+    return OpenAIGPTLMHeadModel(config).eval(), tokenizer
@@ -0,0 +1,41 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import openai
+import pytest
+
+from bbmhr.pipeline.async_completion import complete_in_order
+from bbmhr.pipeline.prompting import completion_params
+from bbmhr.pipeline.response_cache import ResponseCache
+from bbmhr.tools.fake_completion_server import make_handler
+
+PROMPTS = [f"Conversation:\nseeker: turn {index}" for index in range(8)]
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    server = ThreadingHTTPServer(("localhost", 0), make_handler(0.05, 3, "feels fine."))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai, "api_base", f"http://localhost:{server.server_address[1]}/v1")
+    monkeypatch.setattr(openai, "api_key", "test")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_completions_are_written_in_prompt_order(fake_server, tmp_path):
+    params = completion_params("ada", stop_words=["\n"])
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    responses = []
+    stats = complete_in_order(PROMPTS, params, responses.append, max_in_flight=4, cache=cache)
+    # the fake server ends every completion with the last line of its prompt
+    assert responses == [f"feels fine. seeker: turn {index}" for index in range(len(PROMPTS))]
+    assert stats["requests"] == len(PROMPTS)
+    assert stats["rate_limited"] > 0 and stats["retries"] == stats["rate_limited"]
+
+    # a second run is answered from the cache
+    cached = []
+    stats = complete_in_order(PROMPTS, params, cached.append, max_in_flight=4, cache=cache)
+    assert cached == responses
+    assert stats == {"requests": 0, "retries": 0, "rate_limited": 0}
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bbmhr.pipeline.prompting import (
+    batch_response_generate,
+    gpt_text_generate,
+    response_from_generation,
+)
+from bbmhr.pipeline.reasoning_server import DynamicBatcher
+
+PROMPTS = [
+    "Conversation:\nseeker: Hello.\nIn this conversation, the seeker",
+    "Conversation:\nsupporter: How are you?\nseeker: I feel Sad, my dog died.\nIn this conversation, the seeker",
+    "Conversation:\nseeker: I lost my JOB today and I am worried.\nIn this conversation, the seeker",
+]
+SEEDS = [3, 4, 5]
+
+
+@pytest.fixture(params=["gpt", "gpt-2"])
+def tiny_model(request):
+    return request.getfixturevalue("tiny_gpt" if request.param == "gpt" else "tiny_gpt2")
+
+
+def single_responses(model, tokenizer):
+    return [
+        response_from_generation(tokenizer, prompt, gpt_text_generate(prompt, model, tokenizer, seed=seed))
+        for prompt, seed in zip(PROMPTS, SEEDS)
+    ]
+
+
+def test_batch_responses_match_single_responses(tiny_model):
+    model, tokenizer = tiny_model
+    assert batch_response_generate(PROMPTS, model, tokenizer, seeds=SEEDS) == single_responses(
+        model, tokenizer
+    )
+
+
+def test_server_responses_match_single_responses(tiny_model):
+    model, tokenizer = tiny_model
+    batcher = DynamicBatcher("gpt-2", model, tokenizer, batch_window=0.5)
+    with ThreadPoolExecutor(len(PROMPTS)) as executor:
+        results = list(
+            executor.map(
+                lambda item: batcher.submit({"prompt": item[0], "seed": item[1]}), zip(PROMPTS, SEEDS)
+            )
+        )
+    assert [response for response, _ in results] == single_responses(model, tokenizer)
+    assert max(batch_size for _, batch_size in results) > 1
+
+
+def test_gpt_response_starts_after_the_prompt(tiny_gpt):
+    model, tokenizer = tiny_gpt
+    generated = gpt_text_generate(PROMPTS[1], model, tokenizer, seed=0)
+    response = response_from_generation(tokenizer, PROMPTS[1], generated)
+    # gpt decodes the prompt lower-cased and without newlines
+    decoded_prompt = (
+        "conversation : supporter : how are you ? seeker : i feel sad , my dog died . "
+        "in this conversation , the seeker"
+    )
+    assert generated == decoded_prompt + response
+
+
+def test_gpt_response_loses_the_stop_tail(tiny_gpt):
+    _, tokenizer = tiny_gpt
+    prompt = PROMPTS[0]
+    decoded_prompt = tokenizer.decode(tokenizer(prompt)["input_ids"])
+    generated = decoded_prompt + " feels happy . conversation :"
+    # joint_learning only cuts annotations at a newline, which gpt never produces
+    assert response_from_generation(tokenizer, prompt, generated) == " feels happy . "
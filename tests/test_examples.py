@@ -0,0 +1,85 @@
+import argparse
+import json
+
+from bbmhr.pipeline.prompting import (
+    ExampleIndex,
+    PromptTemplate,
+    few_shot_template,
+    load_template,
+    pick_up_examples,
+)
+
+TEMPLATE_TEXT = (
+    "Given a conversation, predict the emotion.\n"
+    "Conversation:\nseeker: hello.\nIn this conversation, the seeker did greeting.\n"
+    "Conversation:\n<conversation>In this conversation, the seeker"
+)
+POOL = [
+    {
+        "emotion_type": emotion,
+        "problem_type": problem,
+        "conversation": [
+            {"speaker": "supporter", "content": "How are you?"},
+            {"speaker": "seeker", "content": f"I am {emotion}, {problem} {n}."},
+        ],
+    }
+    for n in range(3)
+    for emotion, problem in [("sad", "job crisis"), ("anxious", "breakup"), ("angry", "conflict")]
+]
+
+
+def test_picks_are_distinct_and_seeded():
+    index = ExampleIndex(POOL)
+    examples = index.pick(3, seed=1)
+    assert examples == index.pick(3, seed=1)
+    assert len({(e["emotion_type"], e["problem_type"]) for e in examples}) == 3
+    # fewer types than examples are filled up with other examples
+    assert len(index.pick(5, seed=1)) == 5
+
+
+def test_pick_up_examples_reuses_the_index(monkeypatch):
+    pool = list(POOL)
+    built = []
+    init = ExampleIndex.__init__
+
+    def counting_init(self, test_data):
+        built.append(test_data)
+        init(self, test_data)
+
+    monkeypatch.setattr(ExampleIndex, "__init__", counting_init)
+    for seed in range(5):
+        pick_up_examples(pool, 2, seed=seed)
+    assert len(built) == 1
+    pick_up_examples(list(POOL), 2, seed=0)
+    assert len(built) == 2
+
+
+def test_few_shot_template_adds_blocks_before_the_conversation():
+    template = PromptTemplate(TEMPLATE_TEXT)
+    examples = POOL[:2]
+    extended = few_shot_template(template, examples)
+    prompt = extended.fill("seeker: hi.\n")
+    head, conversation = prompt.rsplit("Conversation:\n", 1)
+    assert conversation == "seeker: hi.\nIn this conversation, the seeker"
+    assert head.startswith(template.prefix[: -len("Conversation:\n")])
+    assert head.endswith(
+        "Conversation:\nsupporter: How are you?\nseeker: I am anxious, breakup 0.\n"
+        "In this conversation, the seeker feels anxious. The reason is breakup.\n"
+    )
+
+
+def test_load_template_picks_once_per_run(tmp_path):
+    template_path = tmp_path / "template.txt"
+    template_path.write_text(TEMPLATE_TEXT, encoding="utf-8")
+    pool_path = tmp_path / "pool.json"
+    pool_path.write_text(json.dumps(POOL), encoding="utf-8")
+    args = argparse.Namespace(
+        prompt_template=str(template_path), example_number=0, example_path=str(pool_path), seed=3
+    )
+    assert load_template(args).text == TEMPLATE_TEXT
+
+    args.example_number = 2
+    template = load_template(args)
+    assert template.text.count("Conversation:\n") == 4
+    expected = few_shot_template(PromptTemplate(TEMPLATE_TEXT), ExampleIndex(POOL).pick(2, seed=3))
+    assert template.text == expected.text
@@ -0,0 +1,64 @@
+import pytest
+
+from bbmhr.pipeline.prompting import (
+    DialogueHistory,
+    check_batch_inference,
+    check_prefix_cache,
+    template_prefix,
+)
+
+TEMPLATE_TEXT = (
+    "Conversation:\nseeker: hello.\nIn this conversation, the seeker did greeting.\n"
+    "Conversation:\n<conversation>In this conversation, the seeker"
+)
+DIALOGS = [
+    "seeker: Hello.",
+    "supporter: How are you?\nseeker: I feel sad, my dog died.",
+    "seeker: I lost my job today.\nsupporter: I am sorry to hear that.\nseeker: I am worried.",
+]
+
+
+@pytest.fixture(params=["gpt", "gpt-2"])
+def tiny_model(request):
+    return request.param, request.getfixturevalue("tiny_gpt" if request.param == "gpt" else "tiny_gpt2")
+
+
+def old_truncation(dialog, allowed_dialog_length, tokenizer):
+    """The truncation of process_prompt_length before DialogueHistory, which tokenized
+       the whole rest of the conversation again for every dropped line."""
+    utterances = dialog.split("\n")
+    text = "\n".join(utterances)
+    while len(tokenizer(text)["input_ids"]) > allowed_dialog_length:
+        utterances.pop(0)
+        text = "\n".join(utterances)
+    return text + "\n"
+
+
+def test_prefix_cache_matches_full_recomputation(tiny_gpt2):
+    model, tokenizer = tiny_gpt2
+    prefix = template_prefix(TEMPLATE_TEXT)
+    for dialog in DIALOGS:
+        prompt = TEMPLATE_TEXT.replace("<conversation>", dialog + "\n")
+        assert check_prefix_cache(prompt, prefix, model, tokenizer, seed=1)
+
+
+def test_batch_inference_matches_single_inference(tiny_model, tmp_path):
+    model_name, (model, tokenizer) = tiny_model
+    template_path = tmp_path / "template.txt"
+    template_path.write_text(TEMPLATE_TEXT, encoding="utf-8")
+    histories = [DialogueHistory(dialog.split("\n")) for dialog in DIALOGS]
+    assert check_batch_inference(model_name, model, tokenizer, str(template_path), DIALOGS, seed=2)
+    assert check_batch_inference(model_name, model, tokenizer, str(template_path), histories, seed=2)
+
+
+def test_window_matches_the_old_truncation(tiny_model):
+    _, (_, tokenizer) = tiny_model
+    history = DialogueHistory()
+    lines = [line for dialog in DIALOGS for line in dialog.split("\n")] * 3
+    for line in lines:
+        # lines are added one at a time, as in self chat, so the cached counts grow
+        history.append(line)
+        for allowed_dialog_length in [0, 5, 20, 60, 1000]:
+            assert history.window(allowed_dialog_length, tokenizer) == old_truncation(
+                history.text(), allowed_dialog_length, tokenizer
+            )
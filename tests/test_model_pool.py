@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from bbmhr.pipeline.model_pool import ModelPool
+
+
+class FakeLoader:
+    def __init__(self):
+        self.loads = []
+
+    def __call__(self, model_name, dtype=None, **load_options):
+        self.loads.append((model_name, dtype, load_options))
+        return object(), object()
+
+
+def test_models_are_loaded_once_and_freed_with_the_last_reference():
+    loader = FakeLoader()
+    pool = ModelPool(loader)
+    first = pool.acquire("gpt-2", low_memory=True)
+    assert pool.acquire("gpt-2") == first
+    pool.retain("gpt-2")
+    other = pool.acquire("gpt-2", dtype=torch.bfloat16)
+    assert other != first
+    assert loader.loads == [("gpt-2", None, {"low_memory": True}), ("gpt-2", torch.bfloat16, {})]
+    assert pool.references() == {("gpt-2", "default"): 3, ("gpt-2", "torch.bfloat16"): 1}
+
+    for _ in range(2):
+        pool.release("gpt-2")
+    assert pool.references()[("gpt-2", "default")] == 1
+    pool.release("gpt-2")
+    pool.release("gpt-2", dtype=torch.bfloat16)
+    assert pool.references() == {}
+
+    # released models are loaded again on the next use
+    assert pool.acquire("gpt-2") != first
+    assert len(loader.loads) == 3
+
+
+def test_unknown_models():
+    pool = ModelPool(FakeLoader())
+    with pytest.raises(KeyError):
+        pool.retain("gpt")
+    pool.release("gpt")
+    assert pool.references() == {}
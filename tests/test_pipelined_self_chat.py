@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+pytest.importorskip("parlai")
+
+from parlai.core.agents import Agent
+from parlai.core.opt import Opt
+from parlai.utils.world_logging import WorldLogger
+
+import bbmhr.parlai.tasks.self_chat.worlds as worlds
+
+MAX_TURNS = 5
+BATCHSIZE = 4
+
+
+class EchoAgent(Agent):
+    """Answers with a digest of everything it saw, one row of a batch at a time."""
+
+    rows = {}
+
+    def __init__(self, opt, shared=None):
+        super().__init__(opt, shared)
+        self.history = []
+
+    def observe(self, observation):
+        observation = dict(observation)
+        self.observation = observation
+        self.history.append(observation.get("text", ""))
+        EchoAgent.rows[id(observation)] = self
+        return observation
+
+    def self_observe(self, action):
+        self.history.append(action["text"])
+
+    def respond(self):
+        digest = abs(hash(tuple(self.history))) % 997
+        text = f"{self.id} of row {self.row} {len(self.history)} {digest}"
+        return {"id": self.id, "text": text, "episode_done": False}
+
+    def act(self):
+        action = self.respond()
+        self.self_observe(action)
+        return action
+
+    def batch_act(self, observations):
+        time.sleep(0.01)
+        return [EchoAgent.rows[id(observation)].respond() for observation in observations]
+
+
+class EpisodeDoneLogger(WorldLogger):
+    """Ends the episode of a row when its sub world is done, as newer ParlAI does."""
+
+    def _log_batch(self, world):
+        for idx, parley in enumerate(zip(*world.get_acts())):
+            self._add_msgs(parley, idx=idx)
+            if world.worlds[idx].episode_done():
+                self.reset_world(idx=idx)
+
+
+def slow_reasoning(name, model, tokenizer, path, histories, seeds=None):
+    # the second pipeline group reasons slowly, so the first one runs ahead
+    if any(f"of row {BATCHSIZE - 1} " in str(history) for history in histories):
+        time.sleep(0.1)
+    return [f" [reasoning {len(history)}]" for history in histories]
+
+
+def run_self_chat(world_class, episodes=2):
+    opt = Opt(
+        {
+            "use_reasoning": True,
+            "reasoning_model_name": "gpt-2",
+            "prompt_path": "",
+            "selfchat_max_turns": MAX_TURNS,
+            "task": "self_chat",
+            "datatype": "valid",
+            "batchsize": BATCHSIZE,
+            "pipeline_groups": 2,
+        }
+    )
+    agents = [EchoAgent(opt), EchoAgent(opt)]
+    world = worlds.SelfChatWorld(Opt(dict(opt, batchsize=1)), agents)
+    world._openers = None
+    world = world_class(opt, world)
+    for row, sub_world in enumerate(world.worlds):
+        for agent, agent_id in zip(sub_world.get_agents(), ["seeker", "supporter"]):
+            agent.id = agent_id
+            agent.row = row
+    logger = EpisodeDoneLogger(Opt({"log_keep_fields": "all"}))
+    for _ in range(episodes):
+        for _ in range(MAX_TURNS):
+            world.parley()
+            logger.log(world)
+        world.reset()
+        for idx in range(BATCHSIZE):
+            logger.reset_world(idx)
+    world.shutdown()
+    return [
+        [[(message.get("id"), message.get("text")) for message in parley] for parley in episode]
+        for episode in logger.get_logs()
+        if episode
+    ]
+
+
+def test_pipelined_logs_match_serial_logs(monkeypatch):
+    monkeypatch.setattr(worlds, "batch_inference", slow_reasoning)
+    monkeypatch.setattr(worlds.model_pool, "loader", lambda name, **kwargs: (None, None))
+    serial = run_self_chat(worlds.BatchSelfChatWorld)
+    pipelined = run_self_chat(worlds.PipelinedSelfChatWorld)
+    assert len(serial) == 2 * BATCHSIZE
+    assert all(len(episode) == MAX_TURNS for episode in serial)
+    assert pipelined == serial
@@ -0,0 +1,41 @@
+import itertools
+
+from bbmhr.pipeline import response_cache
+from bbmhr.pipeline.response_cache import ResponseCache
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    # a clock that always moves on, so that last_used never ties
+    clock = itertools.count(1)
+    monkeypatch.setattr(response_cache.time, "time", lambda: float(next(clock)))
+    path = str(tmp_path / "cache.sqlite")
+    response = {"choices": [{"text": "x" * 100}]}
+    cache = ResponseCache(path, max_bytes=300)
+    cache.put("a", response)
+    cache.put("b", response)
+    size = cache.total_bytes // 2
+    assert cache.get("a") == response
+    cache.put("c", response)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == response and cache.get("c") == response
+    assert cache.stats() == {"hits": 3, "misses": 1, "evictions": 1, "bytes": 2 * size}
+    cache.close()
+
+    # the size of the stored responses is read again on open
+    reopened = ResponseCache(path, max_bytes=300)
+    assert reopened.total_bytes == 2 * size
+    reopened.put("a", response)
+    assert reopened.total_bytes == 2 * size and reopened.evictions == 0
+
+
+def test_read_only_cache_is_never_changed(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path)
+    cache.put("a", "response")
+    cache.close()
+    read_only = ResponseCache(path, read_only=True)
+    assert read_only.get("a") == "response"
+    read_only.put("b", "response")
+    assert read_only.get("b") is None
+    assert read_only.stats() == {"hits": 1, "misses": 1, "evictions": 0, "bytes": cache.total_bytes}
@@ -0,0 +1,13 @@
+import pytest
+
+pytest.importorskip("parlai")
+
+from parlai.core.opt import Opt
+
+from bbmhr.parlai.scripts.self_chat_mental import self_chat
+
+
+def test_self_chat_rejects_a_partial_last_batch():
+    opt = Opt({"seed": 0, "partner_model_file": None, "batchsize": 4, "num_self_chats": 6})
+    with pytest.raises(ValueError, match="multiple of the batchsize"):
+        self_chat(opt)
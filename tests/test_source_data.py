@@ -0,0 +1,109 @@
+import io
+import json
+import random
+
+import pytest
+
+from bbmhr.pipeline import prompting
+from bbmhr.pipeline.retrieval_expert import annotated_contexts
+from bbmhr.pipeline.prompting import (
+    AnnotationCheckpoint,
+    PromptTemplate,
+    assembly_prompt,
+    iter_source_data,
+    seek_seeker_turn,
+    seeker_turn_index,
+    source_dialogs,
+)
+
+TEMPLATE = PromptTemplate("Conversation:\n<conversation>In this conversation, the seeker")
+
+
+@pytest.fixture
+def source_path(tmp_path):
+    """A source file with dialogues without seeker turns and with non-ascii text, so
+       that character and byte offsets differ."""
+    rng = random.Random(0)
+    dialogs = [
+        {
+            "conversation": [
+                {"speaker": rng.choice(["seeker", "supporter"]), "content": f"dialogue {d} turn {u} café ☕"}
+                for u in range(rng.randint(0, 6))
+            ]
+        }
+        for d in range(60)
+    ]
+    path = tmp_path / "source.json"
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(dialogs, file, ensure_ascii=False, indent=2)
+    return str(path)
+
+
+def annotated(source_data, start_index=0):
+    seeker_file = io.StringIO()
+    prompts = list(assembly_prompt(TEMPLATE, source_data, seeker_file, start_index))
+    return prompts, seeker_file.getvalue().splitlines()
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 16])
+def test_iter_source_data_matches_json_load(source_path, chunk_size):
+    with open(source_path, "r", encoding="utf-8") as file:
+        dialogs = json.load(file)
+    assert list(iter_source_data(source_path, chunk_size=chunk_size)) == dialogs
+    assert list(iter_source_data(source_path, 25, chunk_size=chunk_size)) == dialogs[25:]
+
+
+def test_dialogue_offsets_point_at_their_dialogue(source_path):
+    with open(source_path, "rb") as file:
+        content = file.read()
+    offsets = [offset for _, offset in source_dialogs(source_path, chunk_size=7)]
+    assert offsets == [offset for _, offset in source_dialogs(source_path)]
+    assert all(content[offset : offset + 1] == b"{" for offset in offsets)
+    assert list(iter_source_data(source_path, offset=offsets[30])) == list(iter_source_data(source_path, 30))
+
+
+def test_seek_matches_a_full_run(source_path):
+    prompts, seeker_lines = annotated(iter_source_data(source_path))
+    index = seeker_turn_index(source_path)
+    for start_index in [0, 1, 5, 37, len(prompts) - 1, len(prompts), len(prompts) + 3]:
+        source_data, dialog_start_index = seek_seeker_turn(source_path, start_index, index)
+        assert annotated(source_data, dialog_start_index) == (
+            prompts[start_index:],
+            seeker_lines[start_index:],
+        )
+        # skipping inside assembly_prompt gives the same prompts
+        assert annotated(iter_source_data(source_path), start_index)[0] == prompts[start_index:]
+
+
+def test_checkpoint_keeps_the_index(source_path, tmp_path, monkeypatch):
+    response_path = str(tmp_path / "responses.jsonl")
+    checkpoint = AnnotationCheckpoint(response_path, {"seed": 0}, 0)
+    index = checkpoint.seeker_turn_index(source_path)
+    assert index == seeker_turn_index(source_path)
+
+    def fail(path):
+        raise AssertionError("the index was built again")
+
+    monkeypatch.setattr(prompting, "seeker_turn_index", fail)
+    resumed = AnnotationCheckpoint(response_path, {"seed": 0}, 0)
+    assert resumed.seeker_turn_index(source_path) == index
+
+    # a changed source file gets a new index
+    monkeypatch.undo()
+    with open(source_path, "w", encoding="utf-8") as file:
+        json.dump([{"conversation": [{"speaker": "seeker", "content": "hi"}]}], file)
+    assert resumed.seeker_turn_index(source_path) == [(1, 0)]
+
+
+@pytest.mark.parametrize("number", [1, 5, 1000])
+def test_annotated_contexts_match_json_load(source_path, number):
+    with open(source_path, "r", encoding="utf-8") as file:
+        dialogs = json.load(file)
+    contexts, dialog_indices = [], []
+    for dialog_index, data in enumerate(dialogs):
+        lines = [u["speaker"] + ": " + u["content"] for u in data["conversation"]]
+        for turn, utterance in enumerate(data["conversation"]):
+            if utterance["speaker"] == "seeker":
+                contexts.append(lines[: turn + 1])
+                dialog_indices.append(dialog_index)
+    assert annotated_contexts(source_path, number) == (contexts[:number], dialog_indices[:number])
@@ -0,0 +1,52 @@
+import pytest
+
+from bbmhr.pipeline import prompting
+from bbmhr.pipeline.prompting import StoppedStream, stream_inference
+
+TEMPLATE_TEXT = "Conversation:\n<conversation>In this conversation, the seeker"
+
+
+def streamed(pieces, stops):
+    printed = []
+    stream = StoppedStream(printed.append, stops)
+    for piece in pieces:
+        stream.put(piece)
+    return printed, stream.text
+
+
+def test_stream_stops_at_the_first_marker():
+    assert streamed(["feels", " sad.\nsupporter", ": hi\n"], ["\n"]) == (["feels", " sad."], "feels sad.")
+    # the start of a marker is held back until it is complete or broken off
+    printed, text = streamed([" feels sad . conv", "ersation : seeker"], ["\n", "conversation :"])
+    assert printed == [" feels sad . "] and text == " feels sad . "
+    printed, text = streamed([" feels sad . conv", "inced"], ["\n", "conversation :"])
+    assert printed == [" feels sad . ", "convinced"]
+
+
+@pytest.mark.parametrize(
+    "pieces",
+    [
+        [" feels sad", " . conver", "sation : seeker : hi"],
+        [" feels sad . conversation", " :"],
+        # a generation that ends in the middle of a marker
+        [" feels sad . conv"],
+    ],
+)
+def test_gpt_stream_hides_the_stop_marker(tiny_gpt, tmp_path, monkeypatch, pieces):
+    model, tokenizer = tiny_gpt
+    template_path = tmp_path / "template.txt"
+    template_path.write_text(TEMPLATE_TEXT, encoding="utf-8")
+
+    def generate(prompt, model, tokenizer, streamer=None, **kwargs):
+        for piece in pieces:
+            streamer.on_finalized_text(piece)
+        return "conversation : seeker : hello . in this conversation , the seeker" + "".join(pieces)
+
+    monkeypatch.setattr(prompting, "gpt_text_generate", generate)
+    printed = []
+    response = stream_inference(
+        "gpt", model, tokenizer, str(template_path), "seeker: hello.", printed.append
+    )
+    assert "".join(printed) == response[len(" The seeker ") :]
+    assert "conversation :" not in response
+    assert response.startswith(" The seeker  feels sad .")